@@ -1,17 +1,51 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Body
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Body, Header, Query, Depends, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from fastapi.routing import APIRoute
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 from typing import List, Optional, Dict, Any
 from datetime import datetime, timedelta
 from bson import ObjectId
+from pymongo import UpdateOne, CursorType, ReadPreference, ReturnDocument
+from pymongo.read_preferences import PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from pymongo.errors import CollectionInvalid, DuplicateKeyError, OperationFailure
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+import asyncio
+import atexit
+import cProfile
+import csv
+import functools
+import gc
+import gzip
+import hashlib
+import hmac
+import inspect
+import io
 import json
+import linecache
+import marshal
+import pstats
+import queue
+import re
+import sys
+import threading
+import tracemalloc
+import textwrap
+import time
+import unicodedata
+import jwt
+import numpy as np
+import uuid
+from logging.handlers import QueueHandler, QueueListener
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -19,28 +53,357 @@ load_dotenv(ROOT_DIR / '.env')
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+DB_NAME = os.environ['DB_NAME']
+
+# ==================== TENANTS ====================
+# Varios restaurantes en un mismo despliegue: cada uno tiene su base de datos en el
+# mismo cluster (compartiendo el pool de conexiones de `client`) y su namespace de
+# Socket.IO. El restaurante por defecto conserva DB_NAME y el namespace '/'.
+
+TENANT_ID_PATTERN = re.compile(r'^[a-z0-9][a-z0-9_-]{0,39}$')
+DEFAULT_TENANT = os.environ.get('DEFAULT_TENANT', 'default')
+TENANTS = [t.strip() for t in os.environ.get('TENANTS', DEFAULT_TENANT).split(',') if t.strip()]
+if DEFAULT_TENANT not in TENANTS:
+    TENANTS.insert(0, DEFAULT_TENANT)
+for _tenant in TENANTS:
+    if not TENANT_ID_PATTERN.match(_tenant):
+        raise ValueError(f"Invalid tenant id: {_tenant}")
+TENANT_BASE_DOMAIN = os.environ.get('TENANT_BASE_DOMAIN')  # laurel-centro.<dominio> -> laurel-centro
+TENANT_TOKEN_SECRET = os.environ.get('TENANT_TOKEN_SECRET')  # tokens HS256 con claim `tenant`
+
+current_tenant: ContextVar[str] = ContextVar('current_tenant', default=DEFAULT_TENANT)
+
+@contextmanager
+def tenant_context(tenant: str):
+    token = current_tenant.set(tenant)
+    try:
+        yield
+    finally:
+        current_tenant.reset(token)
+
+def tenant_db_name(tenant: str) -> str:
+    return DB_NAME if tenant == DEFAULT_TENANT else f"{DB_NAME}_{tenant}"
+
+def tenant_namespace(tenant: Optional[str] = None) -> str:
+    tenant = tenant or current_tenant.get()
+    return '/' if tenant == DEFAULT_TENANT else f"/{tenant}"
+
+def namespace_tenant(namespace: str) -> Optional[str]:
+    tenant = DEFAULT_TENANT if namespace == '/' else namespace.lstrip('/')
+    return tenant if tenant in TENANTS else None
+
+def tenant_from_token(token: Optional[str]) -> Optional[str]:
+    """The `tenant` claim of a signed token, or None if there is no valid one"""
+    if not token or not TENANT_TOKEN_SECRET:
+        return None
+    try:
+        claims = jwt.decode(token, TENANT_TOKEN_SECRET, algorithms=['HS256'])
+    except jwt.InvalidTokenError:
+        return None
+    return claims.get('tenant')
+
+def requested_tenant(headers: Dict[str, str]) -> Optional[str]:
+    """Tenant asked for by a request: token claim, then X-Tenant-ID, then subdomain"""
+    authorization = headers.get('authorization', '')
+    if authorization.lower().startswith('bearer '):
+        tenant = tenant_from_token(authorization[7:].strip())
+        if tenant:
+            return tenant
+    if headers.get('x-tenant-id'):
+        return headers['x-tenant-id'].strip().lower()
+    if TENANT_BASE_DOMAIN:
+        host = headers.get('host', '').split(':')[0].lower()
+        if host.endswith('.' + TENANT_BASE_DOMAIN):
+            return host[:-len(TENANT_BASE_DOMAIN) - 1]
+    return None
+
+def environ_headers(environ: Dict) -> Dict[str, str]:
+    """Lower-case HTTP headers from a Socket.IO connect environ"""
+    return {key[5:].replace('_', '-').lower(): value for key, value in environ.items() if key.startswith('HTTP_')}
+
+class TenantDatabase:
+    """Stand-in for a Motor database that routes every collection access to the current tenant's database"""
+    
+    def __init__(self, **options):
+        self._options = options
+        self._databases: Dict[str, Any] = {}
+    
+    def current(self):
+        tenant = current_tenant.get()
+        if tenant not in self._databases:
+            self._databases[tenant] = client.get_database(tenant_db_name(tenant), **self._options)
+        return self._databases[tenant]
+    
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+    
+    def __getitem__(self, name):
+        return self.current()[name]
+
+class PerTenant:
+    """One instance of an in-memory structure (cache, event log, cube) per tenant, created on first use"""
+    
+    def __init__(self, factory):
+        self._factory = factory
+        self._instances: Dict[str, Any] = {}
+    
+    def current(self):
+        tenant = current_tenant.get()
+        if tenant not in self._instances:
+            self._instances[tenant] = self._factory()
+        return self._instances[tenant]
+    
+    def instances(self) -> List[Any]:
+        """Every tenant's instance created so far"""
+        return list(self._instances.values())
+    
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+db = TenantDatabase()
+
+# Lecturas de analítica e historial: pueden ir a secundarios (con un retraso máximo)
+# para no competir con las escrituras de pedidos y pagos en el primario
+ANALYTICS_READ_PREFERENCE = os.environ.get('ANALYTICS_READ_PREFERENCE', 'secondaryPreferred')
+ANALYTICS_MAX_STALENESS_SECONDS = int(os.environ.get('ANALYTICS_MAX_STALENESS_SECONDS', '90'))
+
+def analytics_read_preference():
+    if ANALYTICS_READ_PREFERENCE == 'primary':
+        return ReadPreference.PRIMARY
+    modes = {
+        'primaryPreferred': PrimaryPreferred,
+        'secondary': Secondary,
+        'secondaryPreferred': SecondaryPreferred,
+        'nearest': Nearest,
+    }
+    if ANALYTICS_READ_PREFERENCE not in modes:
+        raise ValueError(f"Unsupported ANALYTICS_READ_PREFERENCE: {ANALYTICS_READ_PREFERENCE}")
+    # MongoDB exige un maxStalenessSeconds de al menos 90
+    return modes[ANALYTICS_READ_PREFERENCE](max_staleness=max(90, ANALYTICS_MAX_STALENESS_SECONDS))
+
+analytics_db = TenantDatabase(read_preference=analytics_read_preference())
 
 # Socket.IO setup
+
+class AsyncMongoManager(AsyncPubSubManager):
+    """
+    Socket.IO client manager that relays emits between workers through a
+    capped MongoDB collection, so no extra broker is needed.
+    """
+    name = 'asyncmongo'
+    
+    def __init__(self, database, channel='socketio', write_only=False, logger=None, size=16 * 1024 * 1024):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.database = database
+        self.collection_name = f"pubsub_{channel}"
+        self.size = size
+        self._ready = False
+    
+    async def _collection(self):
+        if not self._ready:
+            if self.collection_name not in await self.database.list_collection_names():
+                try:
+                    await self.database.create_collection(self.collection_name, capped=True, size=self.size)
+                    # Un cursor tailable sobre una colección vacía muere al instante
+                    await self.database[self.collection_name].insert_one({'message': None})
+                except CollectionInvalid:
+                    pass
+            self._ready = True
+        return self.database[self.collection_name]
+    
+    async def _publish(self, data):
+        collection = await self._collection()
+        await collection.insert_one({'message': json.dumps(data), 'created_at': datetime.utcnow()})
+    
+    async def _listen(self):
+        collection = await self._collection()
+        # Se sigue el orden de inserción: los ObjectId de distintos workers no crecen
+        # en ese orden, así que no sirven para filtrar lo ya leído
+        last = await collection.find_one({}, sort=[('$natural', -1)])
+        last_id = last['_id'] if last else None
+        while True:
+            # Al volver a seguir la colección se salta hasta el último mensaje leído;
+            # si ya se descartó, todo lo que queda es posterior
+            seen = last_id is None or await collection.find_one({'_id': last_id}) is None
+            cursor = collection.find(cursor_type=CursorType.TAILABLE_AWAIT)
+            while cursor.alive:
+                async for doc in cursor:
+                    if not seen:
+                        seen = doc['_id'] == last_id
+                        continue
+                    last_id = doc['_id']
+                    if doc.get('message'):
+                        yield doc['message']
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.5)
+
+def create_client_manager():
+    """
+    Pick the Socket.IO client manager from SOCKETIO_MESSAGE_QUEUE:
+    unset -> single process, redis://... -> Redis pub/sub (needs the `redis`
+    package), mongodb -> capped collection in DB_NAME, mongodb://... -> same
+    on another server. One channel serves every tenant namespace.
+    """
+    queue_url = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+    if not queue_url:
+        return None
+    if queue_url.startswith(('redis://', 'rediss://', 'unix://')):
+        return socketio.AsyncRedisManager(queue_url)
+    if queue_url == 'mongodb':
+        return AsyncMongoManager(client[DB_NAME])
+    if queue_url.startswith(('mongodb://', 'mongodb+srv://')):
+        return AsyncMongoManager(AsyncIOMotorClient(queue_url)[DB_NAME])
+    raise ValueError(f"Unsupported SOCKETIO_MESSAGE_QUEUE: {queue_url}")
+
 sio = socketio.AsyncServer(
     async_mode='asgi',
+    client_manager=create_client_manager(),
+    namespaces=[tenant_namespace(tenant) for tenant in TENANTS],
     cors_allowed_origins='*',
     logger=False,
     engineio_logger=False
 )
 
+# Identificador de este proceso (worker) para el registro compartido de clientes
+WORKER_ID = getattr(sio.manager, 'host_id', None) or str(ObjectId())
+
+# Con cola de mensajes los clientes reciben los eventos de todos los workers
+MULTI_WORKER = isinstance(sio.manager, AsyncPubSubManager)
+
 # Create the main app
 app = FastAPI()
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+# Herramientas de diagnóstico: solo con ADMIN_TOKEN configurado y enviado en X-Admin-Token
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+async def require_admin(x_admin_token: Optional[str] = Header(None, alias="X-Admin-Token")):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Admin endpoints are disabled")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+admin_router = APIRouter(prefix="/api/admin", dependencies=[Depends(require_admin)])
+
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Al arrancar la app, los registros pasan a salir del event loop por una cola y un
+# hilo (QueueListener) los formatea y escribe. LOG_FORMAT=text|json (texto por
+# defecto; con json también los de uvicorn), LOG_LEVEL y niveles por módulo en
+# LOG_LEVELS, p. ej. "server.sockets=WARNING,pymongo=WARNING,uvicorn.access=WARNING".
+# Los eventos de mucho volumen llevan extra={'sample': clave} y se limitan a
+# LOG_SAMPLE_PER_SECOND por clave; el siguiente que pasa indica cuántos se omitieron.
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+LOG_SAMPLE_PER_SECOND = float(os.environ.get('LOG_SAMPLE_PER_SECOND', '10'))
+
+request_id: ContextVar[Optional[str]] = ContextVar('request_id', default=None)
+
+STANDARD_LOG_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; extra={...} fields become top-level keys"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.utcfromtimestamp(record.created).isoformat(timespec='milliseconds') + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_LOG_FIELDS and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class ContextFilter(logging.Filter):
+    """Stamp records with the request id and tenant of the task that logged them"""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get()
+        record.tenant = current_tenant.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Token bucket per `sample` key; errors and untagged records always pass"""
+    
+    def __init__(self, per_second: float):
+        super().__init__()
+        self.per_second = per_second
+        self.buckets: Dict[str, List[float]] = {}  # clave -> [tokens, último relleno, omitidos]
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, 'sample', None)
+        if key is None or record.levelno >= logging.ERROR:
+            return True
+        now = time.monotonic()
+        bucket = self.buckets.setdefault(key, [self.per_second, now, 0])
+        bucket[0] = min(self.per_second, bucket[0] + (now - bucket[1]) * self.per_second)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False
+        bucket[0] -= 1
+        if bucket[2]:
+            record.suppressed = int(bucket[2])
+            bucket[2] = 0
+        return True
+
+class LoopQueueHandler(QueueHandler):
+    """QueueHandler for an in-process listener: resolve the message, leave formatting to the listener thread"""
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def configure_logging() -> QueueListener:
+    output = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'))
+    
+    handler = LoopQueueHandler(queue.SimpleQueue())
+    handler.addFilter(ContextFilter())
+    handler.addFilter(SamplingFilter(LOG_SAMPLE_PER_SECOND))
+    
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    
+    # uvicorn instala sus propios handlers; en JSON pasa también por la cola para
+    # que toda la salida tenga el mismo formato, en texto se le deja como está
+    if LOG_FORMAT == 'json':
+        for name in ('uvicorn', 'uvicorn.error', 'uvicorn.access'):
+            uvicorn_logger = logging.getLogger(name)
+            uvicorn_logger.handlers = []
+            uvicorn_logger.propagate = True
+    
+    for item in os.environ.get('LOG_LEVELS', '').split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+    
+    listener = QueueListener(handler.queue, output, respect_handler_level=True)
+    listener.start()
+    # Al salir del proceso, después de los handlers de shutdown, se vacía la cola
+    atexit.register(listener.stop)
+    return listener
+
+# Se configura al arrancar y no al importar: quien importe el módulo (tests,
+# scripts) conserva su propia configuración de logging
+@app.on_event("startup")
+async def start_logging():
+    if not getattr(app.state, 'log_listener', None):
+        app.state.log_listener = configure_logging()
+
 logger = logging.getLogger(__name__)
+sockets_logger = logger.getChild('sockets')
 
 # ==================== MODELS ====================
 
@@ -146,56 +509,421 @@ class Settings(BaseModel):
         json_encoders = {ObjectId: str}
         populate_by_name = True
 
+class SyncOperation(BaseModel):
+    op_id: str  # id único generado por el cliente
+    type: str  # create_order, update_order, partial_payment, delete_order
+    order_id: Optional[str] = None  # id real o id local asignado offline
+    data: Optional[Dict[str, Any]] = None
+
+class SyncBatch(BaseModel):
+    client_id: Optional[str] = None
+    operations: List[SyncOperation]
+
 # ==================== SOCKET.IO EVENTS ====================
 
-connected_clients = {}
+class ClientRegistry:
+    """Connected Socket.IO clients and their roles, shared by every worker through MongoDB"""
+    
+    def __init__(self):
+        self.local: Dict[str, Dict] = {}  # clientes conectados a este worker
+    
+    def local_sids(self) -> List[str]:
+        """This worker's clients of the current tenant"""
+        tenant = current_tenant.get()
+        return [sid for sid, client_info in self.local.items() if client_info['tenant'] == tenant]
+    
+    async def add(self, sid: str):
+        self.local[sid] = {"role": None, "tenant": current_tenant.get()}
+        await db.socket_clients.update_one(
+            {'_id': sid},
+            {'$set': {'role': None, 'worker': WORKER_ID, 'connected_at': datetime.utcnow()}},
+            upsert=True
+        )
+    
+    async def set_role(self, sid: str, role: Optional[str]):
+        self.local[sid] = {"role": role, "tenant": current_tenant.get()}
+        await db.socket_clients.update_one({'_id': sid}, {'$set': {'role': role}})
+    
+    async def remove(self, sid: str):
+        self.local.pop(sid, None)
+        await db.socket_clients.delete_one({'_id': sid})
+    
+    async def prune(self) -> int:
+        """Drop local entries whose socket is gone without a disconnect event"""
+        stale = [
+            sid for sid, client_info in self.local.items()
+            if not sio.manager.is_connected(sid, tenant_namespace(client_info['tenant']))
+        ]
+        for sid in stale:
+            with tenant_context(self.local[sid]['tenant']):
+                await self.remove(sid)
+            flow_control.forget(sid)
+        return len(stale)
+    
+    async def run(self, interval: float = 60.0):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                stale = await self.prune()
+                if stale:
+                    sockets_logger.warning("Pruned stale socket clients", extra={'count': stale})
+            except Exception as e:
+                sockets_logger.error("Client registry prune error: %s", e)
+    
+    async def remove_worker(self):
+        """Forget this worker's clients (on shutdown)"""
+        self.local.clear()
+        for tenant in TENANTS:
+            with tenant_context(tenant):
+                await db.socket_clients.delete_many({'worker': WORKER_ID})
+    
+    async def summary(self) -> Dict:
+        workers = {}
+        roles = {}
+        async for row in db.socket_clients.aggregate([
+            {'$group': {'_id': {'worker': '$worker', 'role': '$role'}, 'count': {'$sum': 1}}}
+        ]):
+            workers[row['_id']['worker']] = workers.get(row['_id']['worker'], 0) + row['count']
+            role = row['_id']['role'] or 'sin_rol'
+            roles[role] = roles.get(role, 0) + row['count']
+        return {'total': sum(workers.values()), 'by_role': roles, 'by_worker': workers}
+
+connected_clients = ClientRegistry()
+
+EVENT_BUFFER_SIZE = int(os.environ.get('EVENT_BUFFER_SIZE', '2000'))
+# Con cola de mensajes los eventos se guardan en la colección event_log durante este tiempo
+EVENT_LOG_TTL_SECONDS = int(os.environ.get('EVENT_LOG_TTL_SECONDS', '600'))
+
+class EventLog:
+    """
+    Stamps every broadcast with a sequence number and keeps the last
+    events so reconnecting clients get only what they missed.
+    Sequences are per worker and tenant; the epoch tells clients which worker issued them,
+    and clients track the last sequence of every epoch they hear from.
+    A single worker keeps the events in a ring buffer. Behind a message queue a
+    client also gets other workers' events, so each worker stores its own in the
+    tenant's event_log collection and any worker can replay them from there.
+    """
+    
+    def __init__(self, size: int):
+        self.epoch = WORKER_ID
+        self.seq = 0
+        self.buffer: deque = deque(maxlen=size)  # (seq, event, data)
+        # Guardar y emitir en el orden de la secuencia: el cliente descarta lo que llega atrasado
+        self.lock = asyncio.Lock()
+    
+    def stamp(self, event: str, data: Any) -> Any:
+        self.seq += 1
+        if isinstance(data, dict):
+            data = {**data, '_seq': self.seq, '_epoch': self.epoch}
+        if not MULTI_WORKER:
+            self.buffer.append((self.seq, event, data))
+        return data
+    
+    async def store(self, event: str, data: Any):
+        """Keep a stamped event where every worker can replay it (behind a message queue only)"""
+        if MULTI_WORKER:
+            await db.event_log.insert_one({
+                'epoch': self.epoch, 'seq': self.seq, 'event': event, 'data': data, 'created_at': datetime.utcnow()
+            })
+    
+    def since(self, last_seq: int) -> Optional[List[tuple]]:
+        """Events after last_seq, or None if the gap is larger than the buffer"""
+        if last_seq > self.seq:
+            return None
+        if last_seq == self.seq:
+            return []
+        if not self.buffer or last_seq < self.buffer[0][0] - 1:
+            return None
+        return [entry for entry in self.buffer if entry[0] > last_seq]
+    
+    async def heads(self) -> Dict[str, int]:
+        """Last sequence of every epoch a client can still resume from"""
+        if not MULTI_WORKER:
+            return {self.epoch: self.seq}
+        heads = {self.epoch: self.seq}
+        for epoch in await db.event_log.distinct('epoch'):
+            last = await db.event_log.find_one({'epoch': epoch}, sort=[('seq', -1)])
+            if last:
+                heads[epoch] = max(heads.get(epoch, 0), last['seq'])
+        return heads
+    
+    async def missed(self, seqs: Dict[str, int]) -> Optional[List[tuple]]:
+        """
+        Events after the last sequence the client saw of each epoch, in the
+        order they were emitted, or None if some of them are no longer kept.
+        """
+        if not MULTI_WORKER:
+            return self.since(int(seqs[self.epoch])) if self.epoch in seqs else None
+        
+        entries = []
+        for epoch in set(seqs) | set(await db.event_log.distinct('epoch')):
+            last = int(seqs.get(epoch) or 0)
+            # Se incluye el último visto: si ya caducó no se sabe qué vino justo después
+            found = await db.event_log.find(
+                {'epoch': epoch, 'seq': {'$gte': last}}
+            ).sort('seq', 1).to_list(EVENT_BUFFER_SIZE + 1)
+            if last and (not found or found[0]['seq'] != last):
+                return None
+            if not last and found and found[0]['seq'] != 1:
+                return None
+            entries.extend(entry for entry in found if entry['seq'] > last)
+            if len(entries) > EVENT_BUFFER_SIZE:
+                return None
+        entries.sort(key=lambda entry: entry['created_at'])
+        return [(entry['seq'], entry['event'], entry['data']) for entry in entries]
+
+event_log = PerTenant(lambda: EventLog(EVENT_BUFFER_SIZE))
+
+SLOW_QUEUE_DEPTH = int(os.environ.get('SLOW_QUEUE_DEPTH', '50'))
+SLOW_LAG_SECONDS = float(os.environ.get('SLOW_LAG_SECONDS', '2'))
+RESYNC_PENDING_EVENTS = int(os.environ.get('RESYNC_PENDING_EVENTS', '200'))
+RESYNC_LAG_SECONDS = float(os.environ.get('RESYNC_LAG_SECONDS', '15'))
+
+class FlowControl:
+    """
+    Per-client backpressure for broadcasts. A client whose outbound queue is
+    deep or has not drained for a while is marked slow: it stops receiving
+    broadcasts directly and its events are coalesced (the newest version of
+    each order/product/category wins) until the queue drains. Past a harder
+    threshold its backlog is dropped and it is told to resync.
+    """
+    
+    def __init__(self):
+        self.clients: Dict[str, Dict] = {}
+        self.totals = {'coalesced': 0, 'dropped': 0, 'resyncs': 0, 'flushed': 0}
+    
+    def _state(self, sid: str) -> Dict:
+        if sid not in self.clients:
+            self.clients[sid] = {
+                'slow': False, 'pending': OrderedDict(), 'drained_at': time.monotonic(),
+                'depth': 0, 'max_depth': 0, 'coalesced': 0, 'dropped': 0, 'resyncs': 0
+            }
+        return self.clients[sid]
+    
+    def forget(self, sid: str):
+        self.clients.pop(sid, None)
+    
+    def queue_depth(self, sid: str) -> int:
+        tenant = connected_clients.local.get(sid, {}).get('tenant', DEFAULT_TENANT)
+        eio_sid = sio.manager.eio_sid_from_sid(sid, tenant_namespace(tenant))
+        socket = sio.eio.sockets.get(eio_sid) if eio_sid else None
+        return socket.queue.qsize() if socket else 0
+    
+    def sample(self, sid: str) -> Dict:
+        state = self._state(sid)
+        now = time.monotonic()
+        state['depth'] = self.queue_depth(sid)
+        state['max_depth'] = max(state['max_depth'], state['depth'])
+        if state['depth'] == 0:
+            state['drained_at'] = now
+        state['lag'] = now - state['drained_at']
+        return state
+    
+    def slow_sids(self) -> List[str]:
+        """Re-evaluate the current tenant's local clients and return the ones that must not get direct broadcasts"""
+        slow = []
+        for sid in connected_clients.local_sids():
+            state = self.sample(sid)
+            if not state['slow'] and (state['depth'] >= SLOW_QUEUE_DEPTH or state['lag'] >= SLOW_LAG_SECONDS):
+                state['slow'] = True
+                sockets_logger.warning("Slow consumer", extra={
+                    'sample': 'socket_slow', 'sid': sid, 'queue': state['depth'], 'lag': round(state['lag'], 1)
+                })
+            if state['slow']:
+                slow.append(sid)
+        return slow
+    
+    @staticmethod
+    def _coalesce_key(event: str, data: Any):
+        entity, _, action = event.rpartition('_')
+        if action in ('created', 'updated', 'deleted') and isinstance(data, dict):
+            entity_id = data.get('_id') or data.get(f"{entity}_id")
+            if entity_id:
+                return (entity, entity_id)
+        return None
+    
+    def defer(self, sid: str, event: str, data: Any):
+        """Hold an event for a slow client, replacing superseded versions"""
+        state = self._state(sid)
+        pending = state['pending']
+        key = self._coalesce_key(event, data)
+        
+        if key is None:
+            pending[('seq', event_log.seq, event)] = (event, data)
+        elif key in pending:
+            previous_event, _ = pending.pop(key)
+            state['coalesced'] += 1
+            self.totals['coalesced'] += 1
+            if previous_event.endswith('_created') and event.endswith('_deleted'):
+                pass  # el cliente nunca lo llegó a ver
+            elif previous_event.endswith('_created'):
+                pending[key] = (previous_event, data)
+            else:
+                pending[key] = (event, data)
+        else:
+            pending[key] = (event, data)
+        
+        if len(pending) > RESYNC_PENDING_EVENTS or state.get('lag', 0) > RESYNC_LAG_SECONDS:
+            self.totals['dropped'] += len(pending)
+            state['dropped'] += len(pending)
+            pending.clear()
+            state['resyncs'] += 1
+            state['resync'] = True
+            self.totals['resyncs'] += 1
+    
+    async def flush(self):
+        """Deliver coalesced backlogs to slow clients whose queue has drained"""
+        for sid, state in list(self.clients.items()):
+            if not state['slow'] or sid not in connected_clients.local:
+                continue
+            self.sample(sid)
+            if state['depth'] > SLOW_QUEUE_DEPTH // 2:
+                continue
+            
+            with tenant_context(connected_clients.local[sid]['tenant']):
+                if state.pop('resync', False):
+                    sockets_logger.warning("Client fell too far behind; forcing resync", extra={'sample': 'socket_resync', 'sid': sid})
+                    await sio.emit('resync_required', {'epoch': event_log.epoch, 'seq': event_log.seq},
+                                   room=sid, namespace=tenant_namespace())
+                pending = list(state['pending'].values())
+                state['pending'].clear()
+                for event, data in pending:
+                    await sio.emit(event, data, room=sid, namespace=tenant_namespace())
+            self.totals['flushed'] += len(pending)
+            state['slow'] = False
+    
+    async def run(self, interval: float = 0.25):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Flow control flush error: %s", e)
+    
+    def stats(self) -> Dict:
+        clients = {}
+        for sid in connected_clients.local_sids():
+            if sid not in self.clients:
+                continue
+            state = self.clients[sid]
+            clients[sid] = {
+                'role': connected_clients.local.get(sid, {}).get('role'),
+                'slow': state['slow'],
+                'queue_depth': state['depth'],
+                'max_queue_depth': state['max_depth'],
+                'lag_seconds': round(state.get('lag', 0), 3),
+                'pending': len(state['pending']),
+                'coalesced': state['coalesced'],
+                'dropped': state['dropped'],
+                'resyncs': state['resyncs']
+            }
+        return {
+            'slow_clients': sum(1 for c in clients.values() if c['slow']),
+            'thresholds': {
+                'slow_queue_depth': SLOW_QUEUE_DEPTH, 'slow_lag_seconds': SLOW_LAG_SECONDS,
+                'resync_pending_events': RESYNC_PENDING_EVENTS, 'resync_lag_seconds': RESYNC_LAG_SECONDS
+            },
+            'totals': dict(self.totals),
+            'clients': clients
+        }
+
+flow_control = FlowControl()
 
-@sio.event
-async def connect(sid, environ):
-    logger.info(f"Client connected: {sid}")
-    connected_clients[sid] = {"role": None}
-    await sio.emit('connection_established', {'sid': sid}, room=sid)
+def tenant_event(handler):
+    """Register a Socket.IO event handler on every tenant namespace; it runs in that tenant's context"""
+    async def dispatch(namespace, sid, *args):
+        tenant = namespace_tenant(namespace)
+        if tenant is None:
+            return False
+        token = request_id.set(f"sio:{sid}")
+        try:
+            with tenant_context(tenant):
+                return await handler(sid, *args)
+        finally:
+            request_id.reset(token)
+    
+    sio.on(handler.__name__, namespace='*')(dispatch)
+    socket_handlers[handler.__name__] = handler
+    return handler
+
+socket_handlers: Dict[str, Any] = {}  # nombre del evento -> handler (para el perfilador)
+
+@tenant_event
+async def connect(sid, environ, auth=None):
+    # El namespace elige el restaurante; un token, cabecera o subdominio que pida otro se rechaza
+    token = auth.get('token') if isinstance(auth, dict) else None
+    requested = tenant_from_token(token) or requested_tenant(environ_headers(environ))
+    if requested and requested != current_tenant.get():
+        sockets_logger.warning("Client refused: tenant mismatch", extra={
+            'sample': 'socket_refused', 'sid': sid, 'requested_tenant': requested
+        })
+        return False
+    
+    sockets_logger.info("Client connected", extra={'sample': 'socket_connect', 'sid': sid})
+    await connected_clients.add(sid)
+    await sio.emit('connection_established', {
+        'sid': sid, 'tenant': current_tenant.get(), 'epoch': event_log.epoch, 'seq': event_log.seq,
+        'seqs': await event_log.heads()
+    }, room=sid, namespace=tenant_namespace())
 
-@sio.event
-async def disconnect(sid):
-    logger.info(f"Client disconnected: {sid}")
-    if sid in connected_clients:
-        del connected_clients[sid]
+@tenant_event
+async def disconnect(sid, reason=None):
+    sockets_logger.info("Client disconnected", extra={'sample': 'socket_disconnect', 'sid': sid, 'reason': reason})
+    await connected_clients.remove(sid)
+    flow_control.forget(sid)
 
-@sio.event
+@tenant_event
 async def set_role(sid, data):
     role = data.get('role')
-    connected_clients[sid] = {"role": role}
-    logger.info(f"Client {sid} set role: {role}")
+    await connected_clients.set_role(sid, role)
+    sockets_logger.info("Client set role", extra={'sample': 'socket_set_role', 'sid': sid, 'role': role})
 
-@sio.event
+@tenant_event
 async def sync_request(sid, data):
     """Client requests full sync"""
+    try:
+        async with admission_classes['sync'].slot():
+            await send_full_sync(sid)
+    except Overloaded as e:
+        await sio.emit('sync_busy', {'retry_after': e.retry_after}, room=sid, namespace=tenant_namespace())
+
+async def send_full_sync(sid):
     try:
         orders = await db.orders.find().to_list(1000)
         products = await db.products.find().to_list(1000)
         categories = await db.categories.find().to_list(1000)
         
-        for order in orders:
-            order['_id'] = str(order['_id'])
-            order['created_at'] = order['created_at'].isoformat()
-            order['updated_at'] = order['updated_at'].isoformat()
-        
-        for product in products:
-            product['_id'] = str(product['_id'])
-            product['created_at'] = product['created_at'].isoformat()
-        
-        for category in categories:
-            category['_id'] = str(category['_id'])
-            category['created_at'] = category['created_at'].isoformat()
-        
         await sio.emit('sync_data', {
-            'orders': orders,
-            'products': products,
-            'categories': categories
-        }, room=sid)
+            'orders': [serialize_doc(o) for o in orders],
+            'products': [serialize_doc(p) for p in products],
+            'categories': [serialize_doc(c) for c in categories],
+            'epoch': event_log.epoch,
+            'seq': event_log.seq,
+            'seqs': await event_log.heads()
+        }, room=sid, namespace=tenant_namespace())
     except Exception as e:
-        logger.error(f"Sync error: {str(e)}")
+        sockets_logger.error("Sync error: %s", e, extra={'sid': sid})
+
+@tenant_event
+async def resume(sid, data):
+    """Reconnecting client sends the last seq of every epoch; replay the missed events or fall back to a full sync"""
+    seqs = data.get('seqs') or {data.get('epoch'): data.get('last_seq', 0)}
+    missed = await event_log.missed(seqs)
+    
+    if missed is None:
+        sockets_logger.info("Resume gap too large; full sync", extra={'sample': 'socket_resume', 'sid': sid})
+        await sync_request(sid, {})
+    else:
+        for _, event, payload in missed:
+            await sio.emit(event, payload, room=sid, namespace=tenant_namespace())
+    
+    await sio.emit('resume_complete', {
+        'epoch': event_log.epoch,
+        'seq': event_log.seq,
+        'full_sync': missed is None,
+        'replayed': len(missed) if missed is not None else 0
+    }, room=sid, namespace=tenant_namespace())
 
 # ==================== HELPER FUNCTIONS ====================
 
@@ -241,7 +969,7 @@ async def send_notification(waiter_role: str, order_id: str, message: str):
     try:
         settings = await db.settings.find_one()
         if not settings or not settings.get('onesignal_app_id') or not settings.get('onesignal_api_key'):
-            logger.warning("OneSignal not configured")
+            logger.warning("OneSignal not configured", extra={'sample': 'onesignal_missing'})
             return
         
         await sio.emit('notification', {
@@ -249,23 +977,2265 @@ async def send_notification(waiter_role: str, order_id: str, message: str):
             'order_id': order_id,
             'message': message,
             'timestamp': datetime.utcnow().isoformat()
-        })
+        }, namespace=tenant_namespace())
         
     except Exception as e:
-        logger.error(f"Notification error: {str(e)}")
+        logger.error("Notification error: %s", e)
+
+def calculate_order_amounts(order: Dict) -> Dict:
+    """Calculate total, paid and pending amounts"""
+    total = sum(p['price'] * p['quantity'] for p in order['products'])
+    paid_amount = sum(payment['amount'] for payment in order.get('partial_payments', []))
+    pending_amount = max(0, total - paid_amount)
+    
+    return {
+        'total': round(total, 2),
+        'paid_amount': round(paid_amount, 2),
+        'pending_amount': round(pending_amount, 2)
+    }
+
+async def insert_order(order_dict: Dict) -> Dict:
+    """Prepare and insert a new order document (no broadcast)"""
+    order_dict['created_at'] = datetime.utcnow()
+    order_dict['updated_at'] = datetime.utcnow()
+    
+    # Set original_price for all products
+    for product in order_dict['products']:
+        if 'original_price' not in product:
+            product['original_price'] = product['price']
+        if 'is_paid' not in product:
+            product['is_paid'] = False
+    
+    # Calculate amounts
+    amounts = calculate_order_amounts(order_dict)
+    order_dict.update(amounts)
+    
+    # Find similar orders
+    similar_orders = await find_similar_orders(order_dict)
+    if similar_orders:
+        order_dict['unified_with'] = [str(o['_id']) for o in similar_orders]
+    
+    async def insert(session):
+        result = await db.orders.insert_one(order_dict, session=session)
+        # Un pedido que ya se crea entregado (barra, sincronización) se cobra al crearlo
+        await record_settlement(str(result.inserted_id), None, order_dict, session=session)
+        return result.inserted_id
+    
+    order_dict['_id'] = str(await run_in_transaction(insert))
+    
+    await on_order_changed(None, order_dict)
+    return order_dict
+
+async def apply_order_update(order_id: str, order_dict: Dict):
+    """Replace an order's fields; returns (order, became_ready) (no broadcast)"""
+    order_dict['updated_at'] = datetime.utcnow()
+    
+    # Recalculate amounts
+    amounts = calculate_order_amounts(order_dict)
+    order_dict.update(amounts)
+    # closed_date lo pone el cierre del día: el null que manda el cliente no reabre el pedido
+    fields = {k: v for k, v in order_dict.items() if k != 'closed_date'}
+    
+    async def update(session):
+        old_order = await db.orders.find_one({"_id": ObjectId(order_id)}, session=session)
+        await db.orders.update_one(
+            {"_id": ObjectId(order_id)},
+            {"$set": fields},
+            session=session
+        )
+        order_dict['closed_date'] = old_order.get('closed_date') if old_order else None
+        await record_settlement(order_id, old_order, order_dict, session=session)
+        return old_order
+    
+    old_order = await run_in_transaction(update)
+    order_dict['_id'] = order_id
+    
+    await on_order_changed(old_order, order_dict)
+    
+    became_ready = bool(old_order) and old_order.get('status') != 'listo' and order_dict.get('status') == 'listo'
+    return order_dict, became_ready
+
+async def apply_partial_payment(order_id: str, payment_dict: Dict) -> Optional[Dict]:
+    """Append a partial payment to an order and to the payments ledger, atomically; returns None if missing (no broadcast)"""
+    payment_dict['timestamp'] = datetime.utcnow()
+    
+    async def pay(session):
+        order = await db.orders.find_one({"_id": ObjectId(order_id)}, session=session)
+        if not order:
+            return None
+        old_order = dict(order)
+        await db.orders.update_one(
+            {"_id": ObjectId(order_id)},
+            {"$set": add_payment_to_order(order, dict(payment_dict))},
+            session=session
+        )
+        await db.payments.insert_one(
+            payment_entry(order, payment_dict['amount'], payment_dict['payment_method'], 'partial', payment_dict['timestamp']),
+            session=session
+        )
+        # Si ya estaba entregado, el pago reduce lo cobrado al entregar
+        await record_settlement(order_id, old_order, order, session=session)
+        return await db.orders.find_one({"_id": ObjectId(order_id)}, session=session)
+    
+    return await run_in_transaction(pay)
+
+def add_payment_to_order(order: Dict, payment_dict: Dict) -> Dict:
+    """Record a payment on an order document in place; returns the fields to $set"""
+    # Mark products as paid
+    for product in order['products']:
+        if product['product_id'] in payment_dict['paid_products']:
+            product['is_paid'] = True
+    
+    order.setdefault('partial_payments', []).append(payment_dict)
+    
+    # Recalculate amounts
+    amounts = calculate_order_amounts(order)
+    order.update(amounts)
+    order['updated_at'] = datetime.utcnow()
+    
+    return {
+        "products": order['products'],
+        "partial_payments": order['partial_payments'],
+        "paid_amount": order['paid_amount'],
+        "pending_amount": order['pending_amount'],
+        "updated_at": order['updated_at']
+    }
+
+async def remove_order(order_id: str):
+    """Delete an order (no broadcast)"""
+    async def delete(session):
+        old_order = await db.orders.find_one_and_delete({"_id": ObjectId(order_id)}, session=session)
+        await record_settlement(order_id, old_order, None, session=session)
+        if old_order and old_order.get('status') == 'entregado':
+            await db.deleted_orders.update_one(
+                {'_id': order_id}, {'$set': {'deleted_at': datetime.utcnow()}}, upsert=True, session=session
+            )
+        return old_order
+    
+    old_order = await run_in_transaction(delete)
+    sales_cube.discard(order_id)
+    await on_order_changed(old_order, None)
+
+async def find_unified_orders(order_id: str, session=None) -> List[Dict]:
+    """
+    An order plus every order linked to it through unified_with, in either
+    direction, oldest first. unified_with holds string ids while _id is an
+    ObjectId, which $graphLookup cannot join, so the graph is walked with one
+    $in query per hop (a single round trip unless unifications chain).
+    """
+    orders: Dict[str, Dict] = {}
+    visited = set()
+    frontier = {order_id}
+    while frontier:
+        visited |= frontier
+        found = await db.orders.find({'$or': [
+            {'_id': {'$in': [ObjectId(i) for i in frontier if ObjectId.is_valid(i)]}},
+            {'unified_with': {'$in': list(frontier)}}
+        ]}, session=session).to_list(None)
+        
+        frontier = set()
+        for order in found:
+            key = str(order['_id'])
+            if key not in orders:
+                orders[key] = order
+                frontier |= {key, *(order.get('unified_with') or [])}
+        frontier -= visited
+    
+    return sorted(orders.values(), key=lambda o: o['created_at'])
+
+def build_bill(order_id: str, orders: List[Dict]) -> Dict:
+    """Combined lines, payments and amounts of a group of unified orders"""
+    lines = {}
+    payments = []
+    summaries = []
+    for order in orders:
+        for product in order['products']:
+            key = (product['product_id'], product['price'], product.get('is_paid', False))
+            line = lines.setdefault(key, {
+                'product_id': product['product_id'], 'name': product['name'], 'category': product['category'],
+                'price': product['price'], 'quantity': 0, 'is_paid': product.get('is_paid', False)
+            })
+            line['quantity'] += product.get('quantity', 1)
+        
+        for payment in order.get('partial_payments') or []:
+            timestamp = payment.get('timestamp')
+            payments.append({
+                **payment,
+                'order_id': str(order['_id']),
+                'timestamp': timestamp.isoformat() if isinstance(timestamp, datetime) else timestamp
+            })
+        
+        summaries.append({
+            '_id': str(order['_id']),
+            'table_number': order['table_number'],
+            'zone': order.get('zone'),
+            'status': order.get('status'),
+            **calculate_order_amounts(order)
+        })
+    
+    for line in lines.values():
+        line['subtotal'] = round(line['price'] * line['quantity'], 2)
+    
+    return {
+        'order_id': order_id,
+        'orders': summaries,
+        'tables': sorted({o['table_number'] for o in summaries}),
+        'lines': sorted(lines.values(), key=lambda l: (l['category'], l['name'], l['is_paid'])),
+        'partial_payments': sorted(payments, key=lambda p: p['timestamp'] or ''),
+        'total': round(sum(o['total'] for o in summaries), 2),
+        'paid_amount': round(sum(o['paid_amount'] for o in summaries), 2),
+        'pending_amount': round(sum(o['pending_amount'] for o in summaries), 2)
+    }
+
+async def apply_bill_payment(order_id: str, payment_dict: Dict) -> tuple:
+    """
+    Spread one payment over the pending orders of a unified group, oldest
+    first, in a single transaction; returns (group, updated orders) (no broadcast)
+    """
+    async def settle(session):
+        orders = await find_unified_orders(order_id, session=session)
+        if not any(str(o['_id']) == order_id for o in orders):
+            raise HTTPException(status_code=404, detail="Order not found")
+        
+        pending = round(sum(calculate_order_amounts(o)['pending_amount'] for o in orders), 2)
+        if payment_dict['amount'] <= 0 or payment_dict['amount'] > pending + 0.005:
+            raise HTTPException(status_code=400, detail=f"Amount must be between 0 and the pending {pending}")
+        
+        remaining = payment_dict['amount']
+        updated = []
+        timestamp = datetime.utcnow()
+        for order in orders:
+            share = round(min(remaining, calculate_order_amounts(order)['pending_amount']), 2)
+            if share <= 0:
+                continue
+            fields = add_payment_to_order(order, {**payment_dict, 'amount': share, 'timestamp': timestamp, 'bill_order_id': order_id})
+            await db.orders.update_one({'_id': order['_id']}, {'$set': fields}, session=session)
+            await db.payments.insert_one(
+                {**payment_entry(order, share, payment_dict['payment_method'], 'bill', timestamp), 'bill_order_id': order_id},
+                session=session
+            )
+            updated.append(order)
+            remaining = round(remaining - share, 2)
+        return orders, updated
+    
+    return await run_in_transaction(settle)
+
+# Se descubre en la primera escritura: un mongod standalone no admite transacciones
+transactions_supported = True
+
+async def run_in_transaction(operation):
+    """Run operation(session) in a transaction; on a standalone mongod (no transactions) run it with session=None"""
+    global transactions_supported
+    if transactions_supported:
+        async with await client.start_session() as session:
+            try:
+                return await session.with_transaction(operation)
+            except OperationFailure as e:
+                if e.code != 20:  # IllegalOperation: sin transacciones en un mongod standalone
+                    raise
+        transactions_supported = False
+        logger.warning("MongoDB has no transactions (standalone); multi-document writes run without one")
+    return await operation(None)
+
+def payment_entry(order: Dict, amount: float, method: str, kind: str, timestamp: datetime) -> Dict:
+    """
+    One document of the append-only payments ledger. `day` is the business day of
+    the order (the day of its created_at, as in the daily stats and closure), not of the payment.
+    """
+    created_at = order.get('created_at')
+    if not isinstance(created_at, datetime):
+        created_at = datetime.fromisoformat(str(created_at)) if created_at else timestamp
+    return {
+        'order_id': str(order['_id']),
+        'table_number': order.get('table_number'),
+        'zone': order.get('zone'),
+        'amount': round(amount, 2),
+        'method': method,
+        'kind': kind,
+        'timestamp': timestamp,
+        'day': created_at.strftime('%Y-%m-%d')
+    }
+
+async def record_settlement(order_id: str, old_order: Optional[Dict], new_order: Optional[Dict], session=None):
+    """
+    Ledger entries for the pending amount collected when an order is delivered
+    (with its payment_method), and their reversal if it stops being delivered or is deleted.
+    If a delivered order's pending amount or method changes, what was settled is
+    reversed and the new amount settled. Partial and bill payments are already
+    in the ledger when they happen.
+    """
+    was_delivered = bool(old_order) and old_order.get('status') == 'entregado'
+    is_delivered = bool(new_order) and new_order.get('status') == 'entregado'
+    if not was_delivered and not is_delivered:
+        return
+    
+    # Lo que debe constar como cobrado al entregar, método a método
+    target: Dict[str, float] = {}
+    if is_delivered and round(new_order.get('pending_amount', 0), 2) > 0:
+        target[new_order.get('payment_method') or 'sin_especificar'] = round(new_order['pending_amount'], 2)
+    
+    settled: Dict[str, float] = {}
+    if was_delivered:
+        async for entry in db.payments.find({'order_id': order_id, 'kind': {'$in': ['settlement', 'settlement_reversal']}},
+                                            {'method': 1, 'amount': 1}, session=session):
+            settled[entry['method']] = settled.get(entry['method'], 0) + entry['amount']
+        settled = {method: round(amount, 2) for method, amount in settled.items() if round(amount, 2) > 0}
+    if settled == target:
+        return
+    
+    now = datetime.utcnow()
+    entries = [
+        payment_entry({**old_order, '_id': order_id}, -amount, method, 'settlement_reversal', now)
+        for method, amount in settled.items()
+    ] + [
+        payment_entry({**(old_order or {}), **new_order, '_id': order_id}, amount, method, 'settlement', now)
+        for method, amount in target.items()
+    ]
+    await db.payments.insert_many(entries, session=session)
+
+async def on_order_changed(old_order: Optional[Dict], new_order: Optional[Dict]):
+    """Keep derived sales data in step with an order write (old/new are None on insert/delete)"""
+    await record_product_sales(old_order, new_order)
+    await record_daily_stats(old_order, new_order)
+    ticket_pipeline.submit(old_order, new_order)
+    
+    if any(o and o.get('status') == 'entregado' for o in (old_order, new_order)):
+        read_cache.invalidate('daily_stats', 'weekly_stats')
+
+def product_sales_lines(order: Optional[Dict]) -> Dict:
+    """Per-(day, product) quantity and revenue an order contributes once delivered"""
+    lines = {}
+    if not order or order.get('status') != 'entregado':
+        return lines
+    
+    created_at = order.get('created_at')
+    if not isinstance(created_at, datetime):
+        created_at = datetime.fromisoformat(str(created_at))
+    day = created_at.strftime('%Y-%m-%d')
+    
+    for product in order.get('products', []):
+        key = (day, product['product_id'])
+        line = lines.setdefault(key, {'name': product['name'], 'category': product['category'], 'quantity': 0, 'revenue': 0.0})
+        line['quantity'] += product.get('quantity', 1)
+        line['revenue'] += product['price'] * product.get('quantity', 1)
+    return lines
+
+def product_sales_changes(old_order: Optional[Dict], new_order: Optional[Dict]) -> List[Dict]:
+    """Counter updates ({'_id', 'inc', 'set'}) that take the per-product daily counters from one version of an order to the next"""
+    old_lines = product_sales_lines(old_order)
+    new_lines = product_sales_lines(new_order)
+    
+    changes = []
+    for key in set(old_lines) | set(new_lines):
+        old_line = old_lines.get(key, {'quantity': 0, 'revenue': 0.0})
+        new_line = new_lines.get(key, {**old_line, 'quantity': 0, 'revenue': 0.0})
+        quantity = new_line['quantity'] - old_line['quantity']
+        revenue = round(new_line['revenue'] - old_line['revenue'], 2)
+        if quantity == 0 and revenue == 0:
+            continue
+        day, product_id = key
+        changes.append({
+            '_id': f"{day}:{product_id}",
+            'inc': {'quantity': quantity, 'revenue': revenue},
+            'set': {'day': day, 'product_id': product_id, 'name': new_line['name'], 'category': new_line['category']}
+        })
+    return changes
+
+async def apply_product_sales_changes(changes: List[Dict]):
+    operations = [UpdateOne({'_id': c['_id']}, {'$inc': c['inc'], '$set': c['set']}, upsert=True) for c in changes]
+    if operations:
+        await db.product_sales_daily.bulk_write(operations, ordered=False)
+
+async def record_product_sales(old_order: Optional[Dict], new_order: Optional[Dict]):
+    """
+    Apply the difference between two versions of an order to the per-product daily counters.
+    While the counters are being rebuilt, the difference goes to a journal instead,
+    for the rebuild to replay it if its snapshot did not see this write.
+    """
+    changes = product_sales_changes(old_order, new_order)
+    if not changes:
+        return
+    
+    rebuild_id = await product_sales_rebuild_flag.get()
+    if rebuild_id:
+        await db.product_sales_journal.insert_one({
+            'rebuild_id': rebuild_id,
+            'order_id': str((new_order or old_order)['_id']),
+            'created': old_order is None,
+            'version': new_order.get('updated_at') if new_order else None,  # None: borrado
+            'changes': changes,
+            'at': datetime.utcnow()
+        })
+        return
+    await apply_product_sales_changes(changes)
+
+# Cada worker relee el estado de la reconstrucción como mucho con esta frecuencia;
+# la reconstrucción espera más que esto tras abrirse y tras cerrarse
+PRODUCT_SALES_STATE_TTL = 1.0
+PRODUCT_SALES_REBUILD_GRACE_SECONDS = 2.0
+# Una reconstrucción más antigua que esto se da por abandonada (worker caído a mitad)
+PRODUCT_SALES_REBUILD_TIMEOUT_SECONDS = 1800
+
+class ProductSalesRebuildFlag:
+    """The id of the running product sales rebuild (or None), cached so order writes don't read it every time"""
+    
+    def __init__(self):
+        self.rebuild_id: Optional[str] = None
+        self.read_at = float('-inf')
+    
+    async def get(self) -> Optional[str]:
+        if time.monotonic() - self.read_at >= PRODUCT_SALES_STATE_TTL:
+            self.read_at = time.monotonic()
+            state = await db.product_sales_state.find_one({
+                '_id': 'rebuild', 'active': True,
+                'started_at': {'$gt': datetime.utcnow() - timedelta(seconds=PRODUCT_SALES_REBUILD_TIMEOUT_SECONDS)}
+            })
+            self.rebuild_id = state['rebuild_id'] if state else None
+        return self.rebuild_id
+    
+    def set(self, rebuild_id: Optional[str]):
+        self.rebuild_id = rebuild_id
+        self.read_at = time.monotonic()
+
+product_sales_rebuild_flag = PerTenant(ProductSalesRebuildFlag)
+
+class ProductSalesRebuild:
+    """
+    Recompute the per-product daily counters from the orders while writes go on.
+    Writers journal their changes instead of applying them while the rebuild is
+    active; the counters are replaced with a snapshot of every order (noting the
+    updated_at it read), and a journaled change is then applied only if the
+    snapshot read that order before the write.
+    """
+    
+    def __init__(self):
+        self.rebuild_id = uuid.uuid4().hex
+        self.versions: Dict[str, Optional[datetime]] = {}
+        self.created: set = set()  # pedidos creados durante la reconstrucción
+    
+    async def run(self) -> int:
+        try:
+            stale = datetime.utcnow() - timedelta(seconds=PRODUCT_SALES_REBUILD_TIMEOUT_SECONDS)
+            await db.product_sales_state.update_one(
+                {'_id': 'rebuild', '$or': [{'active': {'$ne': True}}, {'started_at': {'$lt': stale}}]},
+                {'$set': {'active': True, 'rebuild_id': self.rebuild_id, 'started_at': datetime.utcnow()}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            raise HTTPException(status_code=409, detail="A product sales rebuild is already running")
+        product_sales_rebuild_flag.set(self.rebuild_id)
+        
+        try:
+            # Los demás workers ven la reconstrucción al releer el estado
+            await asyncio.sleep(PRODUCT_SALES_REBUILD_GRACE_SECONDS)
+            counters, count = await self.snapshot()
+            await self.swap(counters)
+            await self.replay()
+        finally:
+            await db.product_sales_state.update_one({'_id': 'rebuild'}, {'$set': {'active': False}})
+            product_sales_rebuild_flag.set(None)
+        # Las escrituras que aún la veían activa quedaron en el diario
+        await asyncio.sleep(PRODUCT_SALES_REBUILD_GRACE_SECONDS)
+        await self.replay()
+        return count
+    
+    async def snapshot(self) -> tuple:
+        """Counters computed from every order as read now, and the number of delivered orders"""
+        counters: Dict[str, Dict] = {}
+        count = 0
+        projection = {'status': 1, 'products': 1, 'created_at': 1, 'updated_at': 1}
+        async for order in db.orders.find({}, projection):
+            self.versions[str(order['_id'])] = order.get('updated_at')
+            for change in product_sales_changes(None, order):
+                counter = counters.setdefault(change['_id'], {'_id': change['_id'], **change['set'], 'quantity': 0, 'revenue': 0.0})
+                counter['quantity'] += change['inc']['quantity']
+                counter['revenue'] = round(counter['revenue'] + change['inc']['revenue'], 2)
+            if order.get('status') == 'entregado':
+                count += 1
+        return counters, count
+    
+    async def swap(self, counters: Dict[str, Dict]):
+        """Replace the counters; nobody else writes them while the rebuild is active"""
+        await db.product_sales_daily.delete_many({})
+        if counters:
+            await db.product_sales_daily.insert_many(list(counters.values()))
+    
+    def applies(self, entry: Dict) -> bool:
+        if entry['order_id'] not in self.versions:
+            # La instantánea no lo vio: o se creó después (cuenta todo) o ya estaba borrado (nada)
+            return entry['order_id'] in self.created
+        seen = self.versions[entry['order_id']]
+        return entry['version'] is None or seen is None or seen < entry['version']
+    
+    async def replay(self):
+        async for entry in db.product_sales_journal.find({'rebuild_id': self.rebuild_id}).sort('at', 1):
+            if entry['created']:
+                self.created.add(entry['order_id'])
+            if self.applies(entry):
+                await apply_product_sales_changes(entry['changes'])
+            await db.product_sales_journal.delete_one({'_id': entry['_id']})
+
+DAILY_STATS_ZONES = ['terraza_exterior', 'salon_interior', 'terraza_interior']
+PAYMENT_METHOD_COUNTERS = {'efectivo': 'cash_sales', 'tarjeta': 'card_sales', 'ambos': 'mixed_sales'}
+
+def daily_stats_contribution(order: Optional[Dict]) -> Dict[str, Dict[str, float]]:
+    """{day: {counter: value}} an order adds to the running stats: delivered and not yet closed, as in get_daily_stats"""
+    if not order or order.get('status') != 'entregado' or order.get('closed_date'):
+        return {}
+    
+    created_at = order.get('created_at')
+    if not isinstance(created_at, datetime):
+        created_at = datetime.fromisoformat(str(created_at))
+    
+    amount = order.get('total', 0)
+    counters = {'total_sales': amount, 'total_orders': 1}
+    if order.get('payment_method') in PAYMENT_METHOD_COUNTERS:
+        counters[PAYMENT_METHOD_COUNTERS[order['payment_method']]] = amount
+    zone = order.get('zone', 'terraza_exterior')
+    if zone in DAILY_STATS_ZONES:
+        counters[f'zone_breakdown.{zone}.sales'] = amount
+        counters[f'zone_breakdown.{zone}.orders'] = 1
+    return {created_at.strftime('%Y-%m-%d'): counters}
+
+async def record_daily_stats(old_order: Optional[Dict], new_order: Optional[Dict]):
+    """
+    Apply the difference between two versions of an order to the running counters
+    of its day and push it as daily_stats_delta: `delta` and the resulting `values`
+    of the counters that changed, keyed like `cash_sales` or `zone_breakdown.<zone>.sales`.
+    Closures and rebuilds push `reset` with the whole `stats` instead.
+    A day without counters yet is first rebuilt from its orders, this one included.
+    """
+    old_days = daily_stats_contribution(old_order)
+    new_days = daily_stats_contribution(new_order)
+    
+    for day in set(old_days) | set(new_days):
+        old_counters, new_counters = old_days.get(day, {}), new_days.get(day, {})
+        delta = {}
+        for field in set(old_counters) | set(new_counters):
+            change = round(new_counters.get(field, 0) - old_counters.get(field, 0), 2)
+            if change:
+                delta[field] = change
+        if not delta:
+            continue
+        
+        # Sin upsert: un documento creado por el $inc solo tendría los pedidos escritos desde entonces
+        stats = await db.daily_stats_live.find_one_and_update(
+            {'_id': day, 'rebuilt': True}, {'$inc': delta}, return_document=ReturnDocument.AFTER
+        )
+        if stats is None:
+            stats = await rebuild_daily_stats(day)
+        values = {}
+        for field in delta:
+            value = stats
+            for part in field.split('.'):
+                # Tras reconstruir, un contador que quedó a cero no está en el documento
+                value = value.get(part, 0) if isinstance(value, dict) else 0
+            values[field] = round(value, 2)
+        await broadcast('daily_stats_delta', {'date': day, 'delta': delta, 'values': values})
+
+def live_daily_stats_view(day: str, stats: Optional[Dict]) -> Dict:
+    """A daily_stats_live document in the shape of GET /daily-stats"""
+    stats = stats or {}
+    zones = stats.get('zone_breakdown', {})
+    return {
+        'date': day,
+        'total_sales': round(stats.get('total_sales', 0), 2),
+        'cash_sales': round(stats.get('cash_sales', 0), 2),
+        'card_sales': round(stats.get('card_sales', 0), 2),
+        'mixed_sales': round(stats.get('mixed_sales', 0), 2),
+        'total_orders': stats.get('total_orders', 0),
+        'zone_breakdown': {
+            zone: {'sales': round(zones.get(zone, {}).get('sales', 0), 2), 'orders': zones.get(zone, {}).get('orders', 0)}
+            for zone in DAILY_STATS_ZONES
+        }
+    }
+
+async def rebuild_daily_stats(day: str) -> Dict:
+    """Recompute one day's running counters from its orders (after a deploy or a manual fix)"""
+    start = datetime.strptime(day, '%Y-%m-%d')
+    counters: Dict[str, float] = {}
+    async for order in db.orders.find({'created_at': {'$gte': start, '$lt': start + timedelta(days=1)}, 'status': 'entregado'}):
+        for field, value in daily_stats_contribution(order).get(day, {}).items():
+            counters[field] = counters.get(field, 0) + value
+    
+    stats: Dict[str, Any] = {'_id': day, 'rebuilt': True}
+    for field, value in counters.items():
+        target = stats
+        *parents, leaf = field.split('.')
+        for part in parents:
+            target = target.setdefault(part, {})
+        target[leaf] = round(value, 2)
+    await db.daily_stats_live.replace_one({'_id': day}, stats, upsert=True)
+    return stats
+
+class SingleFlightCache:
+    """
+    Short-TTL cache for expensive reads. Concurrent identical calls share a
+    single in-flight computation instead of each running their own.
+    """
+    
+    def __init__(self):
+        self._values: Dict[tuple, tuple] = {}  # key -> (expires_at, value)
+        self._inflight: Dict[tuple, asyncio.Task] = {}
+    
+    async def get(self, key: tuple, ttl: float, compute):
+        cached = self._values.get(key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        
+        task = self._inflight.get(key)
+        if task is None:
+            # El cálculo va en su propia tarea: si se cancela la petición que lo lanzó
+            # (cliente desconectado), las demás que lo esperan siguen recibiendo el resultado
+            task = asyncio.ensure_future(self._compute(key, ttl, compute))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())  # nadie esperándolo: sin aviso
+            self._inflight[key] = task
+        return await asyncio.shield(task)
+    
+    async def _compute(self, key: tuple, ttl: float, compute):
+        task = asyncio.current_task()
+        try:
+            value = await compute()
+        finally:
+            # Una invalidación durante el cálculo deja el resultado fuera de la caché
+            detached = self._inflight.get(key) is not task
+            if not detached:
+                del self._inflight[key]
+        if not detached:
+            self._prune_expired()
+            self._values[key] = (time.monotonic() + ttl, value)
+        return value
+    
+    def _prune_expired(self):
+        # Las claves llevan los argumentos (fechas, filtros): sin esto crecen todo el día
+        now = time.monotonic()
+        for key in [k for k, (expires_at, _) in self._values.items() if expires_at <= now]:
+            del self._values[key]
+    
+    def invalidate(self, *namespaces: str):
+        """Drop cached values (and detach in-flight calls) of the given namespaces, or all"""
+        for store in (self._values, self._inflight):
+            for key in list(store):
+                if not namespaces or key[0] in namespaces:
+                    del store[key]
+
+read_cache = PerTenant(SingleFlightCache)
+
+def cached_read(namespace: str, ttl: float = 5.0):
+    """Decorator for read handlers: collapse identical concurrent calls and cache for ttl seconds"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            key = (namespace, args, tuple(sorted(kwargs.items())))
+            return await read_cache.get(key, ttl, lambda: handler(*args, **kwargs))
+        return wrapper
+    return decorator
+
+class Overloaded(Exception):
+    def __init__(self, admission_class: str, retry_after: int):
+        super().__init__(f"{admission_class} is overloaded")
+        self.admission_class = admission_class
+        self.retry_after = retry_after
+
+class AdmissionLimiter:
+    """Concurrency limit for one priority class, with a bounded wait queue and timeout"""
+    
+    def __init__(self, name: str, limit: int, max_waiting: int, timeout: float):
+        self.name = name
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(limit)
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+    
+    @asynccontextmanager
+    async def slot(self):
+        if self._semaphore.locked() and self.waiting >= self.max_waiting:
+            self.rejected += 1
+            raise Overloaded(self.name, max(1, int(self.timeout)))
+        
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise Overloaded(self.name, max(1, int(self.timeout)))
+        finally:
+            self.waiting -= 1
+        
+        self.active += 1
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+    
+    def stats(self) -> Dict:
+        return {
+            'limit': self.limit, 'max_waiting': self.max_waiting, 'timeout': self.timeout,
+            'active': self.active, 'waiting': self.waiting,
+            'admitted': self.admitted, 'rejected': self.rejected
+        }
+
+def admission_limits(name: str, limit: int, max_waiting: int, timeout: float) -> AdmissionLimiter:
+    prefix = f"ADMISSION_{name.upper()}_"
+    return AdmissionLimiter(
+        name,
+        int(os.environ.get(prefix + 'LIMIT', limit)),
+        int(os.environ.get(prefix + 'QUEUE', max_waiting)),
+        float(os.environ.get(prefix + 'TIMEOUT', timeout))
+    )
+
+# Clases de prioridad: los pedidos y pagos tienen un presupuesto amplio; analítica,
+# sincronización y seeds comparten poco para no acaparar el pool de MongoDB
+admission_classes = {
+    'orders': admission_limits('orders', 64, 512, 10.0),
+    'analytics': admission_limits('analytics', 4, 16, 5.0),
+    'sync': admission_limits('sync', 4, 32, 5.0),
+    'seed': admission_limits('seed', 1, 0, 1.0),
+}
+
+def admission(admission_class: str):
+    """Decorator: run the handler inside its priority class's limit; 503 + Retry-After when overloaded"""
+    limiter = admission_classes[admission_class]
+    
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            try:
+                async with limiter.slot():
+                    return await handler(*args, **kwargs)
+            except Overloaded as e:
+                logger.warning("Request rejected by admission control", extra={
+                    'sample': f"admission_{e.admission_class}", 'handler': handler.__name__
+                })
+                raise HTTPException(
+                    status_code=503,
+                    detail=f"Servidor ocupado ({e.admission_class}), reintenta en {e.retry_after}s",
+                    headers={'Retry-After': str(e.retry_after)}
+                )
+        return wrapper
+    return decorator
+
+# Una reserva más antigua sin respuesta se da por abandonada (worker caído a mitad) y se puede retomar
+IDEMPOTENCY_PENDING_SECONDS = float(os.environ.get('IDEMPOTENCY_PENDING_SECONDS', '30'))
+
+class IdempotencyStore:
+    """
+    Stored responses for Idempotency-Key requests: in-memory LRU in front of a TTL
+    collection. A key is claimed with an atomic insert of a pending record before its
+    request runs, so two workers never execute the same key.
+    """
+    
+    def __init__(self, max_entries: int = 2000):
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[str, Any]" = OrderedDict()
+        self._locks: Dict[str, List] = {}  # key -> [lock, holders]
+    
+    @asynccontextmanager
+    async def lock(self, key: str):
+        """Serialize concurrent requests carrying the same key within this worker"""
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._locks.pop(key, None)
+    
+    async def get(self, key: str) -> Optional[Any]:
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        stored = await db.idempotency_keys.find_one({'_id': key})
+        if stored and 'response' in stored:
+            self._remember(key, stored['response'])
+            return stored['response']
+        return None
+    
+    async def claim(self, key: str) -> bool:
+        """Reserve a key for this request; False while another request holds it"""
+        now = datetime.utcnow()
+        try:
+            await db.idempotency_keys.insert_one({'_id': key, 'status': 'pending', 'created_at': now})
+            return True
+        except DuplicateKeyError:
+            pass
+        abandoned = await db.idempotency_keys.find_one_and_update(
+            {'_id': key, 'status': 'pending', 'created_at': {'$lt': now - timedelta(seconds=IDEMPOTENCY_PENDING_SECONDS)}},
+            {'$set': {'created_at': now}}
+        )
+        return abandoned is not None
+    
+    async def release(self, key: str):
+        """Drop a claim whose request failed, so a retry runs it again"""
+        await db.idempotency_keys.delete_one({'_id': key, 'status': 'pending'})
+    
+    async def save(self, key: str, response: Any):
+        await db.idempotency_keys.update_one(
+            {'_id': key},
+            {'$set': {'status': 'done', 'response': response, 'created_at': datetime.utcnow()}},
+            upsert=True
+        )
+        self._remember(key, response)
+    
+    def _remember(self, key: str, response: Any):
+        self._cache[key] = response
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+idempotency_store = PerTenant(IdempotencyStore)
+
+async def run_idempotent(scope: str, idempotency_key: Optional[str], operation):
+    """Run operation() once per key, across workers; repeated requests get the stored response"""
+    if not idempotency_key:
+        return await operation()
+    
+    key = f"{scope}:{idempotency_key}"
+    async with idempotency_store.lock(key):
+        deadline = time.monotonic() + IDEMPOTENCY_PENDING_SECONDS
+        while True:
+            stored = await idempotency_store.get(key)
+            if stored is not None:
+                logger.info("Idempotent replay for %s", key)
+                return stored
+            if await idempotency_store.claim(key):
+                break
+            # Otro worker la está ejecutando: se espera a su respuesta
+            if time.monotonic() > deadline:
+                raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+            await asyncio.sleep(0.1)
+        
+        try:
+            response = await operation()
+        except BaseException:
+            await idempotency_store.release(key)
+            raise
+        await idempotency_store.save(key, response)
+        return response
+
+# ==================== PRODUCT SEARCH ====================
+
+# Los handlers de productos actualizan el índice de su worker; el de otros
+# workers (o tras escrituras externas) se reconstruye pasado este tiempo,
+# salvo con EVENT_BUS=changestream, que los mantiene al día a todos
+PRODUCT_SEARCH_MAX_AGE = float(os.environ.get('PRODUCT_SEARCH_MAX_AGE', '300'))
+
+def fold_text(text: str) -> str:
+    """Lowercase, strip accents and punctuation: 'Café Solo' -> 'cafe solo'"""
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return re.sub(r'[^0-9a-z]+', ' ', stripped.casefold()).strip()
+
+class TrieNode:
+    __slots__ = ('children', 'ids')
+    
+    def __init__(self):
+        self.children: Dict[str, 'TrieNode'] = {}
+        self.ids: set = set()  # productos con alguna palabra que pasa por este nodo
+
+class ProductSearchIndex:
+    """
+    In-memory autocomplete over the catalog: a prefix trie on the accent-folded
+    words of every product name. Each node keeps the ids of the products below
+    it, so a lookup walks len(word) nodes per query word and intersects the sets.
+    """
+    
+    def __init__(self):
+        self.root = TrieNode()
+        self.products: Dict[str, Dict] = {}
+        self.folded: Dict[str, tuple] = {}  # id -> (nombre, categoría) normalizados
+        self.loaded_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+    
+    @property
+    def size(self) -> int:
+        return len(self.products)
+    
+    async def ensure_loaded(self):
+        if self.loaded_at is not None and time.monotonic() - self.loaded_at < PRODUCT_SEARCH_MAX_AGE:
+            return
+        async with self._lock:
+            if self.loaded_at is not None and time.monotonic() - self.loaded_at < PRODUCT_SEARCH_MAX_AGE:
+                return
+            started = time.monotonic()
+            products = await db.products.find().to_list(None)
+            self.replace_all([serialize_doc(p) for p in products])
+            self.loaded_at = started
+    
+    def invalidate(self):
+        """Rebuild from the database on the next search"""
+        self.loaded_at = None
+    
+    def replace_all(self, products: List[Dict]):
+        self.root = TrieNode()
+        self.products = {}
+        self.folded = {}
+        for product in products:
+            self.upsert(product)
+    
+    def upsert(self, product: Dict):
+        product_id = str(product['_id'])
+        self.remove(product_id)
+        name, category = fold_text(product.get('name', '')), fold_text(product.get('category', ''))
+        self.products[product_id] = dict(product, _id=product_id)
+        self.folded[product_id] = (name, category)
+        for word in set(name.split()):
+            node = self.root
+            for char in word:
+                node = node.children.setdefault(char, TrieNode())
+                node.ids.add(product_id)
+    
+    def remove(self, product_id: str):
+        if product_id not in self.products:
+            return
+        name, _ = self.folded.pop(product_id)
+        del self.products[product_id]
+        for word in set(name.split()):
+            node = self.root
+            for char in word:
+                child = node.children.get(char)
+                if child is None:
+                    break
+                child.ids.discard(product_id)
+                if not child.ids:
+                    # Ningún otro producto pasa por aquí: podar la rama entera
+                    del node.children[char]
+                    break
+                node = child
+    
+    def _prefix_ids(self, prefix: str) -> set:
+        node = self.root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return set()
+        return node.ids
+    
+    def search(self, query: str, category: Optional[str] = None, limit: int = 20) -> List[Dict]:
+        """Products whose name has a word starting with each query word, optionally in one category"""
+        folded_query = fold_text(query)
+        words = folded_query.split()
+        if words:
+            sets = sorted((self._prefix_ids(word) for word in words), key=len)
+            ids = set(sets[0]).intersection(*sets[1:])
+        else:
+            ids = set(self.products)
+        if category:
+            folded_category = fold_text(category)
+            ids = {i for i in ids if self.folded[i][1] == folded_category}
+        
+        # Primero los que empiezan por la consulta completa, luego por nombre
+        ranked = sorted(ids, key=lambda i: (not self.folded[i][0].startswith(folded_query), self.folded[i][0]))
+        return [self.products[i] for i in ranked[:limit]]
+
+product_search = PerTenant(ProductSearchIndex)
+
+def index_product_event(event: str, data: Dict):
+    """Apply a product_created/updated/deleted event to the current tenant's search index"""
+    if event == 'product_deleted':
+        product_search.remove(data['product_id'])
+    elif event in ('product_created', 'product_updated'):
+        product_search.upsert(data)
+
+# ==================== CATALOG ====================
+
+CATALOG_IMPORT_MAX_ROWS = int(os.environ.get('CATALOG_IMPORT_MAX_ROWS', '5000'))
+CATALOG_FIELDS = ['name', 'category', 'price']
+
+async def bump_catalog_version() -> int:
+    """Increment and return the catalog version announced with catalog_replaced"""
+    state = await db.catalog_state.find_one_and_update(
+        {'_id': 'catalog'},
+        {'$inc': {'version': 1}, '$set': {'updated_at': datetime.utcnow()}},
+        upsert=True, return_document=ReturnDocument.AFTER
+    )
+    return state['version']
+
+async def get_catalog_version() -> int:
+    state = await db.catalog_state.find_one({'_id': 'catalog'})
+    return state['version'] if state else 0
+
+async def catalog_changed():
+    """After a product or category write: a new catalog version makes every worker rebuild its menu"""
+    await bump_catalog_version()
+    menu_cache.invalidate()
+
+def parse_catalog_file(body: bytes, content_type: str) -> List[Dict]:
+    """Rows of a JSON (list or {"products": [...]}) or CSV (header name,category,price; ',' ';' or tab) catalog"""
+    text = body.decode('utf-8-sig')
+    if 'json' in content_type or text.lstrip().startswith(('[', '{')):
+        data = json.loads(text)
+        rows = data.get('products') if isinstance(data, dict) else data
+        if not isinstance(rows, list):
+            raise ValueError("JSON catalog must be a list of products or {\"products\": [...]}")
+        return rows
+    
+    dialect = csv.Sniffer().sniff(text[:4096], delimiters=',;\t')
+    rows = []
+    for row in csv.DictReader(io.StringIO(text), dialect=dialect):
+        row = {(k or '').strip().lower(): (v or '').strip() for k, v in row.items()}
+        # Hojas de cálculo en español: "3,50"
+        if row.get('price') and '.' not in row['price']:
+            row['price'] = row['price'].replace(',', '.')
+        rows.append(row)
+    return rows
+
+def validate_catalog_rows(rows: List[Any], categories: set) -> tuple:
+    """(products, errors): every row through the Product model, plus unknown categories and duplicates"""
+    products, errors, seen = [], [], {}
+    for number, row in enumerate(rows, start=1):
+        if not isinstance(row, dict):
+            errors.append({'row': number, 'error': "row must be an object"})
+            continue
+        try:
+            product = Product(**{field: row.get(field) for field in CATALOG_FIELDS})
+        except ValidationError as e:
+            errors.append({'row': number, 'error': '; '.join(
+                f"{'.'.join(str(loc) for loc in err['loc'])}: {err['msg']}" for err in e.errors()
+            )})
+            continue
+        key = (product.name, product.category)
+        if not product.name.strip():
+            errors.append({'row': number, 'error': "name is required"})
+        elif product.category not in categories:
+            errors.append({'row': number, 'error': f"unknown category: {product.category}"})
+        elif key in seen:
+            errors.append({'row': number, 'error': f"duplicate of row {seen[key]}"})
+        else:
+            seen[key] = number
+            products.append(product)
+    return products, errors
+
+def catalog_import_operations(products: List[Product], version: int) -> List:
+    """One upsert per product keyed by name+category"""
+    now = datetime.utcnow()
+    return [
+        UpdateOne(
+            {'name': product.name, 'category': product.category},
+            {'$set': {'price': product.price, 'catalog_version': version}, '$setOnInsert': {'created_at': now}},
+            upsert=True
+        )
+        for product in products
+    ]
+
+async def remove_products_missing_from(products: List[Product], version: int) -> int:
+    """
+    Delete every product an import with replace=true leaves out. They are tagged
+    with catalog_removed first: a delete event carries only the _id, so that tag
+    is how the change-stream bus tells these deletes apart from a handler's.
+    """
+    missing = {'$nor': [{'name': p.name, 'category': p.category} for p in products]}
+    await db.products.update_many(missing, {'$set': {'catalog_removed': version}})
+    result = await db.products.delete_many({'catalog_removed': version})
+    return result.deleted_count
+
+async def build_menu() -> Dict:
+    """Categories in creation order, each with its products sorted by name; orphans under uncategorized"""
+    categories = await db.categories.find().sort('_id', 1).to_list(None)
+    products = await db.products.find().to_list(None)
+    
+    by_category: Dict[str, List[Dict]] = {}
+    for product in products:
+        by_category.setdefault(product.get('category'), []).append(serialize_doc(product))
+    
+    def by_name(items):
+        return sorted(items, key=lambda p: fold_text(p.get('name', '')))
+    
+    menu = []
+    for category in categories:
+        category = serialize_doc(category)
+        category['products'] = by_name(by_category.pop(category['name'], []))
+        menu.append(category)
+    return {
+        'version': await get_catalog_version(),
+        'categories': menu,
+        'uncategorized': by_name(p for items in by_category.values() for p in items)
+    }
+
+class MenuCache:
+    """
+    The GET /api/menu payload, built once per catalog change and kept encoded:
+    JSON bytes, their gzip, and an ETag derived from the content. Each request
+    compares the catalog version, which every catalog write bumps, so other
+    workers' changes are seen too; the change stream bus invalidates it for
+    writes made outside the handlers.
+    """
+    
+    def __init__(self):
+        self.body: Optional[bytes] = None
+        self.gzipped: Optional[bytes] = None
+        self.etag: Optional[str] = None
+        self.generation = 0  # sube con cada invalidación
+        self._built_generation = -1
+        self._built_version = -1
+        self._lock = asyncio.Lock()
+    
+    def invalidate(self):
+        self.generation += 1
+    
+    def _fresh(self, version: int) -> bool:
+        return self._built_generation == self.generation and self._built_version == version
+    
+    async def get(self) -> 'MenuCache':
+        version = await get_catalog_version()
+        if self._fresh(version):
+            return self
+        async with self._lock:
+            if not self._fresh(version):
+                # Un cambio durante la construcción obliga a repetirla en la siguiente petición
+                generation = self.generation
+                menu = await build_menu()
+                body = json.dumps(menu, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+                if body != self.body:
+                    self.body = body
+                    self.gzipped = gzip.compress(body)
+                    self.etag = f'"{hashlib.sha1(body).hexdigest()}"'
+                self._built_generation, self._built_version = generation, version
+        return self
+
+menu_cache = PerTenant(MenuCache)
+
+# ==================== KITCHEN TICKETS ====================
+
+# Impresoras por estación, p. ej.:
+# PRINTERS='{"cocina": {"url": "tcp://192.168.1.50:9100", "categories": ["Entrantes", "Comidas", "Carnes", "Pescados", "Postres"]},
+#            "barra": {"url": "tcp://192.168.1.51:9100", "categories": ["Bebidas"]}}'
+# url: tcp://host:puerto (RAW, normalmente 9100), file:///ruta (o /dev/usb/lp0) o memory://nombre;
+# categories: lista o "*"; tenant: restaurante de la estación (por defecto DEFAULT_TENANT)
+PRINTERS = json.loads(os.environ.get('PRINTERS') or '{}')
+TICKET_QUEUE_SIZE = int(os.environ.get('TICKET_QUEUE_SIZE', '1000'))
+TICKET_MAX_ATTEMPTS = int(os.environ.get('TICKET_MAX_ATTEMPTS', '5'))
+TICKET_RETRY_SECONDS = float(os.environ.get('TICKET_RETRY_SECONDS', '0.5'))
+TICKET_WIDTH = int(os.environ.get('TICKET_WIDTH', '42'))  # caracteres por línea (80 mm, fuente A)
+
+class PrinterError(Exception):
+    pass
+
+class NetworkPrinter:
+    """ESC/POS printer listening on a raw TCP port"""
+    
+    def __init__(self, host: str, port: int = 9100, timeout: float = 5.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+    
+    async def send(self, data: bytes):
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise PrinterError(f"{self.host}:{self.port} unreachable: {e!r}")
+        try:
+            writer.write(data)
+            await asyncio.wait_for(writer.drain(), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise PrinterError(f"{self.host}:{self.port} write failed: {e!r}")
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+class FilePrinter:
+    """Appends tickets to a file or a printer device node"""
+    
+    def __init__(self, path: str):
+        self.path = path
+    
+    async def send(self, data: bytes):
+        def write():
+            with open(self.path, 'ab') as f:
+                f.write(data)
+        try:
+            await asyncio.to_thread(write)
+        except OSError as e:
+            raise PrinterError(f"{self.path}: {e!r}")
+
+class MemoryPrinter:
+    """Keeps printed tickets in memory; fail_next makes that many sends fail (for tests)"""
+    
+    def __init__(self):
+        self.tickets: List[bytes] = []
+        self.fail_next = 0
+    
+    async def send(self, data: bytes):
+        if self.fail_next > 0:
+            self.fail_next -= 1
+            raise PrinterError("simulated failure")
+        self.tickets.append(data)
+
+def create_printer(url: str):
+    if url.startswith('tcp://'):
+        host, _, port = url[len('tcp://'):].rstrip('/').partition(':')
+        return NetworkPrinter(host, int(port or 9100))
+    if url.startswith('file://'):
+        return FilePrinter(url[len('file://'):])
+    if url.startswith('memory://'):
+        return MemoryPrinter()
+    raise ValueError(f"Unsupported printer url: {url}")
+
+def ticket_snapshot(order: Optional[Dict]) -> Optional[Dict]:
+    """The fields a ticket needs, copied so later in-place serialization doesn't touch them"""
+    if order is None:
+        return None
+    return {
+        'order_id': str(order.get('_id', '')),
+        'table_number': order.get('table_number'),
+        'zone': order.get('zone'),
+        'waiter_role': order.get('waiter_role'),
+        'created_by': order.get('created_by'),
+        'special_note': order.get('special_note'),
+        'products': [dict(p) for p in order.get('products') or []]
+    }
+
+def ticket_lines(order: Optional[Dict]) -> Dict[tuple, Dict]:
+    lines = {}
+    for product in (order or {}).get('products', []):
+        key = (product['product_id'], product.get('note') or '')
+        line = lines.setdefault(key, {
+            'name': product['name'], 'category': product['category'], 'note': product.get('note'), 'quantity': 0
+        })
+        line['quantity'] += product.get('quantity', 1)
+    return lines
+
+def ticket_changes(old_order: Optional[Dict], new_order: Optional[Dict]) -> tuple:
+    """(kind, lines) to send to the stations: the whole order when new or cancelled, else only what changed"""
+    if old_order is None:
+        return 'nuevo', list(ticket_lines(new_order).values())
+    if new_order is None:
+        return 'anulado', list(ticket_lines(old_order).values())
+    
+    old_lines = ticket_lines(old_order)
+    new_lines = ticket_lines(new_order)
+    changes = []
+    for key in list(old_lines) + [k for k in new_lines if k not in old_lines]:
+        line = new_lines.get(key) or old_lines[key]
+        delta = new_lines.get(key, {}).get('quantity', 0) - old_lines.get(key, {}).get('quantity', 0)
+        if delta:
+            changes.append({**line, 'quantity': delta})
+    return 'modificado', changes
+
+def render_ticket(station: str, ticket: Dict) -> bytes:
+    """ESC/POS byte stream for one station's part of an order event"""
+    def text(value: str) -> bytes:
+        return value.encode('cp1252', errors='replace')
+    
+    rule = text('-' * TICKET_WIDTH + '\n')
+    out = bytearray()
+    out += b'\x1b@'          # inicializar
+    out += b'\x1bt\x10'      # tabla WPC1252 (acentos, ñ, €)
+    out += b'\x1ba\x01'      # centrado
+    out += b'\x1d!\x11'      # doble alto y ancho
+    out += text(f"{station.upper()}\n")
+    if ticket['kind'] != 'nuevo':
+        out += b'\x1bE\x01' + text(f"** {ticket['kind'].upper()} **\n") + b'\x1bE\x00'
+    out += text(f"MESA {ticket['table_number']}\n")
+    out += b'\x1d!\x00'
+    zone = (ticket.get('zone') or '').replace('_', ' ')
+    out += text(f"{zone} - {ticket.get('created_by') or ticket.get('waiter_role') or ''}\n")
+    out += text(ticket['at'].strftime('%d/%m/%Y %H:%M') + '\n')
+    out += b'\x1ba\x00'      # izquierda
+    out += rule
+    
+    for line in ticket['lines']:
+        quantity = f"{line['quantity']:+d}" if ticket['kind'] == 'modificado' else str(line['quantity'])
+        name_lines = textwrap.wrap(line['name'], TICKET_WIDTH - 6) or ['']
+        out += b'\x1d!\x01'  # doble alto
+        out += text(f"{quantity:>3} x {name_lines[0]}\n")
+        for extra in name_lines[1:]:
+            out += text(f"      {extra}\n")
+        out += b'\x1d!\x00'
+        if line.get('note'):
+            for note_line in textwrap.wrap(line['note'], TICKET_WIDTH - 8):
+                out += text(f"      > {note_line}\n")
+    
+    if ticket.get('special_note'):
+        out += rule
+        out += b'\x1bE\x01'
+        for note_line in textwrap.wrap(f"NOTA: {ticket['special_note']}", TICKET_WIDTH):
+            out += text(note_line + '\n')
+        out += b'\x1bE\x00'
+    out += rule
+    out += text(f"Pedido {ticket['order_id'][-6:]}\n")
+    out += b'\x1bd\x04'      # avanzar 4 líneas
+    out += b'\x1dVB\x00'     # corte parcial
+    return bytes(out)
+
+class TicketPipeline:
+    """
+    Order events -> per-station ESC/POS tickets -> printers, off the request
+    path. submit() only enqueues; a dispatcher splits every event by station
+    and each printer has its own worker that renders and sends with retries,
+    so tickets come out in order per printer and a jammed printer doesn't
+    hold up the others.
+    """
+    
+    def __init__(self, stations: Dict[str, Dict], queue_size: int):
+        self.stations: Dict[str, Dict] = {}
+        for name, config in stations.items():
+            categories = config.get('categories', '*')
+            self.stations[name] = {
+                'url': config['url'],
+                'printer': create_printer(config['url']),
+                'categories': None if categories == '*' else set(categories),
+                'tenant': config.get('tenant', DEFAULT_TENANT),
+                'queue': asyncio.Queue(),
+                'metrics': {
+                    'printed': 0, 'failed': 0, 'retries': 0, 'bytes': 0,
+                    'render_ms': 0.0, 'send_ms': 0.0, 'max_send_ms': 0.0, 'latency_ms': 0.0,
+                    'last_error': None, 'last_printed_at': None, 'printed_times': deque(maxlen=1000)
+                }
+            }
+        self.events: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.totals = {'submitted': 0, 'dropped': 0, 'tickets': 0}
+        self.failed: deque = deque(maxlen=100)
+    
+    def submit(self, old_order: Optional[Dict], new_order: Optional[Dict]):
+        """Queue an order change for printing; never blocks the caller"""
+        if not self.stations:
+            return
+        # Pedidos que ya nacen o mueren entregados (sincronización, limpieza) no van a cocina
+        if all(o is None or o.get('status') == 'entregado' for o in (old_order, new_order)):
+            return
+        try:
+            self.events.put_nowait({
+                'tenant': current_tenant.get(),
+                'old': ticket_snapshot(old_order),
+                'new': ticket_snapshot(new_order),
+                'at': datetime.now()
+            })
+            self.totals['submitted'] += 1
+        except asyncio.QueueFull:
+            self.totals['dropped'] += 1
+            logger.error("Ticket queue full; dropping order event")
+    
+    def route(self, event: Dict):
+        kind, lines = ticket_changes(event['old'], event['new'])
+        order = event['new'] or event['old']
+        for station in self.stations.values():
+            if station['tenant'] != event['tenant']:
+                continue
+            station_lines = [l for l in lines if station['categories'] is None or l['category'] in station['categories']]
+            if station_lines:
+                station['queue'].put_nowait({
+                    **order, 'kind': kind, 'lines': station_lines, 'at': event['at'], 'queued_at': time.monotonic()
+                })
+                self.totals['tickets'] += 1
+    
+    async def dispatch(self):
+        while True:
+            event = await self.events.get()
+            try:
+                self.route(event)
+            except Exception as e:
+                logger.error("Ticket dispatch error: %s", e)
+    
+    async def print_loop(self, name: str):
+        station = self.stations[name]
+        while True:
+            ticket = await station['queue'].get()
+            try:
+                start = time.perf_counter()
+                data = render_ticket(name, ticket)
+                station['metrics']['render_ms'] += (time.perf_counter() - start) * 1000
+                await self.deliver(name, ticket, data)
+            except Exception as e:
+                logger.error("Ticket error on %s: %s", name, e)
+    
+    async def deliver(self, name: str, ticket: Dict, data: bytes):
+        """Send one ticket, retrying with backoff; gives up into the failed list"""
+        station = self.stations[name]
+        metrics = station['metrics']
+        for attempt in range(1, TICKET_MAX_ATTEMPTS + 1):
+            start = time.perf_counter()
+            try:
+                await station['printer'].send(data)
+            except Exception as e:
+                metrics['last_error'] = str(e)
+                if attempt == TICKET_MAX_ATTEMPTS:
+                    metrics['failed'] += 1
+                    self.failed.append({'station': name, 'ticket': ticket, 'error': str(e), 'failed_at': datetime.utcnow()})
+                    logger.error("Printer %s failed %s times; ticket for table %s set aside", name, attempt, ticket['table_number'])
+                    return
+                metrics['retries'] += 1
+                await asyncio.sleep(TICKET_RETRY_SECONDS * 2 ** (attempt - 1))
+            else:
+                send_ms = (time.perf_counter() - start) * 1000
+                metrics['printed'] += 1
+                metrics['bytes'] += len(data)
+                metrics['send_ms'] += send_ms
+                metrics['max_send_ms'] = max(metrics['max_send_ms'], send_ms)
+                metrics['latency_ms'] += (time.monotonic() - ticket['queued_at']) * 1000
+                metrics['last_printed_at'] = datetime.utcnow()
+                metrics['printed_times'].append(time.monotonic())
+                return
+    
+    def retry_failed(self) -> int:
+        """Queue the current tenant's set-aside tickets again"""
+        tenant = current_tenant.get()
+        retry = [f for f in self.failed if self.stations[f['station']]['tenant'] == tenant]
+        for failed in retry:
+            self.failed.remove(failed)
+            self.stations[failed['station']]['queue'].put_nowait({**failed['ticket'], 'queued_at': time.monotonic()})
+        return len(retry)
+    
+    def start(self) -> List[asyncio.Task]:
+        if not self.stations:
+            return []
+        return [asyncio.create_task(self.dispatch())] + [asyncio.create_task(self.print_loop(name)) for name in self.stations]
+    
+    def stats(self) -> Dict:
+        tenant = current_tenant.get()
+        now = time.monotonic()
+        stations = {}
+        for name, station in self.stations.items():
+            if station['tenant'] != tenant:
+                continue
+            metrics = station['metrics']
+            printed = metrics['printed'] or 1
+            stations[name] = {
+                'url': station['url'],
+                'categories': sorted(station['categories']) if station['categories'] is not None else '*',
+                'queue_depth': station['queue'].qsize(),
+                'printed': metrics['printed'],
+                'failed': metrics['failed'],
+                'retries': metrics['retries'],
+                'bytes': metrics['bytes'],
+                'per_minute': sum(1 for t in metrics['printed_times'] if now - t <= 60),
+                'avg_render_ms': round(metrics['render_ms'] / printed, 2),
+                'avg_send_ms': round(metrics['send_ms'] / printed, 2),
+                'max_send_ms': round(metrics['max_send_ms'], 2),
+                'avg_latency_ms': round(metrics['latency_ms'] / printed, 2),
+                'last_error': metrics['last_error'],
+                'last_printed_at': metrics['last_printed_at'].isoformat() if metrics['last_printed_at'] else None
+            }
+        return {
+            'enabled': bool(stations),
+            'pending_events': self.events.qsize(),
+            'totals': dict(self.totals),
+            'set_aside': sum(1 for f in self.failed if f['station'] in stations),
+            'stations': stations
+        }
+
+ticket_pipeline = TicketPipeline(PRINTERS, TICKET_QUEUE_SIZE)
+
+# ==================== ANALYTICS ====================
+
+ANALYTICS_REFRESH_SECONDS = float(os.environ.get('ANALYTICS_REFRESH_SECONDS', '30'))
+# Los borrados se anotan en deleted_orders para que el cubo de cada worker los descarte en su refresco
+DELETED_ORDERS_TTL = timedelta(days=7)
+# Filas descartadas a partir de las que se compacta el cubo (si además son la mitad)
+SALES_CUBE_COMPACT_ROWS = 10000
+WEEKDAY_NAMES = ['lunes', 'martes', 'miercoles', 'jueves', 'viernes', 'sabado', 'domingo']
+EPOCH = datetime(1970, 1, 1)
+
+class SalesCube:
+    """
+    Columnar in-memory copy of delivered order lines.
+    One row per product line; categorical columns are stored as integer codes.
+    """
+    
+    CATEGORICAL = ('zone', 'waiter_role', 'category', 'product')
+    DIMENSIONS = ('day', 'weekday', 'hour') + CATEGORICAL
+    
+    def __init__(self, capacity: int = 4096):
+        self._clear(capacity)
+        self.refreshed_at = 0.0
+        self._refresh_lock = asyncio.Lock()
+    
+    def _clear(self, capacity: int = 4096):
+        self.size = 0
+        self.dead = 0  # filas descartadas que siguen ocupando sitio hasta la próxima compactación
+        self.day = np.zeros(capacity, dtype=np.int32)  # días desde 1970-01-01
+        self.hour = np.zeros(capacity, dtype=np.int8)
+        self.codes = {name: np.zeros(capacity, dtype=np.int32) for name in self.CATEGORICAL}
+        self.order = np.zeros(capacity, dtype=np.int32)
+        self.qty = np.zeros(capacity, dtype=np.int32)
+        self.amount = np.zeros(capacity, dtype=np.float64)
+        self.alive = np.zeros(capacity, dtype=bool)
+        
+        self.labels = {name: [] for name in self.CATEGORICAL + ('order',)}
+        self._lookup = {name: {} for name in self.CATEGORICAL + ('order',)}
+        self._rows_by_order: Dict[str, np.ndarray] = {}
+        
+        self.last_seen: Optional[datetime] = None
+        self.deletions_seen: Optional[datetime] = None
+    
+    def _code(self, dimension: str, value) -> int:
+        value = value if value is not None else ''
+        lookup = self._lookup[dimension]
+        if value not in lookup:
+            lookup[value] = len(self.labels[dimension])
+            self.labels[dimension].append(value)
+        return lookup[value]
+    
+    def _grow(self, needed: int):
+        capacity = len(self.day)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name in ('day', 'hour', 'order', 'qty', 'amount', 'alive'):
+            column = getattr(self, name)
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+        for name, column in self.codes.items():
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            self.codes[name] = grown
+    
+    def _coded_column(self, dimension: str) -> np.ndarray:
+        return self.order if dimension == 'order' else self.codes[dimension]
+    
+    def discard(self, order_id: str):
+        """Drop the rows of an order (edited, reopened or deleted)"""
+        rows = self._rows_by_order.pop(order_id, None)
+        if rows is not None:
+            self.alive[rows] = False
+            self.dead += len(rows)
+            if self.dead >= max(SALES_CUBE_COMPACT_ROWS, self.size // 2):
+                self.compact()
+    
+    def compact(self):
+        """Rewrite the columns without dead rows, and the label tables without the labels only they used"""
+        keep = np.flatnonzero(self.alive[:self.size])
+        live = len(keep)
+        position = np.zeros(self.size, dtype=np.int64)
+        position[keep] = np.arange(live)
+        
+        for name in ('day', 'hour', 'order', 'qty', 'amount', 'alive'):
+            column = getattr(self, name)
+            column[:live] = column[keep]
+            column[live:self.size] = 0
+        for column in self.codes.values():
+            column[:live] = column[keep]
+            column[live:self.size] = 0
+        
+        for dimension in self.CATEGORICAL + ('order',):
+            column = self._coded_column(dimension)
+            used, remapped = np.unique(column[:live], return_inverse=True)
+            column[:live] = remapped.reshape(-1)
+            self.labels[dimension] = [self.labels[dimension][code] for code in used]
+            self._lookup[dimension] = {label: code for code, label in enumerate(self.labels[dimension])}
+        
+        self._rows_by_order = {order_id: position[rows] for order_id, rows in self._rows_by_order.items()}
+        self.size = live
+        self.dead = 0
+    
+    def upsert(self, order: Dict):
+        """Replace the rows of an order; non-delivered orders are just dropped"""
+        order_id = str(order['_id'])
+        self.discard(order_id)
+        if order.get('status') != 'entregado' or not order.get('products'):
+            return
+        
+        created_at = order.get('created_at')
+        if not isinstance(created_at, datetime):
+            created_at = datetime.fromisoformat(str(created_at))
+        
+        lines = order['products']
+        start = self.size
+        end = start + len(lines)
+        self._grow(end)
+        
+        self.day[start:end] = (created_at - EPOCH).days
+        self.hour[start:end] = created_at.hour
+        self.order[start:end] = self._code('order', order_id)
+        self.codes['zone'][start:end] = self._code('zone', order.get('zone', 'terraza_exterior'))
+        self.codes['waiter_role'][start:end] = self._code('waiter_role', order.get('waiter_role'))
+        for i, line in enumerate(lines):
+            quantity = line.get('quantity', 1)
+            self.codes['category'][start + i] = self._code('category', line.get('category'))
+            self.codes['product'][start + i] = self._code('product', line.get('name'))
+            self.qty[start + i] = quantity
+            self.amount[start + i] = line.get('price', 0) * quantity
+        self.alive[start:end] = True
+        
+        self.size = end
+        self._rows_by_order[order_id] = np.arange(start, end)
+    
+    async def refresh(self, force: bool = False):
+        """Pull only the orders written since the last refresh"""
+        if not force and time.monotonic() - self.refreshed_at < ANALYTICS_REFRESH_SECONDS:
+            return
+        async with self._refresh_lock:
+            if not force and time.monotonic() - self.refreshed_at < ANALYTICS_REFRESH_SECONDS:
+                return
+            if self.deletions_seen and datetime.utcnow() - self.deletions_seen > DELETED_ORDERS_TTL:
+                # Los borrados anteriores ya caducaron: no se sabe qué quitar, se recarga entero
+                self._clear(len(self.day))
+            # Margen por si el secundario aplica escrituras con updated_at anterior al último visto
+            overlap = timedelta(seconds=ANALYTICS_MAX_STALENESS_SECONDS if ANALYTICS_READ_PREFERENCE != 'primary' else 0)
+            if self.last_seen is None:
+                query = {'status': 'entregado'}
+                self.deletions_seen = datetime.utcnow() - overlap
+            else:
+                query = {'updated_at': {'$gte': self.last_seen - overlap}}
+            projection = {'status': 1, 'zone': 1, 'waiter_role': 1, 'products': 1, 'created_at': 1, 'updated_at': 1}
+            
+            count = 0
+            async for order in analytics_db.orders.find(query, projection).sort('updated_at', 1):
+                self.upsert(order)
+                updated_at = order.get('updated_at')
+                if isinstance(updated_at, datetime) and (self.last_seen is None or updated_at > self.last_seen):
+                    self.last_seen = updated_at
+                count += 1
+            if self.last_seen is None:
+                self.last_seen = datetime.utcnow()
+            
+            # Pedidos borrados (en cualquier worker) desde la última pasada
+            async for deleted in analytics_db.deleted_orders.find({'deleted_at': {'$gte': self.deletions_seen - overlap}}):
+                self.discard(deleted['_id'])
+                if deleted['deleted_at'] > self.deletions_seen:
+                    self.deletions_seen = deleted['deleted_at']
+            
+            self.refreshed_at = time.monotonic()
+            if count:
+                logger.info("Sales cube refreshed: %s orders, %s rows", count, self.size)
+    
+    def _column(self, dimension: str) -> np.ndarray:
+        if dimension == 'day':
+            return self.day[:self.size]
+        if dimension == 'weekday':
+            # 1970-01-01 fue jueves (3)
+            return (self.day[:self.size] + 3) % 7
+        if dimension == 'hour':
+            return self.hour[:self.size]
+        return self.codes[dimension][:self.size]
+    
+    def _label(self, dimension: str, code: int):
+        if dimension == 'day':
+            return (EPOCH + timedelta(days=int(code))).strftime('%Y-%m-%d')
+        if dimension == 'weekday':
+            return WEEKDAY_NAMES[int(code)]
+        if dimension == 'hour':
+            return int(code)
+        return self.labels[dimension][int(code)]
+    
+    def group_by(self, dimensions: List[str], start: Optional[datetime] = None, end: Optional[datetime] = None,
+                 filters: Optional[Dict[str, str]] = None) -> List[Dict]:
+        """Sum qty/amount and count orders for every combination of the given dimensions"""
+        for dimension in dimensions:
+            if dimension not in self.DIMENSIONS:
+                raise ValueError(f"Unknown dimension: {dimension}")
+        
+        mask = self.alive[:self.size].copy()
+        if start is not None:
+            mask &= self.day[:self.size] >= (start - EPOCH).days
+        if end is not None:
+            mask &= self.day[:self.size] <= (end - EPOCH).days
+        for dimension, value in (filters or {}).items():
+            code = self._lookup[dimension].get(value)
+            if code is None:
+                return []
+            mask &= self.codes[dimension][:self.size] == code
+        
+        if not mask.any():
+            return []
+        
+        columns = [self._column(d)[mask].astype(np.int64) for d in dimensions]
+        if columns:
+            stacked = np.stack(columns, axis=1)
+            keys, inverse = np.unique(stacked, axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+        else:
+            keys = np.zeros((1, 0), dtype=np.int64)
+            inverse = np.zeros(int(mask.sum()), dtype=np.int64)
+        
+        groups = len(keys)
+        qty = np.bincount(inverse, weights=self.qty[:self.size][mask], minlength=groups)
+        amount = np.bincount(inverse, weights=self.amount[:self.size][mask], minlength=groups)
+        
+        # Pedidos distintos por grupo
+        pairs = np.unique(np.stack([inverse, self.order[:self.size][mask].astype(np.int64)], axis=1), axis=0)
+        orders = np.bincount(pairs[:, 0], minlength=groups)
+        
+        rows = []
+        for i in np.argsort(-amount, kind='stable'):
+            row = {d: self._label(d, keys[i][j]) for j, d in enumerate(dimensions)}
+            row.update({
+                'quantity': int(qty[i]),
+                'sales': round(float(amount[i]), 2),
+                'orders': int(orders[i])
+            })
+            rows.append(row)
+        return rows
+    
+    def status(self) -> Dict:
+        return {
+            'rows': int(self.size),
+            'live_rows': int(self.alive[:self.size].sum()),
+            'orders': len(self._rows_by_order),
+            'last_seen': self.last_seen.isoformat() if self.last_seen else None
+        }
+
+sales_cube = PerTenant(SalesCube)
+
+# Heatmaps de días anteriores a hoy (ya no cambian), por restaurante: (día, minutos por franja) -> filas
+heatmap_cache = PerTenant(OrderedDict)
+HEATMAP_CACHE_MAX_DAYS = 400
+
+async def compute_heatmap_days(start: datetime, end: datetime, bucket_minutes: int) -> Dict[str, List[Dict]]:
+    """Order count and revenue per (day, zone, time bucket) with one $dateTrunc/$group aggregation"""
+    pipeline = [
+        {'$match': {'status': 'entregado', 'created_at': {'$gte': start, '$lt': end}}},
+        {'$group': {
+            '_id': {
+                'bucket': {'$dateTrunc': {'date': '$created_at', 'unit': 'minute', 'binSize': bucket_minutes}},
+                'zone': {'$ifNull': ['$zone', 'terraza_exterior']}
+            },
+            'orders': {'$sum': 1},
+            'sales': {'$sum': '$total'}
+        }}
+    ]
+    days: Dict[str, List[Dict]] = {}
+    async for row in analytics_db.orders.aggregate(pipeline):
+        bucket = row['_id']['bucket']
+        days.setdefault(bucket.strftime('%Y-%m-%d'), []).append({
+            'zone': row['_id']['zone'],
+            'time': bucket.strftime('%H:%M'),
+            'orders': row['orders'],
+            'sales': round(row['sales'], 2)
+        })
+    return days
+
+
+# ==================== CHANGE STREAM EVENT BUS ====================
+
+# EVENT_BUS=changestream: los eventos de socket salen de los change streams
+# de MongoDB (requiere replica set) en lugar de emitirse en cada handler
+EVENT_BUS_ENABLED = os.environ.get('EVENT_BUS', '').lower() == 'changestream'
+EVENT_BUS_COLLECTIONS = {
+    'orders': ('order', 'order_id'),
+    'products': ('product', 'product_id'),
+    'categories': ('category', 'category_id'),
+    'daily_closures': ('daily_closure', 'closure_id'),
+}
+RESUME_TOKEN_SAVE_SECONDS = 1.0
+# Un token de reanudación por worker (en la base de datos de cada restaurante)
+EVENT_BUS_STATE_ID = f"change_stream:{WORKER_ID}"
+
+async def broadcast(event: str, data: Any, **kwargs):
+    """
+    Emit a state-change event to every client of the current tenant, stamped
+    with its sequence number. Slow consumers get it later, coalesced, through flow_control.
+    """
+    async with event_log.lock:
+        data = event_log.stamp(event, data)
+        await event_log.store(event, data)
+        slow = flow_control.slow_sids()
+        await sio.emit(event, data, skip_sid=slow or None, namespace=tenant_namespace(), **kwargs)
+    for sid in slow:
+        flow_control.defer(sid, event, data)
+
+async def broadcast_change(event: str, data: Any):
+    """Broadcast a write made by a handler, unless the change-stream bus will do it"""
+    if not EVENT_BUS_ENABLED:
+        await broadcast(event, data)
+
+def change_to_event(change: Dict, import_removals: Optional[set] = None) -> Optional[tuple]:
+    """
+    Map a change stream document to (event, payload), or None to skip it.
+    import_removals carries, between calls, the ids of products a catalog import
+    tagged for deletion, so their delete events are skipped as well.
+    """
+    entity, id_field = EVENT_BUS_COLLECTIONS[change['ns']['coll']]
+    operation = change['operationType']
+    
+    if operation == 'delete':
+        if entity == 'daily_closure':
+            return None
+        entity_id = str(change['documentKey']['_id'])
+        if import_removals is not None and entity_id in import_removals:
+            import_removals.discard(entity_id)
+            return None
+        return f"{entity}_deleted", {id_field: entity_id}
+    
+    if entity == 'product' and is_catalog_removal(change):
+        # Marcado por una importación con replace: su delete llega después y también se omite
+        if import_removals is not None:
+            import_removals.add(str(change['documentKey']['_id']))
+        return None
+    
+    doc = change.get('fullDocument')
+    if doc is None:
+        # Borrado antes de poder leerlo (updateLookup); llegará su propio delete
+        return None
+    if entity == 'product' and is_catalog_import(change):
+        # La importación ya avisó con un único catalog_replaced
+        return None
+    if operation == 'insert':
+        return f"{entity}_created", serialize_doc(doc)
+    if entity == 'daily_closure':
+        return None
+    return f"{entity}_updated", serialize_doc(doc)
+
+def is_catalog_removal(change: Dict) -> bool:
+    """A product tagged for deletion by an import with replace=true"""
+    return 'catalog_removed' in change.get('updateDescription', {}).get('updatedFields', {})
+
+def is_catalog_import(change: Dict) -> bool:
+    """Product writes made by a bulk import set catalog_version; handler writes never do"""
+    if change['operationType'] == 'insert':
+        return 'catalog_version' in change['fullDocument']
+    return 'catalog_version' in change.get('updateDescription', {}).get('updatedFields', {})
+
+async def run_change_stream_bus():
+    """
+    Tail change streams on the catalog, orders and closures and turn them into
+    socket events, so writes from scripts, seed endpoints or other workers are
+    broadcast too. Each worker tails its own stream, emits only to its own
+    clients (ignore_queue) and keeps its own resume token, so a stream that
+    fails picks up where it stopped. A worker that restarts gets a new id and
+    starts from now: it has no clients or cached state left to catch up.
+    """
+    pipeline = [{'$match': {
+        'ns.coll': {'$in': list(EVENT_BUS_COLLECTIONS)},
+        'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}
+    }}]
+    import_removals: set = set()
+    
+    while True:
+        state = await db.event_bus_state.find_one({'_id': EVENT_BUS_STATE_ID})
+        resume_token = state.get('resume_token') if state else None
+        last_saved = time.monotonic()
+        try:
+            async with db.watch(pipeline, full_document='updateLookup', resume_after=resume_token) as stream:
+                logger.info("Change stream event bus started for %s (resuming: %s)", current_tenant.get(), resume_token is not None)
+                async for change in stream:
+                    mapped = change_to_event(change, import_removals)
+                    if mapped:
+                        index_product_event(*mapped)
+                        await broadcast(mapped[0], mapped[1], ignore_queue=True)
+                    elif change['ns']['coll'] == 'products':
+                        product_search.invalidate()
+                    if change['ns']['coll'] in ('products', 'categories'):
+                        menu_cache.invalidate()
+                    if change['ns']['coll'] == 'orders' and change['operationType'] == 'delete':
+                        sales_cube.discard(str(change['documentKey']['_id']))
+                    
+                    resume_token = stream.resume_token
+                    if time.monotonic() - last_saved > RESUME_TOKEN_SAVE_SECONDS:
+                        await save_resume_token(resume_token)
+                        last_saved = time.monotonic()
+        except asyncio.CancelledError:
+            if resume_token:
+                await save_resume_token(resume_token)
+            raise
+        except OperationFailure as e:
+            if e.code == 286:  # ChangeStreamHistoryLost: el token ya no está en el oplog
+                logger.error("Change stream resume token lost; restarting from now")
+                await db.event_bus_state.delete_one({'_id': EVENT_BUS_STATE_ID})
+            else:
+                logger.error("Change stream error: %s", e)
+                await asyncio.sleep(1)
+        except Exception as e:
+            logger.error("Change stream error: %s", e)
+            if resume_token:
+                await save_resume_token(resume_token)
+            await asyncio.sleep(1)
+
+async def save_resume_token(resume_token):
+    await db.event_bus_state.update_one(
+        {'_id': EVENT_BUS_STATE_ID},
+        {'$set': {'resume_token': resume_token, 'updated_at': datetime.utcnow()}},
+        upsert=True
+    )
+
+# ==================== PROFILING ====================
+
+PROFILE_MAX_SECONDS = 300
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', '0.005'))
+
+def handler_labels() -> Dict[Any, str]:
+    """Code object of every api_router route and Socket.IO handler -> readable name"""
+    labels = {}
+    for route in api_router.routes:
+        endpoint = inspect.unwrap(route.endpoint)
+        labels[endpoint.__code__] = f"{','.join(sorted(route.methods))} {route.path}"
+    for name, handler in socket_handlers.items():
+        labels[handler.__code__] = f"sio {name}"
+    return labels
+
+def code_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class StackSampler:
+    """
+    Wall-clock sampling profiler for the event loop thread. A helper thread
+    reads the loop thread's current stack every interval; nothing is
+    installed in the loop itself, so there is no cost when it isn't running.
+    """
+    
+    def __init__(self, thread_id: int, seconds: float, interval: float):
+        self.thread_id = thread_id
+        self.seconds = seconds
+        self.interval = interval
+        self.stacks: Dict[tuple, int] = {}  # (código externo, ..., código interno) -> muestras
+        self.handlers: Dict[str, int] = {}
+        self.samples = 0
+        self._labels = handler_labels()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+    
+    def start(self):
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+    
+    @property
+    def running(self) -> bool:
+        return self._thread.is_alive()
+    
+    def _run(self):
+        deadline = time.monotonic() + self.seconds
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self._record(frame)
+            self._stop.wait(self.interval)
+    
+    def _record(self, frame):
+        codes = []
+        handler = None
+        while frame is not None:
+            codes.append(frame.f_code)
+            if frame.f_code in self._labels:
+                handler = self._labels[frame.f_code]  # el más externo gana
+            frame = frame.f_back
+        codes.reverse()
+        
+        innermost = codes[-1]
+        if handler is None:
+            idle = innermost.co_name in ('select', 'poll') and innermost.co_filename.endswith('selectors.py')
+            handler = '(idle)' if idle else '(other)'
+        
+        key = tuple(codes)
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.handlers[handler] = self.handlers.get(handler, 0) + 1
+        self.samples += 1
+    
+    def folded(self) -> str:
+        """Collapsed stacks (flamegraph.pl / speedscope input)"""
+        return ''.join(
+            ';'.join(code_label(c) for c in stack) + f" {count}\n"
+            for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1])
+        )
+    
+    def breakdown(self) -> List[Dict]:
+        return [
+            {'handler': name, 'samples': count, 'percent': round(100 * count / self.samples, 1),
+             'ms': round(count * self.interval * 1000, 1)}
+            for name, count in sorted(self.handlers.items(), key=lambda item: -item[1])
+        ]
+    
+    def pstats_bytes(self) -> bytes:
+        """Samples as a pstats file: tottime = samples as innermost frame, cumtime = samples on the stack"""
+        stats = {}
+        for stack, count in self.stacks.items():
+            seconds = count * self.interval
+            seen = set()
+            for depth, code in enumerate(stack):
+                key = (code.co_filename, code.co_firstlineno, code.co_name)
+                entry = stats.setdefault(key, [0, 0, 0.0, 0.0, {}])
+                if key not in seen:
+                    seen.add(key)
+                    entry[0] += count
+                    entry[1] += count
+                    entry[3] += seconds
+                if depth == len(stack) - 1:
+                    entry[2] += seconds
+                if depth > 0:
+                    caller = stack[depth - 1]
+                    caller_key = (caller.co_filename, caller.co_firstlineno, caller.co_name)
+                    callers = entry[4]
+                    previous = callers.get(caller_key, (0, 0, 0.0, 0.0))
+                    callers[caller_key] = (previous[0] + count, previous[1] + count,
+                                           previous[2] + (seconds if depth == len(stack) - 1 else 0), previous[3] + seconds)
+        return marshal_stats({key: tuple(value) for key, value in stats.items()})
+    
+    def svg(self, width: int = 1200, row: int = 16) -> str:
+        """Self-contained flamegraph (root at the bottom); hover a frame for its sample count"""
+        root = {'children': {}, 'value': 0}
+        for stack, count in self.stacks.items():
+            node = root
+            node['value'] += count
+            for code in stack:
+                node = node['children'].setdefault(code_label(code), {'children': {}, 'value': 0})
+                node['value'] += count
+        
+        depth = max((len(stack) for stack in self.stacks), default=0)
+        height = (depth + 1) * row + 30
+        total = root['value'] or 1
+        rects = []
+        
+        def draw(children, x, level):
+            for name, node in sorted(children.items()):
+                w = node['value'] / total * width
+                if w >= 0.5:
+                    y = height - (level + 1) * row - 10
+                    hue = 10 + (sum(map(ord, name)) % 40)
+                    label = _xml_escape(name)
+                    text = ''
+                    if w > 40:
+                        text = f'<text x="{x + 3:.1f}" y="{y + row - 4}">{_xml_escape(name[:int(w / 7)])}</text>'
+                    rects.append(
+                        f'<g><title>{label} ({node["value"]} muestras, {100 * node["value"] / total:.1f}%)</title>'
+                        f'<rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{row - 1}" fill="hsl({hue},85%,60%)"/>{text}</g>'
+                    )
+                    draw(node['children'], x, level + 1)
+                x += w
+        
+        draw(root['children'], 0.0, 0)
+        return (
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="monospace" font-size="11">'
+            f'<text x="4" y="14">{self.samples} muestras cada {self.interval * 1000:.0f} ms</text>'
+            + ''.join(rects) + '</svg>'
+        )
+
+def _xml_escape(value: str) -> str:
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+def marshal_stats(stats: Dict) -> bytes:
+    """Serialize a pstats-style dict the way Stats.dump_stats does"""
+    return marshal.dumps(stats)
+
+class RouteProfiler:
+    """
+    cProfile around the next K requests of one route. The route's ASGI app is
+    swapped for a wrapper while it runs and restored afterwards, so other
+    routes (and this one once finished) run untouched. Other tasks that run
+    on the loop while a profiled request is in flight show up as well.
+    """
+    
+    def __init__(self, route: APIRoute, requests: int, seconds: float):
+        self.route = route
+        self.remaining = requests
+        self.profile = cProfile.Profile()
+        self.durations: List[float] = []
+        self.active = 0
+        self.finished = False
+        self._original = route.app
+        route.app = self
+        self._timeout = asyncio.get_running_loop().call_later(seconds, self.finish)
+    
+    async def __call__(self, scope, receive, send):
+        if self.finished or self.remaining <= 0:
+            await self._original(scope, receive, send)
+            return
+        self.remaining -= 1
+        if self.active == 0:
+            self.profile.enable()
+        self.active += 1
+        start = time.perf_counter()
+        try:
+            await self._original(scope, receive, send)
+        finally:
+            self.durations.append((time.perf_counter() - start) * 1000)
+            self.active -= 1
+            if self.active == 0:
+                self.profile.disable()
+                if self.remaining <= 0:
+                    self.finish()
+    
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        self._timeout.cancel()
+        if self.route.app is self:
+            self.route.app = self._original
+        if self.active:
+            self.profile.disable()
+    
+    @property
+    def running(self) -> bool:
+        return not self.finished
+    
+    def pstats_bytes(self) -> bytes:
+        self.profile.create_stats()
+        return marshal_stats(self.profile.stats)
+    
+    def text(self, limit: int = 40) -> str:
+        out = io.StringIO()
+        pstats.Stats(self.profile, stream=out).sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+class ProfilingSessions:
+    """At most one profiler running at a time; the last few results kept for download"""
+    
+    def __init__(self, keep: int = 5):
+        self.keep = keep
+        self.sessions: "OrderedDict[str, Dict]" = OrderedDict()
+    
+    def running(self) -> Optional[Dict]:
+        return next((s for s in self.sessions.values() if s['profiler'].running), None)
+    
+    def add(self, kind: str, profiler, **info) -> Dict:
+        session = {'id': uuid.uuid4().hex[:12], 'kind': kind, 'started_at': datetime.utcnow(), 'profiler': profiler, **info}
+        self.sessions[session['id']] = session
+        while len(self.sessions) > self.keep:
+            oldest = next(iter(self.sessions))
+            if self.sessions[oldest]['profiler'].running:
+                break
+            self.sessions.pop(oldest)
+        return session
+    
+    def describe(self, session: Dict) -> Dict:
+        profiler = session['profiler']
+        info = {key: value for key, value in session.items() if key != 'profiler'}
+        info['started_at'] = session['started_at'].isoformat()
+        info['running'] = profiler.running
+        if isinstance(profiler, StackSampler):
+            info['samples'] = profiler.samples
+            info['handlers'] = profiler.breakdown()
+            info['formats'] = ['svg', 'folded', 'pstats']
+        else:
+            durations = sorted(profiler.durations)
+            info['profiled_requests'] = len(durations)
+            info['request_ms'] = {
+                'p50': round(durations[len(durations) // 2], 2) if durations else None,
+                'max': round(durations[-1], 2) if durations else None
+            }
+            info['formats'] = ['pstats', 'text']
+        return info
 
-def calculate_order_amounts(order: Dict) -> Dict:
-    """Calculate total, paid and pending amounts"""
-    total = sum(p['price'] * p['quantity'] for p in order['products'])
-    paid_amount = sum(payment['amount'] for payment in order.get('partial_payments', []))
-    pending_amount = max(0, total - paid_amount)
+profiling = ProfilingSessions()
+
+# ==================== MEMORY ====================
+
+def process_rss_mb() -> Optional[float]:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+def structure_sizes() -> Dict[str, int]:
+    """Entry counts of the server's long-lived in-memory structures, across tenants"""
+    def total(proxy, measure):
+        return sum(measure(instance) for instance in proxy.instances())
     
     return {
-        'total': round(total, 2),
-        'paid_amount': round(paid_amount, 2),
-        'pending_amount': round(pending_amount, 2)
+        'connected_clients': len(connected_clients.local),
+        'socketio_sessions': len(sio.eio.sockets),
+        'flow_control_clients': len(flow_control.clients),
+        'flow_control_pending': sum(len(state['pending']) for state in flow_control.clients.values()),
+        'event_log_entries': total(event_log, lambda log: len(log.buffer)),
+        'read_cache_entries': total(read_cache, lambda cache: len(cache._values)),
+        'read_cache_inflight': total(read_cache, lambda cache: len(cache._inflight)),
+        'idempotency_cache': total(idempotency_store, lambda store: len(store._cache)),
+        'idempotency_locks': total(idempotency_store, lambda store: len(store._locks)),
+        'heatmap_cache_days': total(heatmap_cache, len),
+        'product_search_products': total(product_search, lambda index: index.size),
+        'menu_cache_bytes': total(menu_cache, lambda menu: len(menu.body or b'')),
+        'sales_cube_rows': total(sales_cube, lambda cube: cube.size),
+        'ticket_events_queued': ticket_pipeline.events.qsize(),
+        'tickets_queued': sum(station['queue'].qsize() for station in ticket_pipeline.stations.values()),
+        'tickets_set_aside': len(ticket_pipeline.failed),
+        'profiling_sessions': len(profiling.sessions),
+        'asyncio_tasks': len(asyncio.all_tasks()),
     }
 
+class MemoryTracker:
+    """
+    tracemalloc snapshots diffed against a baseline, with every growing
+    allocation pinned to the innermost line of this file that led to it,
+    plus live object counts by type. tracemalloc only runs while started.
+    """
+    
+    def __init__(self):
+        self.baseline: Optional[tracemalloc.Snapshot] = None
+        self.baseline_at: Optional[datetime] = None
+        self.last_counts: Dict[str, int] = {}
+    
+    def start(self, frames: int):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        tracemalloc.start(frames)
+        self.reset_baseline()
+    
+    def stop(self):
+        tracemalloc.stop()
+        self.baseline = None
+        self.baseline_at = None
+    
+    def reset_baseline(self):
+        self.baseline = self._snapshot()
+        self.baseline_at = datetime.utcnow()
+    
+    @staticmethod
+    def _snapshot() -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ))
+    
+    def diff(self, limit: int, reset: bool) -> Dict:
+        snapshot = self._snapshot()
+        stats = snapshot.compare_to(self.baseline, 'traceback')
+        
+        by_line: Dict[str, Dict] = {}
+        for stat in stats:
+            if stat.size_diff == 0:
+                continue
+            frame = next((f for f in reversed(stat.traceback) if f.filename == __file__), None)
+            where = f"server.py:{frame.lineno}" if frame else f"{stat.traceback[-1].filename}:{stat.traceback[-1].lineno}"
+            entry = by_line.setdefault(where, {'where': where, 'size_diff_kb': 0.0, 'size_kb': 0.0, 'count_diff': 0, 'count': 0})
+            entry['size_diff_kb'] += stat.size_diff / 1024
+            entry['size_kb'] += stat.size / 1024
+            entry['count_diff'] += stat.count_diff
+            entry['count'] += stat.count
+        
+        top = sorted(by_line.values(), key=lambda e: -e['size_diff_kb'])[:limit]
+        for entry in top:
+            entry['size_diff_kb'] = round(entry['size_diff_kb'], 1)
+            entry['size_kb'] = round(entry['size_kb'], 1)
+            if entry['where'].startswith('server.py:'):
+                line_number = int(entry['where'].split(':')[1])
+                entry['source'] = linecache.getline(__file__, line_number).strip()
+        
+        result = {
+            'since': self.baseline_at.isoformat(),
+            'total_diff_kb': round(sum(stat.size_diff for stat in stats) / 1024, 1),
+            'top': top,
+            'largest_tracebacks': [
+                {'size_diff_kb': round(stat.size_diff / 1024, 1), 'count_diff': stat.count_diff,
+                 'traceback': stat.traceback.format(limit=8)}
+                for stat in stats[:min(limit, 5)] if stat.size_diff > 0
+            ]
+        }
+        if reset:
+            self.baseline = snapshot
+            self.baseline_at = datetime.utcnow()
+        return result
+    
+    def object_counts(self, limit: int) -> List[Dict]:
+        """Live objects by type, with the change since the previous call"""
+        counts = Counter(type(o).__qualname__ for o in gc.get_objects())
+        result = [
+            {'type': name, 'count': count, 'diff': count - self.last_counts.get(name, 0)}
+            for name, count in counts.most_common(limit)
+        ]
+        self.last_counts = dict(counts)
+        return result
+
+memory_tracker = MemoryTracker()
+
 # ==================== API ROUTES ====================
 
 @api_router.get("/")
@@ -280,7 +3250,7 @@ async def get_categories():
         categories = await db.categories.find().to_list(1000)
         return [serialize_doc(c) for c in categories]
     except Exception as e:
-        logger.error(f"Error fetching categories: {str(e)}")
+        logger.error("Error fetching categories: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.post("/categories")
@@ -290,11 +3260,12 @@ async def create_category(category: Category):
         result = await db.categories.insert_one(category_dict)
         category_dict['_id'] = str(result.inserted_id)
         
-        await sio.emit('category_created', serialize_doc(category_dict))
+        await catalog_changed()
+        await broadcast_change('category_created', serialize_doc(category_dict))
         
         return serialize_doc(category_dict)
     except Exception as e:
-        logger.error(f"Error creating category: {str(e)}")
+        logger.error("Error creating category: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.put("/categories/{category_id}")
@@ -307,23 +3278,25 @@ async def update_category(category_id: str, category: Category):
         )
         category_dict['_id'] = category_id
         
-        await sio.emit('category_updated', serialize_doc(category_dict))
+        await catalog_changed()
+        await broadcast_change('category_updated', serialize_doc(category_dict))
         
         return serialize_doc(category_dict)
     except Exception as e:
-        logger.error(f"Error updating category: {str(e)}")
+        logger.error("Error updating category: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.delete("/categories/{category_id}")
 async def delete_category(category_id: str):
     try:
         await db.categories.delete_one({"_id": ObjectId(category_id)})
+        await catalog_changed()
         
-        await sio.emit('category_deleted', {'category_id': category_id})
+        await broadcast_change('category_deleted', {'category_id': category_id})
         
         return {"success": True}
     except Exception as e:
-        logger.error(f"Error deleting category: {str(e)}")
+        logger.error("Error deleting category: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 # ===== PRODUCTS =====
@@ -334,7 +3307,17 @@ async def get_products():
         products = await db.products.find().to_list(1000)
         return [serialize_doc(p) for p in products]
     except Exception as e:
-        logger.error(f"Error fetching products: {str(e)}")
+        logger.error("Error fetching products: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/products/search")
+async def search_products(q: str = "", category: Optional[str] = None, limit: int = Query(20, ge=1, le=200)):
+    """Autocompletado de productos sin distinguir mayúsculas ni acentos ("cafe" encuentra "Café Solo")"""
+    try:
+        await product_search.ensure_loaded()
+        return product_search.search(q, category, limit)
+    except Exception as e:
+        logger.error("Error searching products: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.post("/products")
@@ -344,11 +3327,13 @@ async def create_product(product: Product):
         result = await db.products.insert_one(product_dict)
         product_dict['_id'] = str(result.inserted_id)
         
-        await sio.emit('product_created', serialize_doc(product_dict))
+        product_search.upsert(serialize_doc(product_dict))
+        await catalog_changed()
+        await broadcast_change('product_created', serialize_doc(product_dict))
         
         return serialize_doc(product_dict)
     except Exception as e:
-        logger.error(f"Error creating product: {str(e)}")
+        logger.error("Error creating product: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.put("/products/{product_id}")
@@ -361,23 +3346,135 @@ async def update_product(product_id: str, product: Product):
         )
         product_dict['_id'] = product_id
         
-        await sio.emit('product_updated', serialize_doc(product_dict))
+        product_search.upsert(serialize_doc(product_dict))
+        await catalog_changed()
+        await broadcast_change('product_updated', serialize_doc(product_dict))
         
         return serialize_doc(product_dict)
     except Exception as e:
-        logger.error(f"Error updating product: {str(e)}")
+        logger.error("Error updating product: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.delete("/products/{product_id}")
 async def delete_product(product_id: str):
     try:
         await db.products.delete_one({"_id": ObjectId(product_id)})
+        product_search.remove(product_id)
+        await catalog_changed()
         
-        await sio.emit('product_deleted', {'product_id': product_id})
+        await broadcast_change('product_deleted', {'product_id': product_id})
         
         return {"success": True}
     except Exception as e:
-        logger.error(f"Error deleting product: {str(e)}")
+        logger.error("Error deleting product: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/products/import")
+@admission('seed')
+async def import_products(request: Request, replace: bool = False):
+    """
+    Importación masiva del catálogo (CSV o JSON). Se validan todas las filas y, solo
+    si no hay errores, se aplican en un único bulk_write con upserts por nombre+categoría;
+    con replace=true se borran además los productos que no vengan en el fichero.
+    Los dispositivos reciben un solo catalog_replaced con la nueva versión del catálogo.
+    """
+    try:
+        try:
+            rows = parse_catalog_file(await request.body(), request.headers.get('content-type', ''))
+        except (ValueError, csv.Error) as e:
+            raise HTTPException(status_code=400, detail=f"Unreadable catalog: {str(e)}")
+        if not rows:
+            raise HTTPException(status_code=400, detail="Empty catalog")
+        if len(rows) > CATALOG_IMPORT_MAX_ROWS:
+            raise HTTPException(status_code=413, detail=f"Catalog too large: {len(rows)} rows (max {CATALOG_IMPORT_MAX_ROWS})")
+        
+        categories = {c['name'] for c in await db.categories.find({}, {'name': 1}).to_list(None)}
+        products, errors = validate_catalog_rows(rows, categories)
+        if errors:
+            raise HTTPException(status_code=422, detail={
+                'message': f"{len(errors)} invalid rows; nothing was imported",
+                'errors': errors[:100]
+            })
+        
+        version = await bump_catalog_version()
+        result = await db.products.bulk_write(catalog_import_operations(products, version), ordered=False)
+        deleted = await remove_products_missing_from(products, version) if replace else 0
+        product_search.invalidate()
+        menu_cache.invalidate()
+        
+        summary = {
+            'version': version,
+            'products': len(products),
+            'inserted': result.upserted_count,
+            'updated': result.modified_count,
+            'deleted': deleted
+        }
+        # Directo, también con EVENT_BUS: el bus omite las escrituras de la importación
+        await broadcast('catalog_replaced', summary)
+        return summary
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error importing products: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/products/export")
+async def export_products(format: str = "csv"):
+    """Exportación del catálogo en streaming (CSV o JSON), en el formato que acepta /products/import"""
+    if format not in ('csv', 'json'):
+        raise HTTPException(status_code=400, detail="format must be csv or json")
+    try:
+        version = await get_catalog_version()
+        cursor = db.products.find({}, {'_id': 0, 'name': 1, 'category': 1, 'price': 1}).sort([('category', 1), ('name', 1)])
+        
+        async def csv_chunks():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(CATALOG_FIELDS)
+            async for product in cursor:
+                writer.writerow([product.get(field) for field in CATALOG_FIELDS])
+                if buffer.tell() > 64 * 1024:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+        
+        async def json_chunks():
+            yield '{"version": %d, "products": [' % version
+            separator = ''
+            async for product in cursor:
+                yield separator + json.dumps({field: product.get(field) for field in CATALOG_FIELDS}, ensure_ascii=False)
+                separator = ',\n'
+            yield ']}'
+        
+        return StreamingResponse(
+            csv_chunks() if format == 'csv' else json_chunks(),
+            media_type='text/csv; charset=utf-8' if format == 'csv' else 'application/json',
+            headers={
+                'Content-Disposition': f'attachment; filename="catalogo-v{version}.{format}"',
+                'X-Catalog-Version': str(version)
+            }
+        )
+    except Exception as e:
+        logger.error("Error exporting products: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ===== MENU =====
+
+@api_router.get("/menu")
+async def get_menu(if_none_match: Optional[str] = Header(None, alias="If-None-Match"),
+                   accept_encoding: Optional[str] = Header(None, alias="Accept-Encoding")):
+    """Carta completa (categorías con sus productos) en una sola respuesta ya codificada; 304 si no ha cambiado"""
+    try:
+        menu = await menu_cache.get()
+        headers = {'ETag': menu.etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+        if if_none_match and menu.etag in [tag.strip() for tag in if_none_match.split(',')]:
+            return Response(status_code=304, headers=headers)
+        if 'gzip' in (accept_encoding or ''):
+            return Response(menu.gzipped, media_type='application/json', headers={**headers, 'Content-Encoding': 'gzip'})
+        return Response(menu.body, media_type='application/json', headers=headers)
+    except Exception as e:
+        logger.error("Error fetching menu: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 # ===== ORDERS =====
@@ -392,7 +3489,7 @@ async def get_orders(zone: Optional[str] = None):
         orders = await db.orders.find(query).sort('created_at', -1).to_list(1000)
         return [serialize_doc(o) for o in orders]
     except Exception as e:
-        logger.error(f"Error fetching orders: {str(e)}")
+        logger.error("Error fetching orders: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.get("/orders/{order_id}")
@@ -403,128 +3500,312 @@ async def get_order(order_id: str):
             raise HTTPException(status_code=404, detail="Order not found")
         return serialize_doc(order)
     except Exception as e:
-        logger.error(f"Error fetching order: {str(e)}")
+        logger.error("Error fetching order: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.post("/orders")
-async def create_order(order: Order):
-    try:
+@admission('orders')
+async def create_order(order: Order, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    async def create():
         order_dict = order.model_dump(by_alias=True, exclude=['id'])
-        order_dict['created_at'] = datetime.utcnow()
-        order_dict['updated_at'] = datetime.utcnow()
-        
-        # Set original_price for all products
-        for product in order_dict['products']:
-            if 'original_price' not in product:
-                product['original_price'] = product['price']
-            if 'is_paid' not in product:
-                product['is_paid'] = False
-        
-        # Calculate amounts
-        amounts = calculate_order_amounts(order_dict)
-        order_dict.update(amounts)
+        order_dict = await insert_order(order_dict)
         
-        # Find similar orders
-        similar_orders = await find_similar_orders(order_dict)
-        if similar_orders:
-            order_dict['unified_with'] = [str(o['_id']) for o in similar_orders]
-        
-        result = await db.orders.insert_one(order_dict)
-        order_dict['_id'] = str(result.inserted_id)
-        
-        await sio.emit('order_created', serialize_doc(order_dict))
+        await broadcast_change('order_created', serialize_doc(order_dict))
         
         return serialize_doc(order_dict)
+    
+    try:
+        return await run_idempotent('create_order', idempotency_key, create)
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error creating order: {str(e)}")
+        logger.error("Error creating order: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.put("/orders/{order_id}")
-async def update_order(order_id: str, order: Order):
-    try:
+@admission('orders')
+async def update_order(order_id: str, order: Order, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    async def update():
         order_dict = order.model_dump(by_alias=True, exclude=['id'])
-        order_dict['updated_at'] = datetime.utcnow()
-        
-        # Recalculate amounts
-        amounts = calculate_order_amounts(order_dict)
-        order_dict.update(amounts)
-        
-        old_order = await db.orders.find_one({"_id": ObjectId(order_id)})
-        
-        await db.orders.update_one(
-            {"_id": ObjectId(order_id)},
-            {"$set": order_dict}
-        )
-        order_dict['_id'] = order_id
+        order_dict, became_ready = await apply_order_update(order_id, order_dict)
         
         # Send notification if status changed to listo
-        if old_order and old_order.get('status') != 'listo' and order_dict.get('status') == 'listo':
+        if became_ready:
             waiter_role = order_dict.get('waiter_role')
             await send_notification(waiter_role, order_id, f"Pedido mesa {order_dict['table_number']} listo")
         
-        await sio.emit('order_updated', serialize_doc(order_dict))
+        await broadcast_change('order_updated', serialize_doc(order_dict))
         
         return serialize_doc(order_dict)
+    
+    try:
+        return await run_idempotent(f'update_order:{order_id}', idempotency_key, update)
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error updating order: {str(e)}")
+        logger.error("Error updating order: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.post("/orders/{order_id}/partial-payment")
-async def add_partial_payment(order_id: str, payment: PartialPayment):
-    try:
-        order = await db.orders.find_one({"_id": ObjectId(order_id)})
-        if not order:
+@admission('orders')
+async def add_partial_payment(order_id: str, payment: PartialPayment, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    async def pay():
+        updated_order = await apply_partial_payment(order_id, payment.model_dump())
+        if not updated_order:
             raise HTTPException(status_code=404, detail="Order not found")
         
-        payment_dict = payment.model_dump()
-        payment_dict['timestamp'] = datetime.utcnow()
+        await broadcast_change('order_updated', serialize_doc(updated_order))
         
-        # Mark products as paid
-        for product in order['products']:
-            if product['product_id'] in payment_dict['paid_products']:
-                product['is_paid'] = True
+        return serialize_doc(updated_order)
+    
+    try:
+        return await run_idempotent(f'partial_payment:{order_id}', idempotency_key, pay)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error adding partial payment: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.delete("/orders/{order_id}")
+@admission('orders')
+async def delete_order(order_id: str):
+    try:
+        await remove_order(order_id)
         
-        order['partial_payments'].append(payment_dict)
+        await broadcast_change('order_deleted', {'order_id': order_id})
         
-        # Recalculate amounts
-        amounts = calculate_order_amounts(order)
-        order.update(amounts)
+        return {"success": True}
+    except Exception as e:
+        logger.error("Error deleting order: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ===== UNIFIED BILLS =====
+
+@api_router.get("/orders/{order_id}/bill")
+@admission('orders')
+async def get_unified_bill(order_id: str):
+    """Cuenta conjunta de un pedido y de todos los pedidos unificados con él"""
+    try:
+        orders = await find_unified_orders(order_id)
+        if not any(str(o['_id']) == order_id for o in orders):
+            raise HTTPException(status_code=404, detail="Order not found")
+        return build_bill(order_id, orders)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error building unified bill: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.post("/orders/{order_id}/bill")
+@admission('orders')
+async def pay_unified_bill(order_id: str, payment: PartialPayment, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    """Cobra un pago sobre la cuenta conjunta, repartido entre los pedidos pendientes (del más antiguo al más nuevo)"""
+    async def pay():
+        orders, updated = await apply_bill_payment(order_id, payment.model_dump())
+        bill = build_bill(order_id, orders)
         
-        await db.orders.update_one(
-            {"_id": ObjectId(order_id)},
-            {"$set": {
-                "products": order['products'],
-                "partial_payments": order['partial_payments'],
-                "paid_amount": order['paid_amount'],
-                "pending_amount": order['pending_amount'],
-                "updated_at": datetime.utcnow()
-            }}
-        )
+        for order in updated:
+            await broadcast_change('order_updated', serialize_doc(order))
+        
+        return bill
+    
+    try:
+        return await run_idempotent(f'bill_payment:{order_id}', idempotency_key, pay)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error paying unified bill: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ===== PAYMENTS =====
+
+@api_router.get("/payments/totals")
+@admission('analytics')
+async def get_payment_totals(date_from: Optional[str] = Query(None, alias="from"),
+                             date_to: Optional[str] = Query(None, alias="to"),
+                             by_day: bool = False):
+    """
+    Cobrado por método de pago entre dos días de negocio (YYYY-MM-DD, por defecto hoy),
+    desde el libro de pagos: una agregación cubierta por el índice (day, method, amount).
+    """
+    try:
+        today = datetime.utcnow().strftime('%Y-%m-%d')
+        start_day = datetime.fromisoformat(date_from).strftime('%Y-%m-%d') if date_from else today
+        end_day = datetime.fromisoformat(date_to).strftime('%Y-%m-%d') if date_to else today
         
-        updated_order = await db.orders.find_one({"_id": ObjectId(order_id)})
+        rows = await analytics_db.payments.aggregate([
+            {'$match': {'day': {'$gte': start_day, '$lte': end_day}}},
+            {'$project': {'_id': 0, 'day': 1, 'method': 1, 'amount': 1}},
+            {'$group': {'_id': {'day': '$day', 'method': '$method'}, 'amount': {'$sum': '$amount'}, 'payments': {'$sum': 1}}},
+            {'$sort': {'_id.day': 1, '_id.method': 1}}
+        ]).to_list(None)
         
-        await sio.emit('order_updated', serialize_doc(updated_order))
+        methods: Dict[str, Dict] = {}
+        days: Dict[str, Dict] = {}
+        for row in rows:
+            day, method = row['_id']['day'], row['_id']['method']
+            for totals in (methods.setdefault(method, {'amount': 0.0, 'payments': 0}),
+                           days.setdefault(day, {}).setdefault(method, {'amount': 0.0, 'payments': 0})):
+                totals['amount'] = round(totals['amount'] + row['amount'], 2)
+                totals['payments'] += row['payments']
         
-        return serialize_doc(updated_order)
+        result = {
+            'from': start_day,
+            'to': end_day,
+            'total': round(sum(row['amount'] for row in rows), 2),
+            'methods': methods
+        }
+        if by_day:
+            result['days'] = days
+        return result
     except Exception as e:
-        logger.error(f"Error adding partial payment: {str(e)}")
+        logger.error("Error getting payment totals: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
-@api_router.delete("/orders/{order_id}")
-async def delete_order(order_id: str):
+@api_router.get("/orders/{order_id}/payments")
+async def get_order_payments(order_id: str):
+    """Movimientos del libro de pagos de un pedido, en orden"""
+    try:
+        payments = await db.payments.find({'order_id': order_id}).sort('timestamp', 1).to_list(None)
+        for payment in payments:
+            payment['_id'] = str(payment['_id'])
+            payment['timestamp'] = payment['timestamp'].isoformat()
+        return payments
+    except Exception as e:
+        logger.error("Error fetching order payments: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ===== OFFLINE SYNC =====
+
+SYNC_OP_TYPES = ('create_order', 'update_order', 'partial_payment', 'delete_order')
+
+def sync_op_scope(op_type: str, order_id: str) -> Optional[str]:
+    """
+    Idempotency scope of the endpoint doing the same write online. The app queues a
+    write that failed with the Idempotency-Key it already sent as the op_id, so an
+    attempt that did reach the server is found here instead of being applied twice.
+    """
+    if op_type == 'create_order':
+        return 'create_order'
+    if op_type in ('update_order', 'partial_payment'):
+        return f'{op_type}:{order_id}'
+    return None
+
+@api_router.post("/sync/batch")
+@admission('sync')
+async def sync_batch(batch: SyncBatch):
+    """
+    Reproduce en una sola llamada la cola de operaciones offline de un dispositivo.
+    Las operaciones se aplican en orden; las que ya se aplicaron (mismo op_id)
+    devuelven el resultado guardado sin volver a ejecutarse.
+    """
     try:
-        await db.orders.delete_one({"_id": ObjectId(order_id)})
+        op_ids = [op.op_id for op in batch.operations]
+        applied = await db.sync_ops.find({'_id': {'$in': op_ids}}).to_list(None)
+        applied_by_id = {a['_id']: a for a in applied}
         
-        await sio.emit('order_deleted', {'order_id': order_id})
+        # Ids locales (creados offline) -> ids reales de MongoDB
+        id_map = {a['local_id']: a['order_id'] for a in applied if a.get('local_id') and a.get('order_id')}
         
-        return {"success": True}
+        results = []
+        changed_orders = {}
+        deleted_order_ids = []
+        ready_orders = []
+        
+        for op in batch.operations:
+            if op.op_id in applied_by_id:
+                results.append({'op_id': op.op_id, 'status': 'duplicate', 'order_id': applied_by_id[op.op_id].get('order_id')})
+                continue
+            
+            if op.type not in SYNC_OP_TYPES:
+                results.append({'op_id': op.op_id, 'status': 'error', 'error': f"Unknown operation type: {op.type}"})
+                continue
+            
+            order_id = id_map.get(op.order_id, op.order_id)
+            marker = {
+                '_id': op.op_id,
+                'type': op.type,
+                'order_id': None if op.type == 'create_order' else order_id,
+                'local_id': op.order_id if op.type == 'create_order' else None,
+                'client_id': batch.client_id,
+                'applied_at': datetime.utcnow()
+            }
+            try:
+                # Se reclama el op_id antes de aplicarlo: repetido en este lote o en otro simultáneo, no se ejecuta dos veces
+                await db.sync_ops.insert_one(marker)
+            except DuplicateKeyError:
+                existing = await db.sync_ops.find_one({'_id': op.op_id}) or {}
+                results.append({'op_id': op.op_id, 'status': 'duplicate', 'order_id': existing.get('order_id')})
+                continue
+            applied_by_id[op.op_id] = marker
+            
+            applied_here = []
+            
+            async def apply():
+                applied_here.append(True)
+                if op.type == 'create_order':
+                    order_dict = Order(**(op.data or {})).model_dump(by_alias=True, exclude=['id'])
+                    order_dict = await insert_order(order_dict)
+                elif op.type == 'update_order':
+                    order_dict = Order(**(op.data or {})).model_dump(by_alias=True, exclude=['id'])
+                    order_dict, became_ready = await apply_order_update(order_id, order_dict)
+                    if became_ready:
+                        ready_orders.append(order_dict)
+                elif op.type == 'partial_payment':
+                    payment_dict = PartialPayment(**(op.data or {})).model_dump()
+                    order_dict = await apply_partial_payment(order_id, payment_dict)
+                    if not order_dict:
+                        raise ValueError("Order not found")
+                else:
+                    await remove_order(order_id)
+                    changed_orders.pop(order_id, None)
+                    deleted_order_ids.append(order_id)
+                    return None
+                changed_orders[str(order_dict['_id'])] = order_dict
+                return serialize_doc(order_dict)
+            
+            try:
+                scope = sync_op_scope(op.type, order_id)
+                response = await run_idempotent(scope, op.op_id, apply) if scope else await apply()
+                if op.type == 'create_order':
+                    order_id = response['_id']
+                    if op.order_id:
+                        id_map[op.order_id] = order_id
+                    marker['order_id'] = order_id
+                    await db.sync_ops.update_one({'_id': op.op_id}, {'$set': {'order_id': order_id}})
+            except Exception as e:
+                logger.error("Sync op %s (%s) failed: %s", op.op_id, op.type, e)
+                # Sin aplicar: se libera el op_id para que el cliente pueda reintentarla
+                await db.sync_ops.delete_one({'_id': op.op_id})
+                applied_by_id.pop(op.op_id)
+                results.append({'op_id': op.op_id, 'status': 'error', 'error': str(e)})
+                continue
+            
+            # Sin applied_here, la petición online con la misma clave ya la había aplicado
+            results.append({'op_id': op.op_id, 'status': 'applied' if applied_here else 'duplicate', 'order_id': order_id})
+        
+        orders = [serialize_doc(o) for o in changed_orders.values()]
+        if orders or deleted_order_ids:
+            await broadcast_change('sync_batch_applied', {
+                'orders': orders,
+                'deleted_order_ids': deleted_order_ids
+            })
+        
+        for order_dict in ready_orders:
+            await send_notification(order_dict.get('waiter_role'), order_dict['_id'], f"Pedido mesa {order_dict['table_number']} listo")
+        
+        return {'results': results, 'id_map': id_map}
     except Exception as e:
-        logger.error(f"Error deleting order: {str(e)}")
+        logger.error("Error applying sync batch: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 # ===== DAILY CLOSURE =====
 
+STATS_CACHE_SECONDS = float(os.environ.get('STATS_CACHE_SECONDS', '5'))
+
 @api_router.get("/daily-stats")
+@cached_read('daily_stats', ttl=STATS_CACHE_SECONDS)
+@admission('analytics')
 async def get_daily_stats(date: Optional[str] = None):
     try:
         if date:
@@ -536,10 +3817,10 @@ async def get_daily_stats(date: Optional[str] = None):
         end_of_day = target_date.replace(hour=23, minute=59, second=59, microsecond=999999)
         
         # Obtener solo pedidos que NO hayan sido cerrados aún
-        orders = await db.orders.find({
+        orders = await analytics_db.orders.find({
             'created_at': {'$gte': start_of_day, '$lte': end_of_day},
             'status': 'entregado',
-            'closed_date': {'$exists': False}
+            'closed_date': None  # ausente o null (el modelo Order lo guarda como null)
         }).to_list(1000)
         
         total_sales = 0
@@ -585,7 +3866,34 @@ async def get_daily_stats(date: Optional[str] = None):
             'zone_breakdown': zone_breakdown
         }
     except Exception as e:
-        logger.error(f"Error getting daily stats: {str(e)}")
+        logger.error("Error getting daily stats: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/daily-stats/live")
+async def get_live_daily_stats(date: Optional[str] = None):
+    """Contadores en vivo del día (sin recorrer pedidos); después basta con aplicar los eventos daily_stats_delta"""
+    try:
+        day = (datetime.fromisoformat(date) if date else datetime.utcnow()).strftime('%Y-%m-%d')
+        stats = await db.daily_stats_live.find_one({'_id': day, 'rebuilt': True})
+        if stats is None:
+            # Primer uso del día en este despliegue: partir de los pedidos ya entregados
+            stats = await rebuild_daily_stats(day)
+        return live_daily_stats_view(day, stats)
+    except Exception as e:
+        logger.error("Error getting live daily stats: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@admin_router.post("/daily-stats/live/rebuild")
+@admission('analytics')
+async def rebuild_live_daily_stats(date: Optional[str] = None):
+    """Recalcula los contadores en vivo de un día a partir de sus pedidos"""
+    try:
+        day = (datetime.fromisoformat(date) if date else datetime.utcnow()).strftime('%Y-%m-%d')
+        stats = live_daily_stats_view(day, await rebuild_daily_stats(day))
+        await broadcast('daily_stats_delta', {'date': day, 'reset': True, 'stats': stats})
+        return stats
+    except Exception as e:
+        logger.error("Error rebuilding live daily stats: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.post("/daily-closures")
@@ -614,39 +3922,48 @@ async def create_daily_closure(closure: DailyClosure):
             {
                 'created_at': {'$gte': start_of_day, '$lte': end_of_day},
                 'status': 'entregado',
-                'closed_date': {'$exists': False}
+                'closed_date': None
             },
             {
                 '$set': {'closed_date': datetime.utcnow()}
             }
         )
         
-        logger.info(f"Daily closure: Updated {update_result.modified_count} orders with closed_date")
+        logger.info("Daily closure: Updated %s orders with closed_date", update_result.modified_count)
+        read_cache.invalidate('daily_stats', 'weekly_stats')
+        
+        # Los pedidos cerrados dejan de contar: los contadores en vivo vuelven a cero
+        today_key = start_of_day.strftime('%Y-%m-%d')
+        await db.daily_stats_live.delete_one({'_id': today_key})
+        await broadcast('daily_stats_delta', {'date': today_key, 'reset': True, 'stats': live_daily_stats_view(today_key, None)})
         
         # Eliminar cierres más antiguos de 7 días
         seven_days_ago = datetime.utcnow() - timedelta(days=7)
         await db.daily_closures.delete_many({'date': {'$lt': seven_days_ago}})
         
         # Emitir evento de cierre a través de WebSocket
-        await sio.emit('daily_closure_created', serialize_doc(closure_dict))
+        await broadcast_change('daily_closure_created', serialize_doc(closure_dict))
         
         return serialize_doc(closure_dict)
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error creating daily closure: {str(e)}")
+        logger.error("Error creating daily closure: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.get("/daily-closures")
+@admission('analytics')
 async def get_daily_closures(limit: int = 30):
     try:
-        closures = await db.daily_closures.find().sort('date', -1).limit(limit).to_list(limit)
+        closures = await analytics_db.daily_closures.find().sort('date', -1).limit(limit).to_list(limit)
         return [serialize_doc(c) for c in closures]
     except Exception as e:
-        logger.error(f"Error fetching daily closures: {str(e)}")
+        logger.error("Error fetching daily closures: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.get("/weekly-stats")
+@cached_read('weekly_stats', ttl=STATS_CACHE_SECONDS)
+@admission('analytics')
 async def get_weekly_stats():
     """
     Obtiene estadísticas de la última semana (7 días)
@@ -657,7 +3974,7 @@ async def get_weekly_stats():
         start_of_period = datetime(seven_days_ago.year, seven_days_ago.month, seven_days_ago.day, 0, 0, 0)
         
         # Obtener pedidos entregados de los últimos 7 días
-        orders = await db.orders.find({
+        orders = await analytics_db.orders.find({
             'status': 'entregado',
             'created_at': {'$gte': start_of_period}
         }).to_list(None)
@@ -723,9 +4040,231 @@ async def get_weekly_stats():
             'daily_breakdown': daily_breakdown
         }
     except Exception as e:
-        logger.error(f"Error getting weekly stats: {str(e)}")
+        logger.error("Error getting weekly stats: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ===== ANALYTICS =====
+
+@api_router.get("/analytics/sales")
+@admission('analytics')
+async def get_sales_analytics(by: str = "product", date_from: Optional[str] = Query(None, alias="from"),
+                              date_to: Optional[str] = Query(None, alias="to"), zone: Optional[str] = None,
+                              waiter_role: Optional[str] = None, category: Optional[str] = None,
+                              limit: Optional[int] = None):
+    """
+    Ventas agrupadas por cualquier combinación de dimensiones, p.ej.
+    by=product,hour · by=waiter_role,zone · by=category,weekday
+    """
+    try:
+        dimensions = [d.strip() for d in by.split(',') if d.strip()]
+        filters = {k: v for k, v in (('zone', zone), ('waiter_role', waiter_role), ('category', category)) if v}
+        
+        await sales_cube.refresh()
+        rows = sales_cube.group_by(
+            dimensions,
+            start=datetime.fromisoformat(date_from) if date_from else None,
+            end=datetime.fromisoformat(date_to) if date_to else None,
+            filters=filters
+        )
+        if limit:
+            rows = rows[:limit]
+        return {'by': dimensions, 'rows': rows}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error("Error getting sales analytics: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/analytics/status")
+@admission('analytics')
+async def get_analytics_status():
+    try:
+        await sales_cube.refresh()
+        return {'dimensions': list(SalesCube.DIMENSIONS), **sales_cube.status()}
+    except Exception as e:
+        logger.error("Error getting analytics status: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@admin_router.post("/analytics/refresh")
+@admission('analytics')
+async def refresh_analytics():
+    try:
+        await sales_cube.refresh(force=True)
+        return sales_cube.status()
+    except Exception as e:
+        logger.error("Error refreshing analytics: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/analytics/top-products")
+@admission('analytics')
+async def get_top_products(date_from: Optional[str] = Query(None, alias="from"),
+                           date_to: Optional[str] = Query(None, alias="to"),
+                           limit: int = 10, sort: str = "quantity"):
+    """
+    Productos más vendidos entre dos días (YYYY-MM-DD, por defecto hoy),
+    leídos de los contadores diarios por producto.
+    """
+    try:
+        if sort not in ('quantity', 'revenue'):
+            raise HTTPException(status_code=400, detail="sort must be 'quantity' or 'revenue'")
+        
+        today = datetime.utcnow().strftime('%Y-%m-%d')
+        start_day = datetime.fromisoformat(date_from).strftime('%Y-%m-%d') if date_from else today
+        end_day = datetime.fromisoformat(date_to).strftime('%Y-%m-%d') if date_to else today
+        
+        products = await analytics_db.product_sales_daily.aggregate([
+            {'$match': {'day': {'$gte': start_day, '$lte': end_day}}},
+            # $last toma el nombre y la categoría del día más reciente
+            {'$sort': {'day': 1}},
+            {'$group': {
+                '_id': '$product_id',
+                'name': {'$last': '$name'},
+                'category': {'$last': '$category'},
+                'quantity': {'$sum': '$quantity'},
+                'revenue': {'$sum': '$revenue'}
+            }},
+            {'$match': {'quantity': {'$gt': 0}}},
+            {'$sort': {sort: -1}},
+            {'$limit': limit}
+        ]).to_list(limit)
+        
+        return {
+            'from': start_day,
+            'to': end_day,
+            'products': [
+                {
+                    'product_id': p['_id'],
+                    'name': p['name'],
+                    'category': p['category'],
+                    'quantity': p['quantity'],
+                    'revenue': round(p['revenue'], 2)
+                }
+                for p in products
+            ]
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error getting top products: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@admin_router.post("/analytics/top-products/rebuild")
+@admission('analytics')
+async def rebuild_product_sales():
+    """Recalcula los contadores por producto a partir de los pedidos entregados, sin parar las escrituras"""
+    try:
+        count = await ProductSalesRebuild().run()
+        return {"success": True, "orders": count}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error rebuilding product sales: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_router.get("/analytics/heatmap")
+@admission('analytics')
+async def get_service_heatmap(date_from: Optional[str] = Query(None, alias="from"),
+                              date_to: Optional[str] = Query(None, alias="to"),
+                              bucket_minutes: int = 15):
+    """
+    Pedidos y ventas por franja horaria (por defecto de 15 minutos) y zona
+    entre dos días (YYYY-MM-DD, por defecto los últimos 7 días).
+    Los días anteriores a hoy se calculan una sola vez y quedan en caché.
+    """
+    try:
+        if bucket_minutes <= 0 or 1440 % bucket_minutes != 0:
+            raise HTTPException(status_code=400, detail="bucket_minutes must divide 1440")
+        
+        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        start_day = datetime.fromisoformat(date_from).replace(hour=0, minute=0, second=0, microsecond=0) if date_from else today - timedelta(days=6)
+        end_day = datetime.fromisoformat(date_to).replace(hour=0, minute=0, second=0, microsecond=0) if date_to else today
+        if end_day < start_day:
+            raise HTTPException(status_code=400, detail="'from' must not be after 'to'")
+        
+        cache = heatmap_cache.current()
+        days = {}
+        missing = []
+        day = start_day
+        while day <= end_day:
+            key = (day.strftime('%Y-%m-%d'), bucket_minutes)
+            if key in cache:
+                cache.move_to_end(key)
+                days[key[0]] = cache[key]
+            else:
+                missing.append(day)
+            day += timedelta(days=1)
+        
+        if missing:
+            computed = await compute_heatmap_days(missing[0], missing[-1] + timedelta(days=1), bucket_minutes)
+            for day in missing:
+                day_key = day.strftime('%Y-%m-%d')
+                days[day_key] = computed.get(day_key, [])
+                # Los días pasados ya no cambian; los cierres de más de 7 días se borran, así que no sirven de guía
+                if day < today:
+                    cache[(day_key, bucket_minutes)] = days[day_key]
+                    while len(cache) > HEATMAP_CACHE_MAX_DAYS:
+                        cache.popitem(last=False)
+        
+        # Sumar todos los días por franja y zona
+        buckets = {}
+        for rows in days.values():
+            for row in rows:
+                bucket = buckets.setdefault((row['zone'], row['time']), {'zone': row['zone'], 'time': row['time'], 'orders': 0, 'sales': 0})
+                bucket['orders'] += row['orders']
+                bucket['sales'] += row['sales']
+        
+        for bucket in buckets.values():
+            bucket['sales'] = round(bucket['sales'], 2)
+        
+        return {
+            'from': start_day.strftime('%Y-%m-%d'),
+            'to': end_day.strftime('%Y-%m-%d'),
+            'bucket_minutes': bucket_minutes,
+            'days': (end_day - start_day).days + 1,
+            'buckets': sorted(buckets.values(), key=lambda b: (b['time'], b['zone']))
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error getting service heatmap: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ===== SOCKET CLIENTS =====
+
+@api_router.get("/socket-clients")
+async def get_socket_clients():
+    """Clientes Socket.IO conectados en todos los workers"""
+    try:
+        return {'worker': WORKER_ID, 'local': len(connected_clients.local_sids()), **(await connected_clients.summary())}
+    except Exception as e:
+        logger.error("Error fetching socket clients: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@admin_router.get("/socket-clients/flow")
+async def get_socket_flow_stats():
+    """Profundidad de cola, retraso y eventos agrupados/descartados por cliente (este worker)"""
+    try:
+        flow_control.slow_sids()
+        return {'worker': WORKER_ID, **flow_control.stats()}
+    except Exception as e:
+        logger.error("Error fetching socket flow stats: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+@admin_router.get("/tickets/stats")
+async def get_ticket_stats():
+    """Colas, tickets impresos, reintentos y latencia por impresora de estación"""
+    return ticket_pipeline.stats()
+
+@admin_router.post("/tickets/retry-failed")
+async def retry_failed_tickets():
+    """Vuelve a encolar los tickets apartados tras agotar los reintentos"""
+    return {'requeued': ticket_pipeline.retry_failed()}
+
+@admin_router.get("/admission")
+async def get_admission_stats():
+    """Estado de los límites de concurrencia por clase de prioridad"""
+    return {name: limiter.stats() for name, limiter in admission_classes.items()}
+
 # ===== SETTINGS =====
 
 @api_router.get("/settings")
@@ -743,7 +4282,7 @@ async def get_settings():
             return serialize_doc(settings)
         return serialize_doc(settings)
     except Exception as e:
-        logger.error(f"Error fetching settings: {str(e)}")
+        logger.error("Error fetching settings: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.put("/settings")
@@ -764,12 +4303,13 @@ async def update_settings(settings_data: dict = Body(...)):
         
         return serialize_doc(settings_data)
     except Exception as e:
-        logger.error(f"Error updating settings: {str(e)}")
+        logger.error("Error updating settings: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 # ===== SEED DATA =====
 
 @api_router.post("/seed")
+@admission('seed')
 async def seed_data():
     try:
         # Check if data exists
@@ -829,14 +4369,17 @@ async def seed_data():
             ]
             
             await db.products.insert_many(sample_products)
+            product_search.invalidate()
             products_count = len(sample_products)
         
+        await catalog_changed()
         return {"message": "Data seeded successfully", "products_count": products_count, "categories_count": categories_count}
     except Exception as e:
-        logger.error(f"Error seeding data: {str(e)}")
+        logger.error("Error seeding data: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.post("/seed-data")
+@admission('seed')
 async def seed_simple_data():
     """Seed initial data (products)"""
     try:
@@ -867,6 +4410,8 @@ async def seed_simple_data():
         ]
         
         await db.products.insert_many(products)
+        product_search.invalidate()
+        await catalog_changed()
         
         return {
             "message": "Data seeded successfully",
@@ -874,10 +4419,11 @@ async def seed_simple_data():
             "categories_count": len(categories)
         }
     except Exception as e:
-        logger.error(f"Error seeding data: {str(e)}")
+        logger.error("Error seeding data: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.post("/test-orders")
+@admission('seed')
 async def create_test_orders():
     """Crear pedidos de prueba con fecha actual para testing"""
     try:
@@ -920,31 +4466,254 @@ async def create_test_orders():
             }
             test_orders.append(order)
         
-        result = await db.orders.insert_many(test_orders)
+        # Uno a uno, como cualquier pedido creado ya entregado: cobro en el libro y
+        # datos derivados (top ventas, contadores del día) antes de escribir el siguiente
+        order_ids = []
+        for order in test_orders:
+            async def insert(session):
+                result = await db.orders.insert_one(order, session=session)
+                await record_settlement(str(result.inserted_id), None, order, session=session)
+                return result.inserted_id
+            order_ids.append(str(await run_in_transaction(insert)))
+            await on_order_changed(None, {**order, '_id': order_ids[-1]})
         
         return {
             "message": "Test orders created successfully",
-            "count": len(result.inserted_ids),
-            "order_ids": [str(id) for id in result.inserted_ids]
+            "count": len(order_ids),
+            "order_ids": order_ids
         }
     except Exception as e:
-        logger.error(f"Error creating test orders: {str(e)}")
+        logger.error("Error creating test orders: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
 
+# ===== ADMIN: PROFILING =====
+
+@admin_router.post("/profile/sample")
+async def start_sampling_profile(seconds: float = 10, interval: float = PROFILE_SAMPLE_INTERVAL):
+    """Muestrea la pila del event loop durante N segundos (máx. 300)"""
+    if profiling.running():
+        raise HTTPException(status_code=409, detail="A profiling session is already running")
+    if not 0 < seconds <= PROFILE_MAX_SECONDS or not 0.001 <= interval <= 1:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {PROFILE_MAX_SECONDS}] and interval in [0.001, 1]")
+    sampler = StackSampler(threading.get_ident(), seconds, interval)
+    sampler.start()
+    session = profiling.add('sample', sampler, seconds=seconds, interval=interval)
+    return profiling.describe(session)
+
+@admin_router.post("/profile/route")
+async def start_route_profile(path: str, method: str = "GET", requests: int = 10, seconds: float = PROFILE_MAX_SECONDS):
+    """Perfila con cProfile las próximas K peticiones a una ruta (p. ej. path=/api/orders/{order_id})"""
+    if profiling.running():
+        raise HTTPException(status_code=409, detail="A profiling session is already running")
+    if requests <= 0 or not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail="requests must be positive and seconds within the limit")
+    route = next((r for r in app.routes if isinstance(r, APIRoute) and r.path == path and method.upper() in r.methods), None)
+    if route is None or route.path.startswith(admin_router.prefix):
+        raise HTTPException(status_code=404, detail=f"No route {method.upper()} {path}")
+    session = profiling.add('route', RouteProfiler(route, requests, seconds), route=f"{method.upper()} {path}", requests=requests)
+    return profiling.describe(session)
+
+@admin_router.get("/profile")
+async def list_profiles():
+    return [profiling.describe(session) for session in profiling.sessions.values()]
+
+@admin_router.post("/profile/{session_id}/stop")
+async def stop_profile(session_id: str):
+    session = profiling.sessions.get(session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Profiling session not found")
+    profiler = session['profiler']
+    if isinstance(profiler, StackSampler):
+        profiler.stop()
+    else:
+        profiler.finish()
+    return profiling.describe(session)
+
+@admin_router.get("/profile/{session_id}")
+async def get_profile(session_id: str, format: str = "json"):
+    """Resultado: json (resumen y desglose por handler), svg, folded, pstats o text"""
+    session = profiling.sessions.get(session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Profiling session not found")
+    profiler = session['profiler']
+    if format == 'json':
+        return profiling.describe(session)
+    if profiler.running:
+        raise HTTPException(status_code=409, detail="Profiling session still running")
+    
+    filename = f"profile-{session_id}"
+    if format == 'pstats':
+        return Response(profiler.pstats_bytes(), media_type='application/octet-stream',
+                        headers={'Content-Disposition': f'attachment; filename="{filename}.pstats"'})
+    if format == 'svg' and isinstance(profiler, StackSampler):
+        return Response(profiler.svg(), media_type='image/svg+xml')
+    if format == 'folded' and isinstance(profiler, StackSampler):
+        return Response(profiler.folded(), media_type='text/plain',
+                        headers={'Content-Disposition': f'attachment; filename="{filename}.folded"'})
+    if format == 'text' and isinstance(profiler, RouteProfiler):
+        return Response(profiler.text(), media_type='text/plain')
+    raise HTTPException(status_code=400, detail=f"Format {format} not available for a {session['kind']} session")
+
+# ===== ADMIN: MEMORY =====
+
+@admin_router.get("/memory")
+async def get_memory_stats(objects: int = 25):
+    """RSS, estructuras en memoria del servidor y objetos vivos por tipo (con su variación desde la última llamada)"""
+    traced, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+    return {
+        'worker': WORKER_ID,
+        'rss_mb': process_rss_mb(),
+        'gc_counts': gc.get_count(),
+        'structures': structure_sizes(),
+        'objects': memory_tracker.object_counts(objects),
+        'tracemalloc': {
+            'tracing': tracemalloc.is_tracing(),
+            'traced_kb': round(traced / 1024, 1),
+            'peak_kb': round(peak / 1024, 1),
+            'baseline_at': memory_tracker.baseline_at.isoformat() if memory_tracker.baseline_at else None
+        }
+    }
+
+@admin_router.post("/memory/tracemalloc/start")
+async def start_tracemalloc(frames: int = 25):
+    """Activa tracemalloc (con coste mientras esté activo) y toma la instantánea de referencia"""
+    if not 1 <= frames <= 100:
+        raise HTTPException(status_code=400, detail="frames must be between 1 and 100")
+    memory_tracker.start(frames)
+    return {'tracing': True, 'frames': frames, 'baseline_at': memory_tracker.baseline_at.isoformat()}
+
+@admin_router.get("/memory/tracemalloc/diff")
+async def get_tracemalloc_diff(limit: int = 20, reset: bool = False):
+    """Crecimiento desde la referencia, agrupado por la línea de server.py que originó cada asignación"""
+    if not tracemalloc.is_tracing() or memory_tracker.baseline is None:
+        raise HTTPException(status_code=409, detail="tracemalloc is not running; POST /api/admin/memory/tracemalloc/start first")
+    return memory_tracker.diff(limit, reset)
+
+@admin_router.post("/memory/tracemalloc/stop")
+async def stop_tracemalloc():
+    memory_tracker.stop()
+    return {'tracing': False}
+
 # Include the router in the main app
 app.include_router(api_router)
+app.include_router(admin_router)
+
+class TenantMiddleware:
+    """Resolve the tenant of every HTTP request and run the app in its context"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        headers = {key.decode('latin-1'): value.decode('latin-1') for key, value in scope['headers']}
+        tenant = requested_tenant(headers) or DEFAULT_TENANT
+        if tenant not in TENANTS:
+            await JSONResponse({'detail': f"Unknown restaurant: {tenant}"}, status_code=404)(scope, receive, send)
+            return
+        with tenant_context(tenant):
+            await self.app(scope, receive, send)
+
+class RequestIdMiddleware:
+    """Give every HTTP request an id (X-Request-ID, or a new one) for its log records and response"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope['headers'])
+        rid = headers.get(b'x-request-id', b'').decode('latin-1')[:64] or uuid.uuid4().hex[:16]
+        
+        async def send_with_id(message):
+            if message['type'] == 'http.response.start':
+                message.setdefault('headers', [])
+                message['headers'] = list(message['headers']) + [(b'x-request-id', rid.encode('latin-1'))]
+            await send(message)
+        
+        token = request_id.set(rid)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id.reset(token)
 
+# Antes que CORS, para que también las respuestas 404 de tenant lleven sus cabeceras
+app.add_middleware(TenantMiddleware)
+app.add_middleware(RequestIdMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "ETag"],
 )
 
 # Mount Socket.IO
 socket_app = socketio.ASGIApp(sio, other_asgi_app=app)
 
+@app.on_event("startup")
+async def create_indexes():
+    for tenant in TENANTS:
+        with tenant_context(tenant):
+            await create_tenant_indexes()
+
+async def create_tenant_indexes():
+    # Las operaciones offline ya aplicadas se olvidan a los 7 días
+    await db.sync_ops.create_index('applied_at', expireAfterSeconds=7 * 24 * 3600)
+    # Las respuestas guardadas por Idempotency-Key caducan a las 24 horas
+    await db.idempotency_keys.create_index('created_at', expireAfterSeconds=24 * 3600)
+    # Refresco incremental del cubo de ventas
+    await db.orders.create_index('updated_at')
+    await db.deleted_orders.create_index('deleted_at', expireAfterSeconds=int(DELETED_ORDERS_TTL.total_seconds()))
+    # Contadores diarios por producto (top ventas)
+    await db.product_sales_daily.create_index([('day', 1), ('product_id', 1)])
+    await db.product_sales_journal.create_index([('rebuild_id', 1), ('at', 1)])
+    await db.product_sales_journal.create_index('at', expireAfterSeconds=24 * 3600)
+    # Estadísticas y heatmap por rango de fechas sobre pedidos entregados
+    await db.orders.create_index([('status', 1), ('created_at', 1)])
+    # Upserts de la importación masiva del catálogo
+    await db.products.create_index([('name', 1), ('category', 1)])
+    # Libro de pagos: totales por método de un periodo con una agregación cubierta por el índice
+    await db.payments.create_index([('day', 1), ('method', 1), ('amount', 1)])
+    await db.payments.create_index('order_id')
+    # Cuenta conjunta: pedidos que apuntan a otro en unified_with
+    await db.orders.create_index('unified_with')
+    # Registro compartido de clientes Socket.IO; red de seguridad si un worker muere sin limpiar
+    await db.socket_clients.create_index('worker')
+    await db.socket_clients.create_index('connected_at', expireAfterSeconds=24 * 3600)
+    # Eventos para reanudar clientes cuando hay varios workers
+    await db.event_log.create_index([('epoch', 1), ('seq', 1)])
+    await db.event_log.create_index('created_at', expireAfterSeconds=EVENT_LOG_TTL_SECONDS)
+    # Tokens del bus de eventos de workers que ya no existen
+    await db.event_bus_state.create_index('updated_at', expireAfterSeconds=24 * 3600)
+
+@app.on_event("startup")
+async def start_event_bus():
+    app.state.flow_control = asyncio.create_task(flow_control.run())
+    app.state.ticket_tasks = ticket_pipeline.start()
+    app.state.client_janitor = asyncio.create_task(connected_clients.run())
+    app.state.event_buses = []
+    if EVENT_BUS_ENABLED:
+        # Un change stream por restaurante; la tarea hereda el tenant del contexto
+        for tenant in TENANTS:
+            with tenant_context(tenant):
+                app.state.event_buses.append(asyncio.create_task(run_change_stream_bus()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    tasks = (getattr(app.state, 'event_buses', []) + getattr(app.state, 'ticket_tasks', [])
+             + [getattr(app.state, 'flow_control', None), getattr(app.state, 'client_janitor', None)])
+    for task in tasks:
+        if task:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+    await connected_clients.remove_worker()
     client.close()
@@ -25,8 +25,8 @@ const ZONE_LABELS: { [key: string]: string } = {
 };
 
 export default function DailyClosureScreen() {
-  const { role } = useApp();
-  const [stats, setStats] = useState<any>(null);
+  // Los totales del día llegan en vivo por socket (daily_stats_delta) a través del contexto
+  const { role, dailyStats: stats, setDailyStats } = useApp();
   const [closures, setClosures] = useState<any[]>([]);
   const [loading, setLoading] = useState(false);
   const [generatingPDF, setGeneratingPDF] = useState(false);
@@ -38,20 +38,30 @@ export default function DailyClosureScreen() {
   const loadData = async () => {
     try {
       const [statsData, closuresData] = await Promise.all([
-        api.getDailyStats(),
+        api.getLiveDailyStats(),
         api.getDailyClosures(30),
       ]);
-      setStats(statsData);
+      setDailyStats(statsData);
       setClosures(closuresData);
     } catch (error) {
       console.error('Error loading data:', error);
     }
   };
 
-  const handleClosureDay = () => {
+  const handleClosureDay = async () => {
+    // El cierre se guarda con los totales recalculados de los pedidos, no con los contadores en vivo
+    let closingStats: any;
+    try {
+      closingStats = await api.getDailyStats();
+    } catch (error) {
+      console.error('Error loading daily stats:', error);
+      Alert.alert('Error', 'No se pudieron obtener los totales del día');
+      return;
+    }
+
     Alert.alert(
       'Cerrar Día',
-      `¿Confirmas el cierre del día con total de €${stats?.total_sales.toFixed(2)}?`,
+      `¿Confirmas el cierre del día con total de €${closingStats.total_sales.toFixed(2)}?`,
       [
         { text: 'Cancelar', style: 'cancel' },
         {
@@ -62,12 +72,12 @@ export default function DailyClosureScreen() {
             try {
               await api.createDailyClosure({
                 date: new Date().toISOString(),
-                total_sales: stats.total_sales,
-                cash_sales: stats.cash_sales,
-                card_sales: stats.card_sales,
-                mixed_sales: stats.mixed_sales,
-                total_orders: stats.total_orders,
-                zone_breakdown: stats.zone_breakdown || {},
+                total_sales: closingStats.total_sales,
+                cash_sales: closingStats.cash_sales,
+                card_sales: closingStats.card_sales,
+                mixed_sales: closingStats.mixed_sales,
+                total_orders: closingStats.total_orders,
+                zone_breakdown: closingStats.zone_breakdown || {},
                 closed_by: role || 'administrador',
               });
               Alert.alert('Éxito', 'Cierre diario guardado correctamente');
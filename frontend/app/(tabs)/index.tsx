@@ -22,7 +22,7 @@ import Modal from 'react-native-modal';
 import { api } from '../../services/api';
 
 export default function OrdersScreen() {
-  const { orders, refreshData, updateOrder, deleteOrder, loading, role, isOnline } = useApp();
+  const { orders, refreshData, updateOrder, deleteOrder, addPartialPayment, payBill, loading, role, isOnline } = useApp();
   const [filter, setFilter] = useState('all');
   const [zoneFilter, setZoneFilter] = useState('all');
   const [selectedOrder, setSelectedOrder] = useState<any>(null);
@@ -32,6 +32,8 @@ export default function OrdersScreen() {
   const [partialAmount, setPartialAmount] = useState('');
   const [selectedProductsForPayment, setSelectedProductsForPayment] = useState<string[]>([]);
   const [partialPaymentMethod, setPartialPaymentMethod] = useState('efectivo');
+  const [bill, setBill] = useState<any>(null);
+  const [payingBill, setPayingBill] = useState(false);
 
   const zones = [
     { value: 'all', label: 'Todas' },
@@ -69,6 +71,8 @@ export default function OrdersScreen() {
         status: newStatus,
         payment_method: order.payment_method || null,
         special_note: order.special_note || null,
+        // El PUT reemplaza el pedido: sin esto se perderían los pagos parciales
+        partial_payments: order.partial_payments || [],
       };
       
       const result = await updateOrder(order._id, updatedOrder);
@@ -140,6 +144,8 @@ export default function OrdersScreen() {
         status: selectedOrder.status,
         payment_method: selectedOrder.payment_method || null,
         special_note: selectedOrder.special_note || null,
+        // El PUT reemplaza el pedido: sin esto se perderían los pagos parciales
+        partial_payments: selectedOrder.partial_payments || [],
       };
       
       const result = await updateOrder(selectedOrder._id, updatedOrder);
@@ -153,7 +159,20 @@ export default function OrdersScreen() {
     }
   };
 
-  const openPartialPaymentModal = () => {
+  // Un pedido unificado se cobra también como cuenta conjunta de todas sus mesas
+  const openOrder = async (order: any) => {
+    setSelectedOrder(order);
+    setBill(null);
+    if (!order.unified_with?.length) return;
+    try {
+      setBill(await api.getBill(order._id));
+    } catch (error) {
+      console.error('Error loading bill:', error);
+    }
+  };
+
+  const openPartialPaymentModal = (forBill: boolean = false) => {
+    setPayingBill(forBill);
     setPartialPaymentModalVisible(true);
     setPartialAmount('');
     setSelectedProductsForPayment([]);
@@ -171,6 +190,11 @@ export default function OrdersScreen() {
   const handlePartialPayment = async () => {
     if (!selectedOrder) return;
 
+    if (payingBill) {
+      await handleBillPayment();
+      return;
+    }
+
     if (selectedProductsForPayment.length === 0 && !partialAmount) {
       Alert.alert('Error', 'Selecciona productos o ingresa un monto');
       return;
@@ -192,42 +216,13 @@ export default function OrdersScreen() {
         return;
       }
 
-      // Marcar productos como pagados
-      const updatedProducts = selectedOrder.products.map((p: any) => ({
-        ...p,
-        is_paid: selectedProductsForPayment.includes(p.product_id) ? true : p.is_paid,
-      }));
-
-      // Calcular nuevo paid_amount y pending_amount
-      const newPaidAmount = (selectedOrder.paid_amount || 0) + calculatedAmount;
-      const newPendingAmount = selectedOrder.total - newPaidAmount;
-
-      // Agregar a partial_payments
-      const partialPayments = selectedOrder.partial_payments || [];
-      partialPayments.push({
+      // El servidor marca los productos pagados, recalcula importes y lo apunta en el libro de pagos
+      await addPartialPayment(selectedOrder._id, {
         amount: calculatedAmount,
         payment_method: partialPaymentMethod,
         paid_products: selectedProductsForPayment,
-        timestamp: new Date().toISOString(),
         note: '',
       });
-
-      const updatedOrder = {
-        table_number: selectedOrder.table_number,
-        zone: selectedOrder.zone || 'terraza_exterior',
-        waiter_role: selectedOrder.waiter_role,
-        products: updatedProducts,
-        total: selectedOrder.total,
-        paid_amount: newPaidAmount,
-        pending_amount: newPendingAmount,
-        status: selectedOrder.status,
-        payment_method: partialPaymentMethod,
-        partial_payments: partialPayments,
-        special_note: selectedOrder.special_note || null,
-      };
-
-      await updateOrder(selectedOrder._id, updatedOrder);
-      await refreshData();
       setPartialPaymentModalVisible(false);
       setSelectedOrder(null);
       Alert.alert('Éxito', 'Pago parcial registrado');
@@ -237,6 +232,30 @@ export default function OrdersScreen() {
     }
   };
 
+  const handleBillPayment = async () => {
+    // Sin monto se cobra todo lo pendiente de la cuenta conjunta
+    const amount = partialAmount ? parseFloat(partialAmount) : bill.pending_amount;
+    if (!(amount > 0)) {
+      Alert.alert('Error', 'Monto inválido');
+      return;
+    }
+
+    try {
+      await payBill(selectedOrder._id, {
+        amount,
+        payment_method: partialPaymentMethod,
+        paid_products: [],
+        note: '',
+      });
+      setPartialPaymentModalVisible(false);
+      setSelectedOrder(null);
+      setBill(null);
+      Alert.alert('Éxito', 'Cuenta conjunta cobrada');
+    } catch (error) {
+      console.error('Error paying bill:', error);
+    }
+  };
+
   const renderOrderItem = ({ item }: { item: any }) => {
     const orderDate = new Date(item.created_at);
     const timeStr = format(orderDate, 'HH:mm');
@@ -249,7 +268,7 @@ export default function OrdersScreen() {
           styles.orderCard,
           { borderLeftColor: StatusColors[item.status as keyof typeof StatusColors] || Colors.gray },
         ]}
-        onPress={() => setSelectedOrder(item)}
+        onPress={() => openOrder(item)}
         activeOpacity={0.7}
       >
         <View style={styles.orderHeader}>
@@ -492,16 +511,48 @@ export default function OrdersScreen() {
                 )}
               </View>
 
+              {bill && (
+                <View style={styles.modalSection}>
+                  <Text style={styles.sectionTitle}>Cuenta conjunta (Mesas {bill.tables.join(', ')})</Text>
+                  <View style={styles.totalRow}>
+                    <Text style={styles.totalLabel}>Total</Text>
+                    <Text style={styles.totalAmount}>€{bill.total.toFixed(2)}</Text>
+                  </View>
+                  {bill.paid_amount > 0 && (
+                    <View style={styles.paymentRow}>
+                      <Text style={styles.paymentLabel}>Pagado</Text>
+                      <Text style={styles.paidAmount}>€{bill.paid_amount.toFixed(2)}</Text>
+                    </View>
+                  )}
+                  {bill.pending_amount > 0 && (
+                    <View style={styles.paymentRow}>
+                      <Text style={styles.paymentLabel}>Pendiente</Text>
+                      <Text style={styles.pendingAmount}>€{bill.pending_amount.toFixed(2)}</Text>
+                    </View>
+                  )}
+                </View>
+              )}
+
               {(selectedOrder.pending_amount || 0) > 0 && (
                 <TouchableOpacity
                   style={styles.partialPaymentButton}
-                  onPress={openPartialPaymentModal}
+                  onPress={() => openPartialPaymentModal()}
                 >
                   <Ionicons name="cash" size={20} color={Colors.white} />
                   <Text style={styles.partialPaymentButtonText}>Cobro Parcial</Text>
                 </TouchableOpacity>
               )}
 
+              {bill && bill.pending_amount > 0 && (
+                <TouchableOpacity
+                  style={styles.partialPaymentButton}
+                  onPress={() => openPartialPaymentModal(true)}
+                >
+                  <Ionicons name="people" size={20} color={Colors.white} />
+                  <Text style={styles.partialPaymentButtonText}>Cobrar Cuenta Conjunta</Text>
+                </TouchableOpacity>
+              )}
+
               <View style={styles.modalActions}>
                 <TouchableOpacity
                   style={[styles.actionButton, styles.deleteButton]}
@@ -568,33 +619,39 @@ export default function OrdersScreen() {
         style={styles.modal}
       >
         <View style={styles.smallModalContent}>
-          <Text style={styles.smallModalTitle}>Cobro Parcial</Text>
+          <Text style={styles.smallModalTitle}>{payingBill ? 'Cuenta Conjunta' : 'Cobro Parcial'}</Text>
           <Text style={styles.smallModalSubtitle}>
-            Pendiente: €{(selectedOrder?.pending_amount || selectedOrder?.total || 0).toFixed(2)}
+            Pendiente: €{(payingBill
+              ? bill?.pending_amount || 0
+              : selectedOrder?.pending_amount || selectedOrder?.total || 0).toFixed(2)}
           </Text>
           
-          <Text style={styles.selectProductsLabel}>Selecciona productos pagados:</Text>
-          <ScrollView style={styles.productsList}>
-            {selectedOrder?.products
-              .filter((p: any) => !p.is_paid)
-              .map((product: any, index: number) => (
-                <TouchableOpacity
-                  key={index}
-                  style={[
-                    styles.productCheckbox,
-                    selectedProductsForPayment.includes(product.product_id) && styles.productCheckboxActive,
-                  ]}
-                  onPress={() => toggleProductForPayment(product.product_id)}
-                >
-                  <Text style={styles.productCheckboxText}>
-                    {product.quantity}x {product.name} - €{(product.price * product.quantity).toFixed(2)}
-                  </Text>
-                  {selectedProductsForPayment.includes(product.product_id) && (
-                    <Ionicons name="checkmark-circle" size={24} color={Colors.secondary} />
-                  )}
-                </TouchableOpacity>
-              ))}
-          </ScrollView>
+          {!payingBill && (
+            <>
+              <Text style={styles.selectProductsLabel}>Selecciona productos pagados:</Text>
+              <ScrollView style={styles.productsList}>
+                {selectedOrder?.products
+                  .filter((p: any) => !p.is_paid)
+                  .map((product: any, index: number) => (
+                    <TouchableOpacity
+                      key={index}
+                      style={[
+                        styles.productCheckbox,
+                        selectedProductsForPayment.includes(product.product_id) && styles.productCheckboxActive,
+                      ]}
+                      onPress={() => toggleProductForPayment(product.product_id)}
+                    >
+                      <Text style={styles.productCheckboxText}>
+                        {product.quantity}x {product.name} - €{(product.price * product.quantity).toFixed(2)}
+                      </Text>
+                      {selectedProductsForPayment.includes(product.product_id) && (
+                        <Ionicons name="checkmark-circle" size={24} color={Colors.secondary} />
+                      )}
+                    </TouchableOpacity>
+                  ))}
+              </ScrollView>
+            </>
+          )}
 
           <Text style={styles.selectProductsLabel}>Método de Pago:</Text>
           <View style={styles.paymentMethodButtons}>
@@ -628,7 +685,7 @@ export default function OrdersScreen() {
 
           <TextInput
             style={styles.priceInput}
-            placeholder="Monto a cobrar (opcional si seleccionaste productos)"
+            placeholder={payingBill ? 'Monto a cobrar (vacío para cobrar todo)' : 'Monto a cobrar (opcional si seleccionaste productos)'}
             placeholderTextColor={Colors.gray}
             value={partialAmount}
             onChangeText={setPartialAmount}
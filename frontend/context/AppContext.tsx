@@ -1,5 +1,5 @@
 import React, { createContext, useContext, useState, useEffect, ReactNode } from 'react';
-import { api, initSocket, disconnectSocket, offlineStorage } from '../services/api';
+import { api, initSocket, disconnectSocket, offlineStorage, offlineQueue, newId } from '../services/api';
 import * as Haptics from 'expo-haptics';
 import { Alert } from 'react-native';
 import { initializeOneSignal, addNotificationListener, sendNotification } from '../services/oneSignalService';
@@ -19,6 +19,38 @@ interface Category {
   created_at: string;
 }
 
+interface Menu {
+  version: number;
+  categories: (Category & { products: Product[] })[];
+  uncategorized: Product[];
+}
+
+// /api/menu trae los productos anidados en su categoría; el resto de la app usa las listas planas
+const splitMenu = (menu: Menu) => ({
+  categoriesData: menu.categories.map(({ products, ...category }) => category),
+  productsData: [...menu.categories.flatMap((category) => category.products), ...menu.uncategorized],
+});
+
+// Contadores en vivo del día: los eventos traen el valor resultante de cada contador
+// que cambia ('total_sales', 'zone_breakdown.<zona>.sales'); cierres y recálculos traen todo
+const applyDailyStatsDelta = (stats: any, event: any) => {
+  if (event.reset) return event.stats;
+  if (!stats || stats.date !== event.date) return stats;
+  const next = { ...stats, zone_breakdown: { ...stats.zone_breakdown } };
+  Object.entries(event.values).forEach(([field, value]) => {
+    const [counter, zone, zoneCounter] = field.split('.');
+    if (zone) {
+      next.zone_breakdown[zone] = { ...next.zone_breakdown[zone], [zoneCounter]: value };
+    } else {
+      next[counter] = value;
+    }
+  });
+  return next;
+};
+
+// fetch solo lanza TypeError cuando no hay red; una respuesta no 2xx llega como ApiError
+const isNetworkError = (error: unknown) => error instanceof TypeError;
+
 interface OrderProduct {
   product_id: string;
   name: string;
@@ -61,12 +93,16 @@ interface AppContextType {
   createOrder: (order: any) => Promise<void>;
   updateOrder: (id: string, order: any) => Promise<void>;
   deleteOrder: (id: string) => Promise<void>;
+  addPartialPayment: (id: string, payment: any) => Promise<Order>;
+  payBill: (id: string, payment: any) => Promise<any>;
   createProduct: (product: any) => Promise<void>;
   updateProduct: (id: string, product: any) => Promise<void>;
   deleteProduct: (id: string) => Promise<void>;
   createCategory: (category: any) => Promise<void>;
   updateCategory: (id: string, category: any) => Promise<void>;
   deleteCategory: (id: string) => Promise<void>;
+  dailyStats: any;
+  setDailyStats: (stats: any) => void;
   loading: boolean;
 }
 
@@ -87,6 +123,7 @@ export const AppProvider = ({ children }: { children: ReactNode }) => {
   const [products, setProducts] = useState<Product[]>([]);
   const [categories, setCategories] = useState<Category[]>([]);
   const [isOnline, setIsOnline] = useState(true);
+  const [dailyStats, setDailyStats] = useState<any>(null);
   const [loading, setLoading] = useState(false);
 
   const ROLE_TO_USERNAME: { [key: string]: string } = {
@@ -135,6 +172,9 @@ export const AppProvider = ({ children }: { children: ReactNode }) => {
   useEffect(() => {
     if (role) {
       const socket = initSocket(role, {
+        onConnect: () => {
+          flushOfflineOps().catch((error) => console.error('Error flushing offline changes:', error));
+        },
         onOrderCreated: (order: Order) => {
           console.log('Order created:', order);
           setOrders((prev) => [order, ...prev]);
@@ -173,6 +213,12 @@ export const AppProvider = ({ children }: { children: ReactNode }) => {
           console.log('Product deleted:', data);
           setProducts((prev) => prev.filter((p) => p._id !== data.product_id));
         },
+        onCatalogReplaced: async (data: { version: number }) => {
+          console.log('Catalog replaced:', data);
+          const { productsData, categoriesData } = splitMenu(await api.getMenu());
+          setProducts(productsData);
+          setCategories(categoriesData);
+        },
         onCategoryCreated: (category: Category) => {
           console.log('Category created:', category);
           setCategories((prev) => [...prev, category]);
@@ -200,6 +246,27 @@ export const AppProvider = ({ children }: { children: ReactNode }) => {
           refreshData();
           Haptics.notificationAsync(Haptics.NotificationFeedbackType.Success);
         },
+        onSyncData: (data: { orders: Order[]; products: Product[]; categories: Category[] }) => {
+          console.log('Full sync received');
+          setOrders(data.orders);
+          setProducts(data.products);
+          setCategories(data.categories);
+        },
+        onDailyStatsDelta: (event: any) => {
+          setDailyStats((prev: any) => applyDailyStatsDelta(prev, event));
+        },
+        onSyncBatchApplied: (data: { orders: Order[]; deleted_order_ids: string[] }) => {
+          console.log('Sync batch applied:', data);
+          setOrders((prev) => {
+            const changed = new Map(data.orders.map((o) => [o._id, o]));
+            const kept = prev
+              .filter((o) => !data.deleted_order_ids.includes(o._id))
+              .map((o) => changed.get(o._id) || o);
+            const existing = new Set(kept.map((o) => o._id));
+            const created = data.orders.filter((o) => !existing.has(o._id));
+            return [...created, ...kept];
+          });
+        },
       });
 
       refreshData();
@@ -210,14 +277,25 @@ export const AppProvider = ({ children }: { children: ReactNode }) => {
     }
   }, [role]);
 
+  // Reproduce en una sola llamada los cambios de pedidos hechos sin conexión
+  const flushOfflineOps = async () => {
+    const result = await offlineQueue.flush(username || undefined);
+    if (!result) return;
+    const failed = result.results.filter((r: any) => r.status === 'error');
+    if (failed.length > 0) {
+      Alert.alert('Sincronización', `${failed.length} cambio(s) hechos sin conexión no se pudieron aplicar`);
+    }
+    // Los pedidos creados offline llevaban un id local; sync_batch_applied los trae con el real
+    const localIds = Object.keys(result.id_map || {});
+    setOrders((prev) => prev.filter((o) => !localIds.includes(o._id)));
+  };
+
   const refreshData = async () => {
     setLoading(true);
     try {
-      const [ordersData, productsData, categoriesData] = await Promise.all([
-        api.getOrders(),
-        api.getProducts(),
-        api.getCategories(),
-      ]);
+      await flushOfflineOps();
+      const [ordersData, menu] = await Promise.all([api.getOrders(), api.getMenu()]);
+      const { productsData, categoriesData } = splitMenu(menu);
 
       setOrders(ordersData);
       setProducts(productsData);
@@ -243,14 +321,32 @@ export const AppProvider = ({ children }: { children: ReactNode }) => {
   };
 
   const createOrder = async (order: any) => {
+    const orderWithUser = {
+      ...order,
+      created_by: username
+    };
+    // Una sola clave por pedido: la de los reintentos online y, si se encola, su op_id
+    const key = newId();
     try {
-      const orderWithUser = {
-        ...order,
-        created_by: username
-      };
-      await api.createOrder(orderWithUser);
+      await api.createOrder(orderWithUser, key);
       Haptics.notificationAsync(Haptics.NotificationFeedbackType.Success);
     } catch (error) {
+      if (isNetworkError(error)) {
+        const localId = await offlineQueue.enqueue('create_order', null, orderWithUser, key);
+        const now = new Date().toISOString();
+        setOrders((prev) => [{
+          status: 'pendiente',
+          paid_amount: 0,
+          pending_amount: orderWithUser.total,
+          partial_payments: [],
+          ...orderWithUser,
+          _id: localId,
+          created_at: now,
+          updated_at: now,
+        }, ...prev]);
+        setIsOnline(false);
+        return;
+      }
       console.error('Error creating order:', error);
       Alert.alert('Error', 'No se pudo crear el pedido');
       throw error;
@@ -258,8 +354,9 @@ export const AppProvider = ({ children }: { children: ReactNode }) => {
   };
 
   const updateOrder = async (id: string, order: any) => {
+    const key = newId();
     try {
-      const updatedOrder = await api.updateOrder(id, order);
+      const updatedOrder = await api.updateOrder(id, order, key);
       Haptics.impactAsync(Haptics.ImpactFeedbackStyle.Light);
       // Actualizar el estado local inmediatamente
       setOrders((prev) =>
@@ -267,6 +364,14 @@ export const AppProvider = ({ children }: { children: ReactNode }) => {
       );
       return updatedOrder;
     } catch (error) {
+      if (isNetworkError(error)) {
+        await offlineQueue.enqueue('update_order', id, order, key);
+        const current = orders.find((o) => o._id === id);
+        const updatedOrder = { ...current, ...order, _id: id, updated_at: new Date().toISOString() } as Order;
+        setOrders((prev) => prev.map((o) => (o._id === id ? updatedOrder : o)));
+        setIsOnline(false);
+        return updatedOrder;
+      }
       console.error('Error updating order:', error);
       Alert.alert('Error', 'No se pudo actualizar el pedido');
       throw error;
@@ -278,12 +383,64 @@ export const AppProvider = ({ children }: { children: ReactNode }) => {
       await api.deleteOrder(id);
       Haptics.impactAsync(Haptics.ImpactFeedbackStyle.Medium);
     } catch (error) {
+      if (isNetworkError(error)) {
+        await offlineQueue.enqueue('delete_order', id);
+        setOrders((prev) => prev.filter((o) => o._id !== id));
+        setIsOnline(false);
+        return;
+      }
       console.error('Error deleting order:', error);
       Alert.alert('Error', 'No se pudo eliminar el pedido');
       throw error;
     }
   };
 
+  const addPartialPayment = async (id: string, payment: any) => {
+    const key = newId();
+    try {
+      const updatedOrder = await api.addPartialPayment(id, payment, key);
+      Haptics.notificationAsync(Haptics.NotificationFeedbackType.Success);
+      setOrders((prev) => prev.map((o) => (o._id === id ? updatedOrder : o)));
+      return updatedOrder;
+    } catch (error) {
+      if (isNetworkError(error)) {
+        await offlineQueue.enqueue('partial_payment', id, payment, key);
+        const current = orders.find((o) => o._id === id) as Order;
+        const paid = (current.paid_amount || 0) + payment.amount;
+        const updatedOrder = {
+          ...current,
+          products: current.products.map((p) => (payment.paid_products?.includes(p.product_id) ? { ...p, is_paid: true } : p)),
+          partial_payments: [...(current.partial_payments || []), { ...payment, timestamp: new Date().toISOString() }],
+          paid_amount: paid,
+          pending_amount: Math.max(0, current.total - paid),
+        };
+        setOrders((prev) => prev.map((o) => (o._id === id ? updatedOrder : o)));
+        setIsOnline(false);
+        return updatedOrder;
+      }
+      console.error('Error adding partial payment:', error);
+      Alert.alert('Error', 'No se pudo registrar el pago parcial');
+      throw error;
+    }
+  };
+
+  // Cobro sobre la cuenta conjunta: el servidor lo reparte entre los pedidos unificados pendientes
+  const payBill = async (id: string, payment: any) => {
+    try {
+      const bill = await api.payBill(id, payment);
+      Haptics.notificationAsync(Haptics.NotificationFeedbackType.Success);
+      const amounts: Record<string, any> = Object.fromEntries(bill.orders.map((o: any) => [o._id, o]));
+      setOrders((prev) => prev.map((o) => (amounts[o._id]
+        ? { ...o, paid_amount: amounts[o._id].paid_amount, pending_amount: amounts[o._id].pending_amount }
+        : o)));
+      return bill;
+    } catch (error) {
+      console.error('Error paying bill:', error);
+      Alert.alert('Error', 'No se pudo cobrar la cuenta conjunta');
+      throw error;
+    }
+  };
+
   const createProduct = async (product: any) => {
     try {
       await api.createProduct(product);
@@ -364,12 +521,16 @@ export const AppProvider = ({ children }: { children: ReactNode }) => {
         createOrder,
         updateOrder,
         deleteOrder,
+        addPartialPayment,
+        payBill,
         createProduct,
         updateProduct,
         deleteProduct,
         createCategory,
         updateCategory,
         deleteCategory,
+        dailyStats,
+        setDailyStats,
         loading,
       }}
     >
@@ -4,14 +4,81 @@ import AsyncStorage from '@react-native-async-storage/async-storage';
 
 const BACKEND_URL = Constants.expoConfig?.extra?.EXPO_PUBLIC_BACKEND_URL || 'http://localhost:8001';
 const API_URL = `${BACKEND_URL}/api`;
-const SOCKET_URL = BACKEND_URL; // Socket.IO en mismo servidor
+// Restaurante de este dispositivo; vacío = restaurante por defecto (namespace '/')
+const TENANT: string = Constants.expoConfig?.extra?.EXPO_PUBLIC_TENANT || '';
+const SOCKET_URL = TENANT ? `${BACKEND_URL}/${TENANT}` : BACKEND_URL; // Socket.IO en mismo servidor, namespace del restaurante
 
 console.log('Backend URL:', BACKEND_URL);
 console.log('API URL:', API_URL);
 console.log('Socket URL:', SOCKET_URL);
 
+// Respuesta que no es 2xx: status, detail del servidor y, en un 503, los segundos de Retry-After
+export class ApiError extends Error {
+  status: number;
+  retryAfter: number | null;
+
+  constructor(status: number, detail: unknown, retryAfter: number | null) {
+    super(typeof detail === 'string' ? detail : `HTTP ${status}`);
+    this.name = 'ApiError';
+    this.status = status;
+    this.retryAfter = retryAfter;
+  }
+}
+
+// Toda llamada lleva el restaurante y falla con ApiError si el servidor no responde 2xx (304 lo trata getMenu)
+const apiFetch = async (url: string, init: RequestInit = {}) => {
+  const response = await fetch(url, {
+    ...init,
+    headers: { ...(init.headers as Record<string, string>), ...(TENANT ? { 'X-Tenant-ID': TENANT } : {}) },
+  });
+  if (!response.ok && response.status !== 304) {
+    const body = await response.json().catch(() => null);
+    const retryAfter = Number(response.headers.get('Retry-After'));
+    throw new ApiError(response.status, body?.detail, retryAfter > 0 ? retryAfter : null);
+  }
+  return response;
+};
+
 let socket: Socket | null = null;
 
+// Ids generados en el dispositivo: op_id de la cola offline, pedidos creados sin conexión, Idempotency-Key
+export const newId = () => `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 10)}`;
+
+// Escrituras que no deben duplicarse: ante un fallo de red o un 503 (servidor ocupado, tras esperar
+// su Retry-After) se reintentan con la misma Idempotency-Key y, si el servidor ya las había aplicado,
+// devuelve la respuesta guardada sin repetirlas. Cualquier otro error se propaga sin reintentar.
+// Si al final se encolan offline, la clave pasa a ser su op_id y /sync/batch tampoco las repite
+const idempotentFetch = async (url: string, init: RequestInit, key: string = newId(), attempts: number = 3) => {
+  const headers = { ...(init.headers as Record<string, string>), 'Idempotency-Key': key };
+  for (let attempt = 1; ; attempt++) {
+    try {
+      return await apiFetch(url, { ...init, headers });
+    } catch (error) {
+      const busy = error instanceof ApiError && error.status === 503;
+      if (attempt >= attempts || !(busy || error instanceof TypeError)) throw error;
+      const retryAfter = busy ? (error as ApiError).retryAfter : null;
+      await new Promise((resolve) => setTimeout(resolve, retryAfter ? retryAfter * 1000 : 500 * attempt));
+    }
+  }
+};
+
+// Última carta recibida y su ETag: si no ha cambiado el servidor responde 304 sin cuerpo
+let menuEtag: string | null = null;
+let cachedMenu: any = null;
+
+// Último evento recibido de cada worker (epoch): al reconectar se piden solo los eventos perdidos
+let lastSeqs: Record<string, number> = {};
+
+const sequenced = (handler?: (payload: any) => void) => (payload: any) => {
+  if (payload && typeof payload._seq === 'number') {
+    if (payload._seq <= (lastSeqs[payload._epoch] ?? 0)) {
+      return; // ya aplicado
+    }
+    lastSeqs[payload._epoch] = payload._seq;
+  }
+  handler?.(payload);
+};
+
 export const initSocket = (role: string, callbacks: any) => {
   if (socket && socket.connected) {
     socket.disconnect();
@@ -28,23 +95,50 @@ export const initSocket = (role: string, callbacks: any) => {
   socket.on('connect', () => {
     console.log('Socket connected:', socket?.id);
     socket?.emit('set_role', { role });
+    if (Object.keys(lastSeqs).length > 0) {
+      socket?.emit('resume', { seqs: lastSeqs });
+    }
+    callbacks.onConnect?.();
+  });
+
+  socket.on('connection_established', (data: { epoch: string; seq: number; seqs?: Record<string, number> }) => {
+    if (Object.keys(lastSeqs).length === 0) {
+      lastSeqs = { ...(data.seqs ?? { [data.epoch]: data.seq }) };
+    }
+  });
+
+  socket.on('sync_data', (data: any) => {
+    lastSeqs = { ...(data.seqs ?? { [data.epoch]: data.seq }) };
+    callbacks.onSyncData?.(data);
+  });
+
+  // El servidor descartó nuestra cola de eventos por ir demasiado atrasados
+  socket.on('resync_required', () => {
+    socket?.emit('sync_request', {});
+  });
+
+  socket.on('sync_busy', (data: { retry_after: number }) => {
+    setTimeout(() => socket?.emit('sync_request', {}), data.retry_after * 1000);
   });
 
   socket.on('disconnect', () => {
     console.log('Socket disconnected');
   });
 
-  socket.on('order_created', callbacks.onOrderCreated);
-  socket.on('order_updated', callbacks.onOrderUpdated);
-  socket.on('order_deleted', callbacks.onOrderDeleted);
-  socket.on('product_created', callbacks.onProductCreated);
-  socket.on('product_updated', callbacks.onProductUpdated);
-  socket.on('product_deleted', callbacks.onProductDeleted);
-  socket.on('category_created', callbacks.onCategoryCreated);
-  socket.on('category_updated', callbacks.onCategoryUpdated);
-  socket.on('category_deleted', callbacks.onCategoryDeleted);
+  socket.on('order_created', sequenced(callbacks.onOrderCreated));
+  socket.on('order_updated', sequenced(callbacks.onOrderUpdated));
+  socket.on('order_deleted', sequenced(callbacks.onOrderDeleted));
+  socket.on('product_created', sequenced(callbacks.onProductCreated));
+  socket.on('product_updated', sequenced(callbacks.onProductUpdated));
+  socket.on('product_deleted', sequenced(callbacks.onProductDeleted));
+  socket.on('catalog_replaced', sequenced(callbacks.onCatalogReplaced));
+  socket.on('category_created', sequenced(callbacks.onCategoryCreated));
+  socket.on('category_updated', sequenced(callbacks.onCategoryUpdated));
+  socket.on('category_deleted', sequenced(callbacks.onCategoryDeleted));
   socket.on('notification', callbacks.onNotification);
-  socket.on('daily_closure_created', callbacks.onDailyClosureCreated);
+  socket.on('daily_closure_created', sequenced(callbacks.onDailyClosureCreated));
+  socket.on('sync_batch_applied', sequenced(callbacks.onSyncBatchApplied));
+  socket.on('daily_stats_delta', sequenced(callbacks.onDailyStatsDelta));
 
   return socket;
 };
@@ -64,14 +158,34 @@ export const syncData = () => {
 
 // API methods
 export const api = {
+  // Menu: categorías con sus productos en una sola petición
+  getMenu: async () => {
+    const response = await apiFetch(`${API_URL}/menu`, {
+      headers: menuEtag && cachedMenu ? { 'If-None-Match': menuEtag } : {},
+    });
+    if (response.status === 304 && cachedMenu) {
+      return cachedMenu;
+    }
+    cachedMenu = await response.json();
+    menuEtag = response.headers.get('ETag');
+    return cachedMenu;
+  },
+
   // Products
   getProducts: async () => {
-    const response = await fetch(`${API_URL}/products`);
+    const response = await apiFetch(`${API_URL}/products`);
+    return response.json();
+  },
+
+  searchProducts: async (query: string, category?: string) => {
+    const params = new URLSearchParams({ q: query });
+    if (category) params.append('category', category);
+    const response = await apiFetch(`${API_URL}/products/search?${params}`);
     return response.json();
   },
 
   createProduct: async (product: any) => {
-    const response = await fetch(`${API_URL}/products`, {
+    const response = await apiFetch(`${API_URL}/products`, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify(product),
@@ -80,7 +194,7 @@ export const api = {
   },
 
   updateProduct: async (id: string, product: any) => {
-    const response = await fetch(`${API_URL}/products/${id}`, {
+    const response = await apiFetch(`${API_URL}/products/${id}`, {
       method: 'PUT',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify(product),
@@ -89,7 +203,7 @@ export const api = {
   },
 
   deleteProduct: async (id: string) => {
-    const response = await fetch(`${API_URL}/products/${id}`, {
+    const response = await apiFetch(`${API_URL}/products/${id}`, {
       method: 'DELETE',
     });
     return response.json();
@@ -97,30 +211,30 @@ export const api = {
 
   // Orders
   getOrders: async () => {
-    const response = await fetch(`${API_URL}/orders`);
+    const response = await apiFetch(`${API_URL}/orders`);
     return response.json();
   },
 
-  createOrder: async (order: any) => {
-    const response = await fetch(`${API_URL}/orders`, {
+  createOrder: async (order: any, key?: string) => {
+    const response = await idempotentFetch(`${API_URL}/orders`, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify(order),
-    });
+    }, key);
     return response.json();
   },
 
-  updateOrder: async (id: string, order: any) => {
-    const response = await fetch(`${API_URL}/orders/${id}`, {
+  updateOrder: async (id: string, order: any, key?: string) => {
+    const response = await idempotentFetch(`${API_URL}/orders/${id}`, {
       method: 'PUT',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify(order),
-    });
+    }, key);
     return response.json();
   },
 
   deleteOrder: async (id: string) => {
-    const response = await fetch(`${API_URL}/orders/${id}`, {
+    const response = await apiFetch(`${API_URL}/orders/${id}`, {
       method: 'DELETE',
     });
     return response.json();
@@ -128,12 +242,12 @@ export const api = {
 
   // Settings
   getSettings: async () => {
-    const response = await fetch(`${API_URL}/settings`);
+    const response = await apiFetch(`${API_URL}/settings`);
     return response.json();
   },
 
   updateSettings: async (settings: any) => {
-    const response = await fetch(`${API_URL}/settings`, {
+    const response = await apiFetch(`${API_URL}/settings`, {
       method: 'PUT',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify(settings),
@@ -143,7 +257,7 @@ export const api = {
 
   // Seed data
   seedData: async () => {
-    const response = await fetch(`${API_URL}/seed`, {
+    const response = await apiFetch(`${API_URL}/seed`, {
       method: 'POST',
     });
     return response.json();
@@ -154,12 +268,12 @@ export const api = {
 export const apiExtended = {
   // Categories
   getCategories: async () => {
-    const response = await fetch(`${API_URL}/categories`);
+    const response = await apiFetch(`${API_URL}/categories`);
     return response.json();
   },
 
   createCategory: async (category: any) => {
-    const response = await fetch(`${API_URL}/categories`, {
+    const response = await apiFetch(`${API_URL}/categories`, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify(category),
@@ -168,7 +282,7 @@ export const apiExtended = {
   },
 
   updateCategory: async (id: string, category: any) => {
-    const response = await fetch(`${API_URL}/categories/${id}`, {
+    const response = await apiFetch(`${API_URL}/categories/${id}`, {
       method: 'PUT',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify(category),
@@ -177,7 +291,7 @@ export const apiExtended = {
   },
 
   deleteCategory: async (id: string) => {
-    const response = await fetch(`${API_URL}/categories/${id}`, {
+    const response = await apiFetch(`${API_URL}/categories/${id}`, {
       method: 'DELETE',
     });
     return response.json();
@@ -186,18 +300,24 @@ export const apiExtended = {
   // Daily Stats
   getDailyStats: async (date?: string) => {
     const url = date ? `${API_URL}/daily-stats?date=${date}` : `${API_URL}/daily-stats`;
-    const response = await fetch(url);
+    const response = await apiFetch(url);
+    return response.json();
+  },
+
+  // Contadores en vivo del día; se mantienen al día con los eventos daily_stats_delta
+  getLiveDailyStats: async () => {
+    const response = await apiFetch(`${API_URL}/daily-stats/live`);
     return response.json();
   },
 
   // Daily Closures
   getDailyClosures: async (limit: number = 30) => {
-    const response = await fetch(`${API_URL}/daily-closures?limit=${limit}`);
+    const response = await apiFetch(`${API_URL}/daily-closures?limit=${limit}`);
     return response.json();
   },
 
   createDailyClosure: async (closure: any) => {
-    const response = await fetch(`${API_URL}/daily-closures`, {
+    const response = await apiFetch(`${API_URL}/daily-closures`, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify(closure),
@@ -206,19 +326,53 @@ export const apiExtended = {
   },
 
   getWeeklyStats: async () => {
-    const response = await fetch(`${API_URL}/weekly-stats`);
+    const response = await apiFetch(`${API_URL}/weekly-stats`);
+    return response.json();
+  },
+
+  // Cobrado por método (efectivo/tarjeta) según el libro de pagos; días YYYY-MM-DD
+  getPaymentTotals: async (from?: string, to?: string) => {
+    const params = new URLSearchParams();
+    if (from) params.append('from', from);
+    if (to) params.append('to', to);
+    const response = await apiFetch(`${API_URL}/payments/totals?${params}`);
     return response.json();
   },
 
   // Partial Payments
-  addPartialPayment: async (orderId: string, payment: any) => {
-    const response = await fetch(`${API_URL}/orders/${orderId}/partial-payment`, {
+  addPartialPayment: async (orderId: string, payment: any, key?: string) => {
+    const response = await idempotentFetch(`${API_URL}/orders/${orderId}/partial-payment`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(payment),
+    }, key);
+    return response.json();
+  },
+
+  // Cuenta conjunta de pedidos unificados
+  getBill: async (orderId: string) => {
+    const response = await apiFetch(`${API_URL}/orders/${orderId}/bill`);
+    return response.json();
+  },
+
+  payBill: async (orderId: string, payment: any) => {
+    const response = await idempotentFetch(`${API_URL}/orders/${orderId}/bill`, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify(payment),
     });
     return response.json();
   },
+
+  // Offline sync: reproduce la cola de operaciones en una sola llamada
+  syncBatch: async (operations: any[], clientId?: string) => {
+    const response = await apiFetch(`${API_URL}/sync/batch`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ client_id: clientId, operations }),
+    });
+    return response.json();
+  },
 };
 
 // Combine both APIs
@@ -261,3 +415,33 @@ export const offlineStorage = {
     return await AsyncStorage.getItem('user_role');
   },
 };
+
+// Cambios de pedidos hechos sin conexión; al reconectar se envían todos juntos a /sync/batch
+export const offlineQueue = {
+  getOps: async (): Promise<any[]> => {
+    const data = await AsyncStorage.getItem('offline_ops');
+    return data ? JSON.parse(data) : [];
+  },
+
+  // Devuelve el id del pedido: para create_order, un id local que el servidor traduce al real.
+  // opId: la Idempotency-Key con la que ya se intentó online, si la hubo
+  enqueue: async (type: string, orderId: string | null, data?: any, opId: string = newId()) => {
+    const ops = await offlineQueue.getOps();
+    const order_id = orderId || `local-${newId()}`;
+    ops.push({ op_id: opId, type, order_id, data });
+    await AsyncStorage.setItem('offline_ops', JSON.stringify(ops));
+    return order_id;
+  },
+
+  // Las operaciones respondidas (aplicadas, duplicadas o rechazadas) salen de la cola;
+  // si la llamada falla se quedan todas para el siguiente intento
+  flush: async (clientId?: string) => {
+    const ops = await offlineQueue.getOps();
+    if (ops.length === 0) return null;
+    const result = await apiExtended.syncBatch(ops, clientId);
+    const answered = new Set(result.results.map((r: any) => r.op_id));
+    const remaining = (await offlineQueue.getOps()).filter((op) => !answered.has(op.op_id));
+    await AsyncStorage.setItem('offline_ops', JSON.stringify(remaining));
+    return result;
+  },
+};
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Load simulator for El Rincón del Laurel - Dinner rush replay.
+
+Drives the backend either in-process (the ASGI `socket_app` from
+backend/server.py against a local mongod) or against a running server,
+replaying a realistic service: N waiters creating orders, adding items,
+taking partial payments, the kitchen flipping statuses, admins polling
+stats, and the daily closure at the end.
+
+Reports throughput and p50/p95/p99 latency per endpoint.
+
+    python load_test.py --waiters 8 --tables 40
+    python load_test.py --url http://localhost:8001/api --waiters 20
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+
+import httpx
+
+ZONES = ['terraza_exterior', 'salon_interior', 'terraza_interior', 'barra']
+WAITER_ROLES = ['camarero_1', 'camarero_2', 'barra']
+PAYMENT_METHODS = ['efectivo', 'tarjeta']
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class LatencyRecorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    async def call(self, client, method, route, path, **kwargs):
+        """Time one request; `route` is the templated name used for grouping"""
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, path, **kwargs)
+        except Exception:
+            self.errors[route] += 1
+            raise
+        finally:
+            self.samples[route].append((time.perf_counter() - start) * 1000)
+        if response.status_code >= 400:
+            self.errors[route] += 1
+        return response
+
+    def report(self, elapsed):
+        total = sum(len(v) for v in self.samples.values())
+        print("\n" + "=" * 96)
+        print(f"{'endpoint':40} {'count':>7} {'err':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        print("-" * 96)
+        for route in sorted(self.samples):
+            values = sorted(self.samples[route])
+            print(f"{route:40} {len(values):7d} {self.errors[route]:5d} {len(values) / elapsed:8.1f} "
+                  f"{percentile(values, 50):8.1f} {percentile(values, 95):8.1f} "
+                  f"{percentile(values, 99):8.1f} {values[-1]:8.1f}")
+        print("-" * 96)
+        print(f"Total: {total} requests in {elapsed:.1f}s -> {total / elapsed:.1f} req/s, "
+              f"{sum(self.errors.values())} errors")
+        print("=" * 96)
+
+
+class DinnerRushSimulator:
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.recorder = LatencyRecorder()
+        self.products = []
+        self.kitchen_queue = asyncio.Queue()
+        self.rng = random.Random(args.seed)
+
+    async def setup(self):
+        await self.recorder.call(self.client, 'POST', 'POST /seed', '/seed')
+        response = await self.recorder.call(self.client, 'GET', 'GET /products', '/products')
+        self.products = response.json()
+        if not self.products:
+            raise RuntimeError("No hay productos tras /seed")
+
+    def pick_lines(self, count):
+        lines = []
+        for product in self.rng.sample(self.products, min(count, len(self.products))):
+            lines.append({
+                'product_id': product['_id'],
+                'name': product['name'],
+                'category': product['category'],
+                'price': product['price'],
+                'quantity': self.rng.randint(1, 4),
+            })
+        return lines
+
+    async def waiter(self, index):
+        role = WAITER_ROLES[index % len(WAITER_ROLES)]
+        for _ in range(self.args.tables):
+            lines = self.pick_lines(self.rng.randint(1, 4))
+            order = {
+                'table_number': self.rng.randint(1, 30),
+                'zone': self.rng.choice(ZONES),
+                'waiter_role': role,
+                'products': lines,
+                'total': sum(p['price'] * p['quantity'] for p in lines),
+            }
+            response = await self.recorder.call(
+                self.client, 'POST', 'POST /orders', '/orders', json=order,
+                headers={'Idempotency-Key': str(uuid.uuid4())}
+            )
+            if response.status_code != 200:
+                continue
+            created = response.json()
+            order_id = created['_id']
+            await asyncio.sleep(self.rng.uniform(0, self.args.think_time))
+
+            # Otra ronda de bebidas
+            for _ in range(self.rng.randint(0, 2)):
+                created['products'] = created['products'] + self.pick_lines(1)
+                response = await self.recorder.call(
+                    self.client, 'PUT', 'PUT /orders/{id}', f'/orders/{order_id}', json=created
+                )
+                if response.status_code == 200:
+                    created = response.json()
+                await asyncio.sleep(self.rng.uniform(0, self.args.think_time))
+
+            await self.kitchen_queue.put(order_id)
+
+            # Cuenta dividida
+            if self.rng.random() < 0.5 and created.get('pending_amount', 0) > 1:
+                await self.recorder.call(
+                    self.client, 'POST', 'POST /orders/{id}/partial-payment',
+                    f'/orders/{order_id}/partial-payment',
+                    json={'amount': round(created['pending_amount'] / 2, 2),
+                          'payment_method': self.rng.choice(PAYMENT_METHODS)}
+                )
+
+    async def kitchen(self):
+        while True:
+            order_id = await self.kitchen_queue.get()
+            try:
+                response = await self.recorder.call(self.client, 'GET', 'GET /orders/{id}', f'/orders/{order_id}')
+                if response.status_code != 200:
+                    continue
+                order = response.json()
+                for status in ('preparando', 'listo', 'entregado'):
+                    order['status'] = status
+                    if status == 'entregado':
+                        order['payment_method'] = 'ambos' if order.get('partial_payments') else self.rng.choice(PAYMENT_METHODS)
+                    response = await self.recorder.call(
+                        self.client, 'PUT', 'PUT /orders/{id}', f'/orders/{order_id}', json=order
+                    )
+                    if response.status_code == 200:
+                        order = response.json()
+                    await asyncio.sleep(self.rng.uniform(0, self.args.think_time))
+            finally:
+                self.kitchen_queue.task_done()
+
+    async def admin_poller(self, stop):
+        while not stop.is_set():
+            await self.recorder.call(self.client, 'GET', 'GET /orders', '/orders')
+            await self.recorder.call(self.client, 'GET', 'GET /daily-stats', '/daily-stats')
+            await self.recorder.call(self.client, 'GET', 'GET /weekly-stats', '/weekly-stats')
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=self.args.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def daily_closure(self):
+        response = await self.recorder.call(self.client, 'GET', 'GET /daily-stats', '/daily-stats')
+        stats = response.json()
+        closure = {
+            'date': datetime.utcnow().isoformat(),
+            'total_sales': stats.get('total_sales', 0),
+            'cash_sales': stats.get('cash_sales', 0),
+            'card_sales': stats.get('card_sales', 0),
+            'mixed_sales': stats.get('mixed_sales', 0),
+            'total_orders': stats.get('total_orders', 0),
+            'zone_breakdown': stats.get('zone_breakdown', {}),
+            'closed_by': 'load_test',
+        }
+        await self.recorder.call(self.client, 'POST', 'POST /daily-closures', '/daily-closures', json=closure)
+
+    async def run(self):
+        await self.setup()
+        print(f"🍽️  Servicio: {self.args.waiters} camareros x {self.args.tables} mesas, "
+              f"{self.args.cooks} en cocina, {self.args.admins} pantallas admin")
+
+        stop = asyncio.Event()
+        cooks = [asyncio.create_task(self.kitchen()) for _ in range(self.args.cooks)]
+        admins = [asyncio.create_task(self.admin_poller(stop)) for _ in range(self.args.admins)]
+
+        start = time.perf_counter()
+        await asyncio.gather(*(self.waiter(i) for i in range(self.args.waiters)))
+        await self.kitchen_queue.join()
+        stop.set()
+        await asyncio.gather(*admins)
+        for cook in cooks:
+            cook.cancel()
+
+        await self.daily_closure()
+        elapsed = time.perf_counter() - start
+        self.recorder.report(elapsed)
+        return sum(self.recorder.errors.values()) == 0
+
+
+async def run_in_process(args):
+    os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+    os.environ.setdefault('DB_NAME', 'rincon_load_test')
+    sys.path.insert(0, str(Path(__file__).parent / 'backend'))
+    import server
+
+    # El log de cada petición falsearía las latencias
+    logging.getLogger('server').setLevel(logging.ERROR)
+
+    # Base de datos desechable para que el cierre del día no choque con uno previo
+    await server.client.drop_database(os.environ['DB_NAME'])
+    await server.create_indexes()
+
+    transport = httpx.ASGITransport(app=server.socket_app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://loadtest/api', timeout=60) as client:
+        return await DinnerRushSimulator(client, args).run()
+
+
+async def run_remote(args):
+    limits = httpx.Limits(max_connections=args.waiters + args.cooks + args.admins + 4)
+    async with httpx.AsyncClient(base_url=args.url, timeout=60, limits=limits) as client:
+        return await DinnerRushSimulator(client, args).run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help="API base URL (e.g. http://localhost:8001/api); in-process if omitted")
+    parser.add_argument('--waiters', type=int, default=6)
+    parser.add_argument('--tables', type=int, default=25, help="orders per waiter")
+    parser.add_argument('--cooks', type=int, default=2)
+    parser.add_argument('--admins', type=int, default=2, help="devices polling stats")
+    parser.add_argument('--think-time', type=float, default=0.05, help="max seconds between a waiter's actions")
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    ok = asyncio.run(run_remote(args) if args.url else run_in_process(args))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
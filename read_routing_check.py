@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Check read-preference routing against a local three-member replica set.
+
+Start one (for example with three `mongod --replSet rs0 --port 2701X`
+processes and `rs.initiate()`), then:
+
+    MONGO_URL="mongodb://localhost:27017,localhost:27018,localhost:27019/?replicaSet=rs0" \\
+        python read_routing_check.py
+
+The backend is driven in-process; a pymongo command listener records which
+member served every command. Order and payment commands must go to the
+primary, while analytics and history reads must go to a secondary.
+"""
+
+import asyncio
+import os
+import sys
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+
+import httpx
+from pymongo import monitoring
+
+READ_COMMANDS = {'find', 'aggregate', 'count', 'getMore'}
+
+
+class ServerRecorder(monitoring.CommandListener):
+    def __init__(self):
+        self.current_step = None
+        self.servers = defaultdict(set)  # paso -> {(comando, host:puerto)}
+
+    def started(self, event):
+        if self.current_step:
+            host, port = event.connection_id
+            self.servers[self.current_step].add((event.command_name, f"{host}:{port}"))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+recorder = ServerRecorder()
+monitoring.register(recorder)
+
+
+async def main():
+    if 'replicaSet=' not in os.environ.get('MONGO_URL', ''):
+        print("❌ MONGO_URL debe apuntar a un replica set local (…?replicaSet=rs0)")
+        return False
+    os.environ.setdefault('DB_NAME', 'rincon_read_routing')
+    sys.path.insert(0, str(Path(__file__).parent / 'backend'))
+    import server
+
+    await server.client.drop_database(os.environ['DB_NAME'])
+    await server.create_indexes()
+    hello = await server.client.admin.command('hello')
+    primary = hello['primary']
+    print(f"Primario: {primary} · secundarios: {', '.join(h for h in hello['hosts'] if h != primary)}")
+    print(f"ANALYTICS_READ_PREFERENCE={server.ANALYTICS_READ_PREFERENCE}")
+
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://check/api') as api:
+        await api.post('/seed')
+        product = (await api.get('/products')).json()[0]
+        line = {'product_id': product['_id'], 'name': product['name'],
+                'category': product['category'], 'price': product['price']}
+
+        async def step(name, method, path, **kwargs):
+            recorder.current_step = name
+            try:
+                response = await api.request(method, path, **kwargs)
+            finally:
+                recorder.current_step = None
+            if response.status_code >= 400:
+                print(f"   ⚠️  {name}: HTTP {response.status_code}")
+            return response
+
+        order = (await step('orders: create', 'POST', '/orders', json={
+            'table_number': 1, 'waiter_role': 'camarero_1', 'products': [line], 'total': line['price']
+        })).json()
+        await step('orders: partial payment', 'POST', f"/orders/{order['_id']}/partial-payment",
+                   json={'amount': 1, 'payment_method': 'efectivo'})
+        order['status'] = 'entregado'
+        await step('orders: update', 'PUT', f"/orders/{order['_id']}", json=order)
+
+        # Dar tiempo a los secundarios a replicar
+        await asyncio.sleep(2)
+
+        await step('analytics: daily-stats', 'GET', '/daily-stats')
+        await step('analytics: weekly-stats', 'GET', '/weekly-stats')
+        await step('analytics: daily-closures', 'GET', '/daily-closures')
+        await step('analytics: top-products', 'GET', '/analytics/top-products')
+        await step('analytics: heatmap', 'GET', '/analytics/heatmap',
+                   params={'from': datetime.utcnow().strftime('%Y-%m-%d')})
+        await step('analytics: sales cube', 'GET', '/analytics/status')
+
+    ok = True
+    for name, calls in recorder.servers.items():
+        reads = {host for command, host in calls if command in READ_COMMANDS}
+        writes = {host for command, host in calls if command not in READ_COMMANDS}
+        if name.startswith('orders'):
+            passed = reads <= {primary} and writes <= {primary}
+        else:
+            passed = bool(reads) and primary not in reads
+        ok &= passed
+        status = "✅ PASSED" if passed else "❌ FAILED"
+        print(f"{status} - {name:30} reads={sorted(reads)} writes={sorted(writes)}")
+
+    await server.client.drop_database(os.environ['DB_NAME'])
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(main()) else 1)
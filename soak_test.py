@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Soak test for El Rincón del Laurel - memory growth over a long service.
+
+Keeps the backend busy for --minutes with two loops:
+
+  * socket churn: waves of Socket.IO clients connect, call `set_role` and
+    `sync_request`, wait for `sync_data` and disconnect;
+  * order lifecycles: create, add a round, partial payment,
+    preparando -> listo -> entregado, delete.
+
+Every --sample-every seconds it reads /api/admin/memory (RSS, the server's
+in-memory structures, live objects by type). With --tracemalloc, tracing
+starts after the warm-up and the final report lists the lines of
+backend/server.py whose allocations grew the most. At the end RSS growth
+is fitted per hour; the run fails above --max-growth-mb-per-hour or if
+client bookkeeping is left behind once every socket has disconnected.
+
+By default the server runs in-process with uvicorn against a throwaway
+database on a local mongod (the simulated clients share its RSS); use
+--url and --admin-token for a running server.
+
+    python soak_test.py --minutes 60 --clients 200 --tracemalloc
+    python soak_test.py --url http://localhost:8001 --admin-token "$ADMIN_TOKEN" --minutes 840
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import socket
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import httpx
+import socketio
+
+ROLES = ['camarero_1', 'camarero_2', 'barra', 'administrador']
+PAYMENT_METHODS = ['efectivo', 'tarjeta']
+
+# Estructuras que deben volver a cero cuando no queda ningún socket conectado
+CLIENT_STRUCTURES = ('connected_clients', 'socketio_sessions', 'flow_control_clients', 'flow_control_pending')
+
+
+def growth_per_hour(points):
+    """Least-squares slope of (seconds, MB) points, in MB per hour"""
+    if len(points) < 2:
+        return 0.0
+    n = len(points)
+    mean_t = sum(t for t, _ in points) / n
+    mean_v = sum(v for _, v in points) / n
+    var_t = sum((t - mean_t) ** 2 for t, _ in points)
+    if var_t == 0:
+        return 0.0
+    slope = sum((t - mean_t) * (v - mean_v) for t, v in points) / var_t
+    return slope * 3600
+
+
+class SoakTest:
+    def __init__(self, url, args):
+        self.url = url
+        self.args = args
+        self.admin = {'X-Admin-Token': args.admin_token}
+        self.rng = random.Random(args.seed)
+        self.samples = []  # (segundos, /admin/memory)
+        self.counts = {'socket_cycles': 0, 'socket_errors': 0, 'orders': 0, 'order_errors': 0}
+
+    async def socket_wave(self):
+        semaphore = asyncio.Semaphore(self.args.connect_concurrency)
+
+        async def cycle(index):
+            client = socketio.AsyncClient(reconnection=False)
+            synced = asyncio.Event()
+
+            async def on_sync_busy(data):
+                await asyncio.sleep(data.get('retry_after', 1))
+                if client.connected:
+                    await client.emit('sync_request', {})
+
+            client.on('sync_data', lambda data: synced.set())
+            client.on('sync_busy', on_sync_busy)
+            try:
+                async with semaphore:
+                    await client.connect(self.url, transports=['websocket'], wait_timeout=self.args.timeout)
+                await client.emit('set_role', {'role': ROLES[index % len(ROLES)]})
+                await client.emit('sync_request', {})
+                await asyncio.wait_for(synced.wait(), self.args.timeout)
+            finally:
+                if client.connected:
+                    await client.disconnect()
+
+        results = await asyncio.gather(*(cycle(i) for i in range(self.args.clients)), return_exceptions=True)
+        errors = sum(1 for r in results if isinstance(r, Exception))
+        self.counts['socket_cycles'] += len(results) - errors
+        self.counts['socket_errors'] += errors
+
+    async def socket_churn(self, stop):
+        while not stop.is_set():
+            await self.socket_wave()
+            await asyncio.sleep(self.args.wave_interval)
+
+    def pick_line(self, products):
+        product = self.rng.choice(products)
+        return {'product_id': product['_id'], 'name': product['name'], 'category': product['category'],
+                'price': product['price'], 'quantity': self.rng.randint(1, 3)}
+
+    async def order_lifecycle(self, http, products):
+        lines = [self.pick_line(products) for _ in range(self.rng.randint(1, 4))]
+        response = await http.post('/orders', json={
+            'table_number': self.rng.randint(1, 30),
+            'waiter_role': self.rng.choice(ROLES[:3]),
+            'products': lines,
+            'total': sum(l['price'] * l['quantity'] for l in lines),
+        }, headers={'Idempotency-Key': str(uuid.uuid4())})
+        response.raise_for_status()
+        order = response.json()
+
+        order['products'] = order['products'] + [self.pick_line(products)]
+        order = (await http.put(f"/orders/{order['_id']}", json=order)).raise_for_status().json()
+
+        await http.post(f"/orders/{order['_id']}/partial-payment", json={
+            'amount': round(order['pending_amount'] / 2, 2), 'payment_method': self.rng.choice(PAYMENT_METHODS)
+        })
+        order = (await http.get(f"/orders/{order['_id']}")).raise_for_status().json()
+
+        for status in ('preparando', 'listo', 'entregado'):
+            order['status'] = status
+            if status == 'entregado':
+                order['payment_method'] = 'ambos'
+            order = (await http.put(f"/orders/{order['_id']}", json=order)).raise_for_status().json()
+
+        # Borrar mantiene la base de datos estable: lo que crezca es memoria del proceso
+        (await http.delete(f"/orders/{order['_id']}")).raise_for_status()
+
+    async def order_cycles(self, http, stop):
+        products = (await http.get('/products')).json()
+        while not stop.is_set():
+            try:
+                await self.order_lifecycle(http, products)
+                self.counts['orders'] += 1
+            except Exception:
+                self.counts['order_errors'] += 1
+            await asyncio.sleep(self.args.order_interval)
+
+    async def sample(self, http, start):
+        memory = (await http.get('/admin/memory', params={'objects': 30}, headers=self.admin)).raise_for_status().json()
+        elapsed = time.monotonic() - start
+        self.samples.append((elapsed, memory))
+        s = memory['structures']
+        print(f"[{elapsed / 60:7.1f} min] RSS {memory['rss_mb'] or 0:7.1f} MB  clientes {s['connected_clients']:5d}  "
+              f"caché {s['read_cache_entries']:4d}  idempotencia {s['idempotency_cache']:5d}  tareas {s['asyncio_tasks']:4d}  "
+              f"sockets {self.counts['socket_cycles']:7d} ({self.counts['socket_errors']} err)  "
+              f"pedidos {self.counts['orders']:6d} ({self.counts['order_errors']} err)")
+        return memory
+
+    async def run(self):
+        async with httpx.AsyncClient(base_url=f"{self.url}/api", timeout=60) as http:
+            if (await http.get('/admin/memory', headers=self.admin)).status_code != 200:
+                print("❌ /api/admin/memory no accesible: revisa ADMIN_TOKEN / --admin-token")
+                return False
+            await http.post('/seed')
+
+            stop = asyncio.Event()
+            start = time.monotonic()
+            duration = self.args.minutes * 60
+            warmup = duration * self.args.warmup
+            tracing = False
+            workers = [asyncio.create_task(self.socket_churn(stop))]
+            workers += [asyncio.create_task(self.order_cycles(http, stop)) for _ in range(self.args.order_workers)]
+
+            print(f"🔁 Soak de {self.args.minutes} min: oleadas de {self.args.clients} sockets, "
+                  f"{self.args.order_workers} ciclos de pedidos en paralelo (calentamiento {warmup / 60:.1f} min)")
+            try:
+                while time.monotonic() - start < duration:
+                    await asyncio.sleep(min(self.args.sample_every, max(0.0, duration - (time.monotonic() - start))))
+                    await self.sample(http, start)
+                    if self.args.tracemalloc and not tracing and time.monotonic() - start >= warmup:
+                        await http.post('/admin/memory/tracemalloc/start', params={'frames': 25}, headers=self.admin)
+                        tracing = True
+                        print("🔬 tracemalloc activado (referencia tras el calentamiento)")
+            finally:
+                stop.set()
+                await asyncio.gather(*workers, return_exceptions=True)
+
+            # Dejar que se procesen las últimas desconexiones
+            await asyncio.sleep(self.args.settle)
+            final = await self.sample(http, start)
+            diff = None
+            if tracing:
+                diff = (await http.get('/admin/memory/tracemalloc/diff', params={'limit': 15},
+                                       headers=self.admin)).raise_for_status().json()
+                await http.post('/admin/memory/tracemalloc/stop', headers=self.admin)
+
+        return self.report(final, diff, warmup)
+
+    def report(self, final, diff, warmup):
+        steady = [(t, m['rss_mb']) for t, m in self.samples if t >= warmup and m['rss_mb'] is not None]
+        slope = growth_per_hour(steady)
+        first_steady = next((m for t, m in self.samples if t >= warmup), self.samples[0][1])
+
+        print("\n" + "=" * 96)
+        if steady:
+            print(f"RSS: {steady[0][1]:.1f} MB -> {steady[-1][1]:.1f} MB tras el calentamiento; "
+                  f"tendencia {slope:+.1f} MB/hora (límite {self.args.max_growth_mb_per_hour} MB/hora)")
+
+        print("\nEstructuras del servidor (tras el calentamiento -> final):")
+        for name, value in final['structures'].items():
+            before = first_steady['structures'].get(name, 0)
+            marker = '  ⚠️' if value > before else ''
+            print(f"  {name:26} {before:8d} -> {value:8d}{marker}")
+
+        before_counts = {o['type']: o['count'] for o in first_steady['objects']}
+        growing = sorted(
+            ((o['type'], o['count'] - before_counts.get(o['type'], 0)) for o in final['objects']),
+            key=lambda item: -item[1]
+        )
+        print("\nTipos de objeto que más crecen:")
+        for name, delta in growing[:10]:
+            print(f"  {name:40} {delta:+10d}")
+
+        if diff:
+            print(f"\ntracemalloc desde {diff['since']}: {diff['total_diff_kb']:+.1f} KB")
+            for entry in diff['top']:
+                print(f"  {entry['size_diff_kb']:+10.1f} KB {entry['count_diff']:+8d} obj  {entry['where']:28} "
+                      f"{entry.get('source', '')[:60]}")
+
+        leaked = {name: final['structures'][name] for name in CLIENT_STRUCTURES if final['structures'][name] > 0}
+        ok = slope <= self.args.max_growth_mb_per_hour and not leaked
+        if leaked:
+            print(f"\n❌ Quedan restos de clientes desconectados: {leaked}")
+        print(f"\n{'✅ PASSED' if ok else '❌ FAILED'} - {self.counts['socket_cycles']} ciclos de socket, "
+              f"{self.counts['orders']} pedidos completos")
+        print("=" * 96)
+        return ok
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def run_in_process(args):
+    os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+    os.environ.setdefault('DB_NAME', 'rincon_soak_test')
+    os.environ['ADMIN_TOKEN'] = args.admin_token
+    sys.path.insert(0, str(Path(__file__).parent / 'backend'))
+    import server
+    import uvicorn
+
+    logging.getLogger('server').setLevel(logging.ERROR)
+    await server.client.drop_database(os.environ['DB_NAME'])
+
+    port = free_port()
+    config = uvicorn.Config(server.socket_app, host='127.0.0.1', port=port, log_level='warning')
+    uv = uvicorn.Server(config)
+    serving = asyncio.create_task(uv.serve())
+    while not uv.started:
+        await asyncio.sleep(0.05)
+    try:
+        return await SoakTest(f"http://127.0.0.1:{port}", args).run()
+    finally:
+        uv.should_exit = True
+        await serving
+        await server.client.drop_database(os.environ['DB_NAME'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help="server base URL (e.g. http://localhost:8001); in-process if omitted")
+    parser.add_argument('--admin-token', default=os.environ.get('ADMIN_TOKEN') or uuid.uuid4().hex,
+                        help="X-Admin-Token for /api/admin (defaults to $ADMIN_TOKEN)")
+    parser.add_argument('--minutes', type=float, default=30)
+    parser.add_argument('--clients', type=int, default=100, help="sockets per connect/disconnect wave")
+    parser.add_argument('--wave-interval', type=float, default=1.0, help="seconds between socket waves")
+    parser.add_argument('--connect-concurrency', type=int, default=50)
+    parser.add_argument('--order-workers', type=int, default=4)
+    parser.add_argument('--order-interval', type=float, default=0.05, help="seconds between a worker's orders")
+    parser.add_argument('--sample-every', type=float, default=30.0, help="seconds between memory samples")
+    parser.add_argument('--warmup', type=float, default=0.1, help="fraction of the run ignored for the trend")
+    parser.add_argument('--settle', type=float, default=3.0, help="seconds to wait for the last disconnects")
+    parser.add_argument('--tracemalloc', action='store_true', help="trace allocations after the warm-up")
+    parser.add_argument('--max-growth-mb-per-hour', type=float, default=20.0)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    if args.url:
+        ok = asyncio.run(SoakTest(args.url.rstrip('/'), args).run())
+    else:
+        ok = asyncio.run(run_in_process(args))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
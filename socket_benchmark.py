@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Socket.IO fan-out benchmark for El Rincón del Laurel.
+
+Connects hundreds or thousands of Socket.IO clients (each calling
+`set_role` like a tablet does), then measures:
+
+  * order events: time from the HTTP write that triggers `order_created` /
+    `order_updated` until each client receives it, plus the spread between
+    the first and the last client;
+  * notifications: same for the `notification` emitted when an order
+    becomes `listo`;
+  * reconnect storm: every client drops and reconnects at once and fires
+    `sync_request`; time until each gets its `sync_data`.
+
+By default the server runs in-process with uvicorn on a free port against
+a throwaway database on a local mongod; use --url for a running server.
+
+    python socket_benchmark.py --clients 500 --events 20
+    python socket_benchmark.py --url http://localhost:8001 --clients 2000
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import sys
+import time
+import uuid
+from collections import defaultdict
+from pathlib import Path
+
+import httpx
+import socketio
+
+ROLES = ['camarero_1', 'camarero_2', 'barra', 'administrador']
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def print_distribution(name, values):
+    values = sorted(values)
+    if not values:
+        print(f"{name:34} (sin muestras)")
+        return
+    print(f"{name:34} n={len(values):7d}  p50={percentile(values, 50):8.1f}  p95={percentile(values, 95):8.1f}  "
+          f"p99={percentile(values, 99):8.1f}  max={values[-1]:8.1f} ms")
+
+
+class BenchClient:
+    """One simulated tablet"""
+
+    def __init__(self, bench, index):
+        self.bench = bench
+        self.role = ROLES[index % len(ROLES)]
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.sync_received = asyncio.Event()
+        self.sio.on('order_created', self.on_order)
+        self.sio.on('order_updated', self.on_order)
+        self.sio.on('notification', self.on_notification)
+        self.sio.on('sync_data', self.on_sync_data)
+
+    async def connect(self):
+        await self.sio.connect(self.bench.url, transports=['websocket'], wait_timeout=30)
+        await self.sio.emit('set_role', {'role': self.role})
+
+    async def on_order(self, order):
+        self.bench.received(order.get('special_note'), time.perf_counter())
+
+    async def on_notification(self, notification):
+        self.bench.received(notification.get('order_id'), time.perf_counter())
+
+    async def on_sync_data(self, data):
+        self.sync_received.set()
+
+
+class FanOutBenchmark:
+    def __init__(self, url, args):
+        self.url = url
+        self.args = args
+        self.clients = []
+        self.receive_times = defaultdict(list)  # marcador -> tiempos de llegada
+
+    def received(self, marker, at):
+        if marker:
+            self.receive_times[marker].append(at)
+
+    async def connect_all(self):
+        semaphore = asyncio.Semaphore(self.args.connect_concurrency)
+        self.clients = [BenchClient(self, i) for i in range(self.args.clients)]
+
+        async def connect(client):
+            async with semaphore:
+                await client.connect()
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(connect(c) for c in self.clients), return_exceptions=True)
+        failures = [r for r in results if isinstance(r, Exception)]
+        self.clients = [c for c, r in zip(self.clients, results) if not isinstance(r, Exception)]
+        print(f"🔌 {len(self.clients)} clientes conectados en {time.perf_counter() - start:.1f}s "
+              f"({len(failures)} fallos)")
+
+    async def wait_for(self, marker, expected, timeout):
+        deadline = time.perf_counter() + timeout
+        while len(self.receive_times[marker]) < expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+
+    async def measure_orders(self, http):
+        latencies, spreads, notify_latencies = [], [], []
+        products = (await http.get('/products')).json()
+        product = products[0]
+        # send_notification solo emite si OneSignal está configurado
+        await http.put('/settings', json={'onesignal_app_id': 'bench', 'onesignal_api_key': 'bench'})
+
+        for _ in range(self.args.events):
+            marker = str(uuid.uuid4())
+            order = {
+                'table_number': 1,
+                'waiter_role': 'camarero_1',
+                'products': [{'product_id': product['_id'], 'name': product['name'],
+                              'category': product['category'], 'price': product['price']}],
+                'total': product['price'],
+                'special_note': marker,
+            }
+            sent = time.perf_counter()
+            created = (await http.post('/orders', json=order)).json()
+            await self.wait_for(marker, len(self.clients), self.args.timeout)
+            arrivals = self.receive_times.pop(marker, [])
+            latencies.extend((t - sent) * 1000 for t in arrivals)
+            if arrivals:
+                spreads.append((max(arrivals) - min(arrivals)) * 1000)
+
+            # listo -> order_updated + notification
+            created['status'] = 'listo'
+            sent = time.perf_counter()
+            await http.put(f"/orders/{created['_id']}", json=created)
+            await self.wait_for(created['_id'], len(self.clients), self.args.timeout)
+            notify_latencies.extend((t - sent) * 1000 for t in self.receive_times.pop(created['_id'], []))
+            self.receive_times.pop(marker, None)
+
+            await http.delete(f"/orders/{created['_id']}")
+            await asyncio.sleep(self.args.interval)
+
+        print("\n=== Fan-out de eventos ===")
+        print_distribution("order_created (write→recv)", latencies)
+        print_distribution("order_created (first→last)", spreads)
+        print_distribution("notification (write→recv)", notify_latencies)
+        expected = self.args.events * len(self.clients)
+        print(f"Entregas order_created: {len(latencies)}/{expected}")
+
+    async def reconnect_storm(self):
+        print("\n=== Tormenta de reconexión ===")
+        await asyncio.gather(*(c.sio.disconnect() for c in self.clients), return_exceptions=True)
+
+        async def reconnect(client):
+            client.sync_received.clear()
+            client.sio = socketio.AsyncClient(reconnection=False)
+            client.sio.on('order_created', client.on_order)
+            client.sio.on('order_updated', client.on_order)
+            client.sio.on('notification', client.on_notification)
+            client.sio.on('sync_data', client.on_sync_data)
+            start = time.perf_counter()
+            await client.connect()
+            connected = time.perf_counter()
+            await client.sio.emit('sync_request', {})
+            await asyncio.wait_for(client.sync_received.wait(), timeout=self.args.timeout)
+            return (connected - start) * 1000, (time.perf_counter() - connected) * 1000
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(reconnect(c) for c in self.clients), return_exceptions=True)
+        ok = [r for r in results if not isinstance(r, Exception)]
+        print(f"{len(ok)}/{len(self.clients)} clientes resincronizados en {time.perf_counter() - start:.1f}s")
+        print_distribution("reconnect (connect+set_role)", [r[0] for r in ok])
+        print_distribution("sync_request → sync_data", [r[1] for r in ok])
+
+    async def run(self):
+        async with httpx.AsyncClient(base_url=f"{self.url}/api", timeout=60) as http:
+            await http.post('/seed')
+            await self.connect_all()
+            await self.measure_orders(http)
+            await self.reconnect_storm()
+        await asyncio.gather(*(c.sio.disconnect() for c in self.clients), return_exceptions=True)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def run_in_process(args):
+    os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+    os.environ.setdefault('DB_NAME', 'rincon_socket_bench')
+    sys.path.insert(0, str(Path(__file__).parent / 'backend'))
+    import server
+    import uvicorn
+
+    logging.getLogger('server').setLevel(logging.ERROR)
+    await server.client.drop_database(os.environ['DB_NAME'])
+
+    port = free_port()
+    config = uvicorn.Config(server.socket_app, host='127.0.0.1', port=port, log_level='warning')
+    uv = uvicorn.Server(config)
+    serving = asyncio.create_task(uv.serve())
+    while not uv.started:
+        await asyncio.sleep(0.05)
+    try:
+        await FanOutBenchmark(f"http://127.0.0.1:{port}", args).run()
+    finally:
+        uv.should_exit = True
+        await serving
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help="server base URL (e.g. http://localhost:8001); in-process if omitted")
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--events', type=int, default=10, help="orders created (and flipped to listo)")
+    parser.add_argument('--interval', type=float, default=0.1, help="seconds between events")
+    parser.add_argument('--connect-concurrency', type=int, default=100)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    args = parser.parse_args()
+
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    if args.url:
+        asyncio.run(FanOutBenchmark(args.url.rstrip('/'), args).run())
+    else:
+        asyncio.run(run_in_process(args))
+
+
+if __name__ == "__main__":
+    main()
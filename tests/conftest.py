@@ -0,0 +1,63 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import httpx
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'rincon_test')
+os.environ.setdefault('ADMIN_TOKEN', 'test-admin-token')
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+import server  # noqa: E402
+
+ADMIN_HEADERS = {'X-Admin-Token': os.environ['ADMIN_TOKEN']}
+
+
+def make_order(**fields):
+    order = {
+        'table_number': 1,
+        'zone': 'salon_interior',
+        'waiter_role': 'camarero_1',
+        'products': [{'product_id': 'p1', 'name': 'Café Solo', 'category': 'Bebidas', 'price': 1.2, 'quantity': 2}],
+        'total': 2.4,
+    }
+    order.update(fields)
+    return order
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """An in-memory MongoDB behind server.db, with every per-tenant structure starting empty"""
+    mock = AsyncMongoMockClient()
+    monkeypatch.setattr(server, 'client', mock)
+    monkeypatch.setattr(server, 'transactions_supported', False)
+    for proxy in (server.db, server.analytics_db):
+        monkeypatch.setattr(proxy, '_databases', {})
+    for proxy in (server.event_log, server.read_cache, server.idempotency_store, server.product_search,
+                  server.menu_cache, server.sales_cube, server.heatmap_cache, server.product_sales_rebuild_flag):
+        monkeypatch.setattr(proxy, '_instances', {})
+
+    emitted = []
+
+    async def emit(event, data=None, **kwargs):
+        emitted.append((event, data))
+
+    monkeypatch.setattr(server.sio, 'emit', emit)
+    mock.emitted = emitted
+    return mock
+
+
+@pytest.fixture
+def api(mongo):
+    """Run a coroutine function against the app: api(lambda http: ...)"""
+    def run(scenario):
+        async def main():
+            transport = httpx.ASGITransport(app=server.app)
+            async with httpx.AsyncClient(transport=transport, base_url='http://test/api') as http:
+                return await scenario(http)
+        return asyncio.run(main())
+    return run
@@ -0,0 +1,37 @@
+import asyncio
+
+import server
+from tests.conftest import ADMIN_HEADERS, make_order
+
+
+def test_saturated_orders_class_answers_503_with_retry_after(api, monkeypatch):
+    limiter = server.admission_classes['orders']
+    monkeypatch.setattr(limiter, '_semaphore', asyncio.Semaphore(1))
+    monkeypatch.setattr(limiter, 'max_waiting', 0)
+    monkeypatch.setattr(limiter, 'timeout', 2.0)
+    monkeypatch.setattr(limiter, 'rejected', 0)
+
+    async def scenario(http):
+        # Una petición ocupa el único hueco y la cola no admite esperas
+        async with limiter.slot():
+            busy = await http.post('/orders', json=make_order(), headers={'Idempotency-Key': 'k1'})
+        assert busy.status_code == 503
+        assert busy.headers['Retry-After'] == '2'
+        assert limiter.rejected == 1
+
+        # El reintento con la misma clave entra cuando hay hueco y crea el pedido una sola vez
+        retried = await http.post('/orders', json=make_order(), headers={'Idempotency-Key': 'k1'})
+        assert retried.status_code == 200
+        assert await server.db.orders.count_documents({}) == 1
+
+    api(scenario)
+
+
+def test_diagnostics_are_admin_only(api):
+    async def scenario(http):
+        for path in ('/socket-clients/flow', '/admission', '/tickets/stats'):
+            assert (await http.get(path)).status_code == 404
+            assert (await http.get(f'/admin{path}')).status_code == 403
+            assert (await http.get(f'/admin{path}', headers=ADMIN_HEADERS)).status_code == 200
+
+    api(scenario)
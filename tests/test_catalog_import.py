@@ -0,0 +1,102 @@
+import pytest
+
+import server
+from server import change_to_event, parse_catalog_file
+
+
+@pytest.mark.parametrize('body', [
+    'name,category,price\nCafé Solo,Bebidas,1.20\nTostada,Desayunos,2.50\n',
+    'name;category;price\nCafé Solo;Bebidas;1,20\nTostada;Desayunos;2,50\n',
+    'name\tcategory\tprice\nCafé Solo\tBebidas\t1,2\nTostada\tDesayunos\t2.5\n',
+    '﻿Name ; Category ; Price\n Café Solo ; Bebidas ; 1,20 \nTostada;Desayunos;2,50\n',
+])
+def test_csv_delimiters_and_decimal_comma(body):
+    rows = parse_catalog_file(body.encode('utf-8'), 'text/csv')
+    assert [(r['name'], r['category'], float(r['price'])) for r in rows] == [
+        ('Café Solo', 'Bebidas', 1.2), ('Tostada', 'Desayunos', 2.5)
+    ]
+
+
+@pytest.mark.parametrize('body,content_type', [
+    (b'[{"name": "Caf\xc3\xa9 Solo", "category": "Bebidas", "price": 1.2}]', 'application/json'),
+    (b'{"products": [{"name": "Caf\xc3\xa9 Solo", "category": "Bebidas", "price": 1.2}]}', 'application/octet-stream'),
+])
+def test_json_list_or_products_object(body, content_type):
+    assert parse_catalog_file(body, content_type) == [{'name': 'Café Solo', 'category': 'Bebidas', 'price': 1.2}]
+
+
+def test_json_must_hold_a_list():
+    with pytest.raises(ValueError):
+        parse_catalog_file(b'{"products": 3}', 'application/json')
+
+
+async def seed_categories(*names):
+    await server.db.categories.insert_many([{'name': name} for name in names])
+
+
+def test_invalid_rows_are_reported_and_nothing_is_imported(api):
+    body = ('name;category;price\n'
+            'Café Solo;Bebidas;1,20\n'
+            'Tostada;Desayunos;gratis\n'
+            ';Bebidas;1\n'
+            'Vermut;Aperitivos;3\n'
+            'Café Solo;Bebidas;1,30\n')
+
+    async def scenario(http):
+        await seed_categories('Bebidas', 'Desayunos')
+        response = await http.post('/products/import', content=body.encode('utf-8'), headers={'Content-Type': 'text/csv'})
+        assert response.status_code == 422
+        errors = response.json()['detail']['errors']
+        assert [e['row'] for e in errors] == [2, 3, 4, 5]
+        assert errors[0]['error'].startswith('price:')
+        assert errors[1]['error'] == 'name is required'
+        assert errors[2]['error'] == 'unknown category: Aperitivos'
+        assert errors[3]['error'] == 'duplicate of row 1'
+        assert await server.db.products.count_documents({}) == 0
+
+    api(scenario)
+
+
+def test_replace_removes_missing_products_with_a_single_event(api, mongo):
+    async def scenario(http):
+        await seed_categories('Bebidas')
+        await server.db.products.insert_many([
+            {'name': 'Café Solo', 'category': 'Bebidas', 'price': 1.0},
+            {'name': 'Mosto', 'category': 'Bebidas', 'price': 1.5},
+        ])
+        response = await http.post('/products/import', params={'replace': 'true'},
+                                   json=[{'name': 'Café Solo', 'category': 'Bebidas', 'price': 1.2},
+                                         {'name': 'Caña', 'category': 'Bebidas', 'price': 2}])
+        assert response.status_code == 200, response.text
+        assert {k: response.json()[k] for k in ('inserted', 'updated', 'deleted')} == {'inserted': 1, 'updated': 1, 'deleted': 1}
+        products = await server.db.products.find({}, {'_id': 0, 'name': 1, 'price': 1}).to_list(None)
+        assert sorted(products, key=lambda p: p['name']) == [
+            {'name': 'Café Solo', 'price': 1.2}, {'name': 'Caña', 'price': 2}
+        ]
+
+    api(scenario)
+    assert [event for event, _ in mongo.emitted] == ['catalog_replaced']
+
+
+def product_change(operation, **fields):
+    return {'ns': {'coll': 'products'}, 'operationType': operation, 'documentKey': {'_id': 'p1'}, **fields}
+
+
+def test_bus_skips_the_deletes_of_a_replace_import():
+    removals = set()
+    tagged = product_change('update', updateDescription={'updatedFields': {'catalog_removed': 4}}, fullDocument=None)
+    assert change_to_event(tagged, removals) is None
+    assert change_to_event(product_change('delete'), removals) is None
+    assert removals == set()
+
+    # Un borrado desde el handler sí se emite
+    assert change_to_event(product_change('delete'), removals) == ('product_deleted', {'product_id': 'p1'})
+
+
+def test_bus_skips_import_upserts_but_not_handler_writes():
+    doc = {'_id': 'p1', 'name': 'Caña', 'category': 'Bebidas', 'price': 2}
+    imported = product_change('update', updateDescription={'updatedFields': {'price': 2, 'catalog_version': 4}},
+                              fullDocument=doc)
+    assert change_to_event(imported) is None
+    edited = product_change('update', updateDescription={'updatedFields': {'price': 2}}, fullDocument=dict(doc))
+    assert change_to_event(edited)[0] == 'product_updated'
@@ -0,0 +1,85 @@
+from datetime import datetime
+
+import server
+from tests.conftest import ADMIN_HEADERS, make_order
+
+
+async def close_day(http):
+    stats = (await http.get('/daily-stats')).json()
+    closure = {key: stats[key] for key in ('total_sales', 'cash_sales', 'card_sales', 'mixed_sales', 'total_orders')}
+    response = await http.post('/daily-closures', json={
+        **closure, 'date': datetime.utcnow().isoformat(), 'closed_by': 'administrador'
+    })
+    assert response.status_code == 200, response.text
+
+
+def test_live_counters_follow_delivered_orders(api):
+    async def scenario(http):
+        order = make_order(status='entregado', payment_method='efectivo')
+        order_id = (await http.post('/orders', json=order)).json()['_id']
+        live = (await http.get('/daily-stats/live')).json()
+        assert (live['total_sales'], live['cash_sales'], live['total_orders']) == (2.4, 2.4, 1)
+
+        await http.put(f'/orders/{order_id}', json={**order, 'payment_method': 'tarjeta'})
+        live = (await http.get('/daily-stats/live')).json()
+        assert (live['cash_sales'], live['card_sales']) == (0, 2.4)
+        assert live == {**(await http.get('/daily-stats')).json(), 'date': live['date']}
+
+    api(scenario)
+
+
+def test_editing_a_closed_order_does_not_reopen_it(api):
+    async def scenario(http):
+        order = make_order(status='entregado', payment_method='efectivo')
+        order_id = (await http.post('/orders', json=order)).json()['_id']
+        await close_day(http)
+        closed_date = (await server.db.orders.find_one({}))['closed_date']
+        assert closed_date is not None
+
+        # El cliente reenvía el pedido sin closed_date (el modelo lo rellena con null)
+        response = await http.put(f'/orders/{order_id}', json={**order, 'special_note': 'factura'})
+        assert response.status_code == 200, response.text
+        assert (await server.db.orders.find_one({}))['closed_date'] == closed_date
+        assert (await http.get('/daily-stats')).json()['total_orders'] == 0
+        assert (await http.get('/daily-stats/live')).json()['total_orders'] == 0
+
+    api(scenario)
+
+
+def test_live_rebuild_is_admin_only(api):
+    async def scenario(http):
+        await http.post('/orders', json=make_order(status='entregado'))
+        await server.db.daily_stats_live.update_many({}, {'$inc': {'total_orders': 5}})
+        assert (await http.post('/daily-stats/live/rebuild')).status_code == 404
+        assert (await http.post('/admin/daily-stats/live/rebuild')).status_code == 403
+        response = await http.post('/admin/daily-stats/live/rebuild', headers=ADMIN_HEADERS)
+        assert response.json()['total_orders'] == 1
+
+    api(scenario)
+
+
+def test_first_write_of_the_day_counts_the_orders_delivered_before_it(api, mongo):
+    async def scenario(http):
+        # Entregado antes de que existieran los contadores del día (p. ej. antes del despliegue)
+        await server.db.orders.insert_one({**make_order(status='entregado', payment_method='tarjeta'),
+                                           'created_at': datetime.utcnow()})
+        await http.post('/orders', json=make_order(status='entregado', payment_method='efectivo'))
+
+        live = (await http.get('/daily-stats/live')).json()
+        assert (live['total_sales'], live['cash_sales'], live['card_sales'], live['total_orders']) == (4.8, 2.4, 2.4, 2)
+        delta = next(data for event, data in mongo.emitted if event == 'daily_stats_delta')
+        assert delta['values']['total_sales'] == 4.8 and delta['values']['total_orders'] == 2
+
+    api(scenario)
+
+
+def test_test_orders_reach_the_live_counters_and_the_ledger(api):
+    async def scenario(http):
+        await http.post('/seed')
+        assert (await http.post('/test-orders')).status_code == 200
+        live = (await http.get('/daily-stats/live')).json()
+        assert live['total_orders'] == 3
+        assert live == {**(await http.get('/daily-stats')).json(), 'date': live['date']}
+        assert await server.db.payments.count_documents({'kind': 'settlement'}) == 3
+
+    api(scenario)
@@ -0,0 +1,103 @@
+import asyncio
+import time
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def flow(mongo, monkeypatch):
+    """A fresh FlowControl with two local clients whose queue depths the test sets"""
+    flow = server.FlowControl()
+    depths = {'fast': 0, 'slow': 0}
+    monkeypatch.setattr(server, 'flow_control', flow)
+    monkeypatch.setattr(server.connected_clients, 'local', {
+        sid: {'role': None, 'tenant': server.DEFAULT_TENANT} for sid in depths
+    })
+    monkeypatch.setattr(flow, 'queue_depth', lambda sid: depths[sid])
+    flow.depths = depths
+    return flow
+
+
+def broadcast(*events):
+    async def scenario():
+        for event, data in events:
+            await server.broadcast(event, data)
+
+    asyncio.run(scenario())
+
+
+def pending(flow, sid='slow'):
+    return [(event, data['name']) for event, data in flow.clients[sid]['pending'].values()]
+
+
+def test_deep_queue_marks_a_client_slow(flow):
+    flow.depths['slow'] = server.SLOW_QUEUE_DEPTH
+    assert flow.slow_sids() == ['slow']
+    # Sigue lento aunque la cola baje: solo flush() lo devuelve a la emisión directa
+    flow.depths['slow'] = 0
+    assert flow.slow_sids() == ['slow']
+
+
+def test_queue_that_does_not_drain_marks_a_client_slow(flow, monkeypatch):
+    monkeypatch.setattr(server, 'SLOW_LAG_SECONDS', 0.01)
+    flow.depths['slow'] = 1
+    assert flow.slow_sids() == []
+    time.sleep(0.02)
+    assert flow.slow_sids() == ['slow']
+
+
+def test_slow_client_gets_the_newest_version_of_each_entity(flow, mongo):
+    flow.depths['slow'] = server.SLOW_QUEUE_DEPTH
+    broadcast(
+        ('order_created', {'_id': 'o1', 'name': 'v1'}),
+        ('order_updated', {'_id': 'o1', 'name': 'v2'}),
+        ('product_updated', {'_id': 'p1', 'name': 'v1'}),
+        ('product_deleted', {'product_id': 'p1', 'name': 'v2'}),
+        ('order_created', {'_id': 'o2', 'name': 'v1'}),
+        ('order_deleted', {'order_id': 'o2', 'name': 'v2'}),
+        ('catalog_replaced', {'name': 'a'}),
+        ('catalog_replaced', {'name': 'b'}),
+    )
+    assert pending(flow) == [
+        ('order_created', 'v2'), ('product_deleted', 'v2'), ('catalog_replaced', 'a'), ('catalog_replaced', 'b')
+    ]
+    assert flow.clients['slow']['coalesced'] == 3
+    # El cliente rápido lo recibió todo en directo
+    assert len(mongo.emitted) == 8 and not flow.clients['fast']['pending']
+
+
+def test_flush_waits_for_the_queue_to_drain(flow, mongo):
+    flow.depths['slow'] = server.SLOW_QUEUE_DEPTH
+    broadcast(('order_updated', {'_id': 'o1', 'name': 'v1'}))
+    mongo.emitted.clear()
+
+    asyncio.run(flow.flush())
+    assert mongo.emitted == [] and flow.clients['slow']['slow']
+
+    flow.depths['slow'] = server.SLOW_QUEUE_DEPTH // 2
+    asyncio.run(flow.flush())
+    assert [(event, data['name']) for event, data in mongo.emitted] == [('order_updated', 'v1')]
+    assert not flow.clients['slow']['slow'] and flow.totals['flushed'] == 1
+
+
+def test_backlog_past_the_limit_is_dropped_for_a_resync(flow, mongo, monkeypatch):
+    monkeypatch.setattr(server, 'RESYNC_PENDING_EVENTS', 2)
+    flow.depths['slow'] = server.SLOW_QUEUE_DEPTH
+    broadcast(*[('order_updated', {'_id': f'o{n}', 'name': 'v1'}) for n in range(3)])
+    assert pending(flow) == []
+    assert flow.totals['dropped'] == 3 and flow.totals['resyncs'] == 1
+    mongo.emitted.clear()
+
+    flow.depths['slow'] = 0
+    asyncio.run(flow.flush())
+    assert [event for event, _ in mongo.emitted] == ['resync_required']
+    assert not flow.clients['slow']['slow']
+
+
+def test_forget_drops_the_client_state(flow):
+    flow.depths['slow'] = server.SLOW_QUEUE_DEPTH
+    flow.slow_sids()
+    flow.forget('slow')
+    assert 'slow' not in flow.clients
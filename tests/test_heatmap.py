@@ -0,0 +1,58 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import server
+
+
+def test_past_days_are_computed_once_and_today_every_time(api, monkeypatch):
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    long_ago = today - timedelta(days=30)
+    calls = []
+
+    # mongomock no implementa $dateTrunc: filas ya agregadas para el primer y el último día
+    async def compute(start, end, bucket_minutes):
+        calls.append((start, end))
+        rows = {long_ago.strftime('%Y-%m-%d'): [{'zone': 'salon_interior', 'time': '09:00', 'orders': 2, 'sales': 3.3}],
+                today.strftime('%Y-%m-%d'): [{'zone': 'salon_interior', 'time': '00:00', 'orders': 1, 'sales': 0.7},
+                                             {'zone': 'salon_interior', 'time': '09:00', 'orders': 1, 'sales': 0.1}]}
+        return {day: day_rows for day, day_rows in rows.items() if start.strftime('%Y-%m-%d') <= day < end.strftime('%Y-%m-%d')}
+
+    monkeypatch.setattr(server, 'compute_heatmap_days', compute)
+
+    async def scenario(http):
+        params = {'from': long_ago.strftime('%Y-%m-%d'), 'to': today.strftime('%Y-%m-%d')}
+        first = (await http.get('/analytics/heatmap', params=params)).json()
+        assert first['days'] == 31
+        assert first['buckets'] == [
+            {'zone': 'salon_interior', 'time': '00:00', 'orders': 1, 'sales': 0.7},
+            {'zone': 'salon_interior', 'time': '09:00', 'orders': 3, 'sales': 3.4},
+        ]
+
+        again = (await http.get('/analytics/heatmap', params=params)).json()
+        assert again == first
+        # Los 30 días anteriores (ninguno con cierre) quedan en caché; solo hoy se recalcula
+        assert calls == [(long_ago, today + timedelta(days=1)), (today, today + timedelta(days=1))]
+        assert len(server.heatmap_cache.current()) == 30
+
+    api(scenario)
+
+
+def test_bucket_size_must_divide_the_day(api):
+    async def scenario(http):
+        assert (await http.get('/analytics/heatmap', params={'bucket_minutes': 7})).status_code == 400
+        assert (await http.get('/analytics/heatmap', params={'from': '2026-10-12', 'to': '2026-10-11'})).status_code == 400
+
+    api(scenario)
+
+
+def test_heatmap_rows_are_rounded(monkeypatch):
+    bucket = datetime(2026, 10, 12, 13, 0)
+
+    class Orders:
+        async def aggregate(self, pipeline):
+            yield {'_id': {'bucket': bucket, 'zone': 'salon_interior'}, 'orders': 2, 'sales': 0.1 + 0.2}
+
+    monkeypatch.setattr(server, 'analytics_db', SimpleNamespace(orders=Orders()))
+    days = asyncio.run(server.compute_heatmap_days(datetime(2026, 10, 12), datetime(2026, 10, 13), 15))
+    assert days == {'2026-10-12': [{'zone': 'salon_interior', 'time': '13:00', 'orders': 2, 'sales': 0.3}]}
@@ -0,0 +1,67 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from tests.conftest import make_order
+
+
+def test_repeated_key_returns_stored_order(api):
+    async def scenario(http):
+        headers = {'Idempotency-Key': 'k1'}
+        first = await http.post('/orders', json=make_order(), headers=headers)
+        again = await http.post('/orders', json=make_order(), headers=headers)
+        assert first.status_code == again.status_code == 200
+        assert again.json()['_id'] == first.json()['_id']
+        assert len((await http.get('/orders')).json()) == 1
+
+    api(scenario)
+
+
+def test_key_claimed_by_another_worker_waits_for_its_response(mongo):
+    calls = []
+
+    async def operation():
+        calls.append(1)
+        return {'ran': 'here'}
+
+    async def scenario():
+        # Otro worker ya reservó la clave y está ejecutando la petición
+        await server.db.idempotency_keys.insert_one({'_id': 'create_order:k1', 'status': 'pending', 'created_at': datetime.utcnow()})
+        waiting = asyncio.create_task(server.run_idempotent('create_order', 'k1', operation))
+        await asyncio.sleep(0.2)
+        assert not waiting.done()
+        await server.db.idempotency_keys.update_one(
+            {'_id': 'create_order:k1'}, {'$set': {'status': 'done', 'response': {'ran': 'there'}}})
+        return await waiting
+
+    assert asyncio.run(scenario()) == {'ran': 'there'}
+    assert calls == []
+
+
+def test_abandoned_claim_is_taken_over(mongo, monkeypatch):
+    monkeypatch.setattr(server, 'IDEMPOTENCY_PENDING_SECONDS', 0.05)
+
+    async def scenario():
+        await server.db.idempotency_keys.insert_one({'_id': 'create_order:k1', 'status': 'pending', 'created_at': datetime.utcnow()})
+        await asyncio.sleep(0.1)
+        return await server.run_idempotent('create_order', 'k1', lambda: asyncio.sleep(0, {'ran': 'here'}))
+
+    assert asyncio.run(scenario()) == {'ran': 'here'}
+
+
+def test_failed_request_releases_its_claim(mongo):
+    async def fail():
+        raise HTTPException(status_code=404, detail="Order not found")
+
+    async def succeed():
+        return {'ok': True}
+
+    async def scenario():
+        with pytest.raises(HTTPException):
+            await server.run_idempotent('partial_payment:x', 'k1', fail)
+        return await server.run_idempotent('partial_payment:x', 'k1', succeed)
+
+    assert asyncio.run(scenario()) == {'ok': True}
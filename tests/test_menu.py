@@ -0,0 +1,28 @@
+import server
+
+
+def test_menu_is_rebuilt_only_when_the_catalog_changes(api, monkeypatch):
+    builds = []
+    build_menu = server.build_menu
+
+    async def counted():
+        builds.append(1)
+        return await build_menu()
+
+    monkeypatch.setattr(server, 'build_menu', counted)
+
+    async def scenario(http):
+        await http.post('/categories', json={'name': 'Bebidas'})
+        await http.post('/products', json={'name': 'Café Solo', 'category': 'Bebidas', 'price': 1.2})
+        first = await http.get('/menu')
+        assert (await http.get('/menu', headers={'If-None-Match': first.headers['ETag']})).status_code == 304
+        assert len(builds) == 1
+
+        # Otro worker escribe en el catálogo: este no recibe la invalidación, pero sí ve la versión nueva
+        await server.db.products.insert_one({'name': 'Vermut', 'category': 'Bebidas', 'price': 3.0})
+        await server.bump_catalog_version()
+        changed = await http.get('/menu')
+        assert 'Vermut' in changed.text and changed.headers['ETag'] != first.headers['ETag']
+        assert len(builds) == 2
+
+    api(scenario)
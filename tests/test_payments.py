@@ -0,0 +1,83 @@
+import server
+from tests.conftest import make_order
+
+
+async def totals(http):
+    body = (await http.get('/payments/totals')).json()
+    return body['total'], {method: row['amount'] for method, row in body['methods'].items() if row['amount']}
+
+
+async def ledger():
+    entries = await server.db.payments.find({}, {'_id': 0, 'kind': 1, 'method': 1, 'amount': 1}).to_list(None)
+    return [(e['kind'], e['method'], e['amount']) for e in entries]
+
+
+def test_order_created_delivered_is_settled_and_reversed_on_delete(api):
+    async def scenario(http):
+        order_id = (await http.post('/orders', json=make_order(status='entregado', payment_method='efectivo'))).json()['_id']
+        assert await totals(http) == (2.4, {'efectivo': 2.4})
+
+        await http.delete(f'/orders/{order_id}')
+        assert await ledger() == [('settlement', 'efectivo', 2.4), ('settlement_reversal', 'efectivo', -2.4)]
+        assert await totals(http) == (0, {})
+
+    api(scenario)
+
+
+def test_delivery_settles_only_what_partial_payments_left(api):
+    async def scenario(http):
+        order = make_order()
+        order_id = (await http.post('/orders', json=order)).json()['_id']
+        await http.post(f'/orders/{order_id}/partial-payment', json={'amount': 1, 'payment_method': 'tarjeta'})
+        paid = (await http.get(f'/orders/{order_id}')).json()
+
+        await http.put(f'/orders/{order_id}', json={**paid, 'status': 'entregado', 'payment_method': 'efectivo'})
+        assert await totals(http) == (2.4, {'tarjeta': 1, 'efectivo': 1.4})
+
+        # Borrar el pedido solo deshace lo cobrado al entregar
+        await http.delete(f'/orders/{order_id}')
+        assert await totals(http) == (1, {'tarjeta': 1})
+
+    api(scenario)
+
+
+def test_undelivering_reverses_the_settlement(api):
+    async def scenario(http):
+        order = make_order(status='entregado', payment_method='efectivo')
+        order_id = (await http.post('/orders', json=order)).json()['_id']
+
+        await http.put(f'/orders/{order_id}', json={**order, 'status': 'listo'})
+        assert await totals(http) == (0, {})
+
+        await http.put(f'/orders/{order_id}', json={**order, 'payment_method': 'tarjeta'})
+        assert await totals(http) == (2.4, {'tarjeta': 2.4})
+        assert [kind for kind, _, _ in await ledger()] == ['settlement', 'settlement_reversal', 'settlement']
+
+    api(scenario)
+
+
+def test_editing_a_delivered_order_adjusts_its_settlement(api):
+    async def scenario(http):
+        order = make_order(status='entregado', payment_method='efectivo')
+        order_id = (await http.post('/orders', json=order)).json()['_id']
+
+        # Cambio de método: se deshace lo cobrado en efectivo y se cobra con tarjeta
+        await http.put(f'/orders/{order_id}', json={**order, 'payment_method': 'tarjeta'})
+        assert await totals(http) == (2.4, {'tarjeta': 2.4})
+
+        # Un producto más: se vuelve a cobrar con el nuevo importe
+        products = order['products'] + [{'product_id': 'p2', 'name': 'Tostada', 'category': 'Desayunos', 'price': 1.6, 'quantity': 1}]
+        await http.put(f'/orders/{order_id}', json={**order, 'payment_method': 'tarjeta', 'products': products, 'total': 4.0})
+        assert await totals(http) == (4.0, {'tarjeta': 4.0})
+
+        # Sin cambios en importe ni método no se escribe nada
+        entries = len(await ledger())
+        await http.put(f'/orders/{order_id}', json={**order, 'payment_method': 'tarjeta', 'products': products,
+                                                    'total': 4.0, 'special_note': 'factura'})
+        assert len(await ledger()) == entries
+
+        # Un pago parcial después de entregar no se cuenta dos veces
+        await http.post(f'/orders/{order_id}/partial-payment', json={'amount': 1, 'payment_method': 'efectivo'})
+        assert await totals(http) == (4.0, {'tarjeta': 3.0, 'efectivo': 1})
+
+    api(scenario)
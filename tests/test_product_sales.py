@@ -0,0 +1,117 @@
+import asyncio
+
+import server
+from tests.conftest import ADMIN_HEADERS, make_order
+
+
+def line(product_id, name, quantity, price=2.0):
+    return {'product_id': product_id, 'name': name, 'category': 'Bebidas', 'price': price, 'quantity': quantity}
+
+
+async def top_products(http):
+    response = await http.get('/analytics/top-products', params={'limit': 50})
+    return {p['product_id']: (p['quantity'], p['revenue']) for p in response.json()['products']}
+
+
+def test_counters_follow_delivery_edits_and_deletes(api):
+    async def scenario(http):
+        order = make_order(status='entregado', products=[line('p1', 'Caña', 2)])
+        order_id = (await http.post('/orders', json=order)).json()['_id']
+        assert await top_products(http) == {'p1': (2, 4.0)}
+
+        order['products'] = [line('p1', 'Caña', 1), line('p2', 'Tinto', 3)]
+        await http.put(f'/orders/{order_id}', json=order)
+        assert await top_products(http) == {'p1': (1, 2.0), 'p2': (3, 6.0)}
+
+        order['status'] = 'listo'
+        await http.put(f'/orders/{order_id}', json=order)
+        assert await top_products(http) == {}
+
+    api(scenario)
+
+
+def test_rebuild_is_admin_only(api):
+    async def scenario(http):
+        assert (await http.post('/analytics/top-products/rebuild')).status_code == 404
+        assert (await http.post('/admin/analytics/top-products/rebuild')).status_code == 403
+
+    api(scenario)
+
+
+def test_rebuild_keeps_writes_that_land_meanwhile(api, monkeypatch):
+    monkeypatch.setattr(server, 'PRODUCT_SALES_REBUILD_GRACE_SECONDS', 0.01)
+    snapshot = server.ProductSalesRebuild.snapshot
+    swap = server.ProductSalesRebuild.swap
+
+    async def scenario(http):
+        kept = make_order(status='entregado', products=[line('p1', 'Caña', 2)])
+        kept_id = (await http.post('/orders', json=kept)).json()['_id']
+        # Contadores desviados a propósito: la reconstrucción debe corregirlos
+        await server.db.product_sales_daily.update_many({}, {'$inc': {'quantity': 40}})
+        gone = make_order(status='entregado', products=[line('p2', 'Tinto', 5)])
+
+        async def snapshot_after_a_write(rebuild):
+            # Antes de la instantánea: la ve, así que su entrada del diario no se aplica
+            gone['_id'] = (await http.post('/orders', json=gone)).json()['_id']
+            return await snapshot(rebuild)
+
+        async def swap_after_writes(rebuild, counters):
+            # Entre la lectura y el cambio de colección: la instantánea no las vio
+            await asyncio.sleep(0.01)
+            await http.post('/orders', json=make_order(status='entregado', products=[line('p3', 'Vermut', 1)]))
+            kept['products'] = [line('p1', 'Caña', 3)]
+            await http.put(f'/orders/{kept_id}', json=kept)
+            await http.delete(f"/orders/{gone['_id']}")
+            await swap(rebuild, counters)
+
+        monkeypatch.setattr(server.ProductSalesRebuild, 'snapshot', snapshot_after_a_write)
+        monkeypatch.setattr(server.ProductSalesRebuild, 'swap', swap_after_writes)
+        response = await http.post('/admin/analytics/top-products/rebuild', headers=ADMIN_HEADERS)
+        assert response.status_code == 200, response.text
+        assert response.json()['orders'] == 2
+        assert await top_products(http) == {'p1': (3, 6.0), 'p3': (1, 2.0)}
+        assert await server.db.product_sales_journal.count_documents({}) == 0
+
+        # Cerrada la reconstrucción, las escrituras vuelven a los contadores directamente
+        kept['products'] = [line('p1', 'Caña', 4)]
+        await http.put(f'/orders/{kept_id}', json=kept)
+        assert await top_products(http) == {'p1': (4, 8.0), 'p3': (1, 2.0)}
+
+    api(scenario)
+
+
+def test_only_one_rebuild_at_a_time(api):
+    async def scenario(http):
+        await server.db.product_sales_state.insert_one({'_id': 'rebuild', 'active': True, 'started_at': server.datetime.utcnow()})
+        response = await http.post('/admin/analytics/top-products/rebuild', headers=ADMIN_HEADERS)
+        assert response.status_code == 409
+
+    api(scenario)
+
+
+def test_top_products_take_the_latest_name(api):
+    async def scenario(http):
+        await server.db.product_sales_daily.insert_many([
+            {'_id': '2026-10-13:p1', 'day': '2026-10-13', 'product_id': 'p1', 'name': 'Caña nueva', 'category': 'Bebidas', 'quantity': 1, 'revenue': 2.0},
+            {'_id': '2026-10-12:p1', 'day': '2026-10-12', 'product_id': 'p1', 'name': 'Caña', 'category': 'Bebidas', 'quantity': 2, 'revenue': 4.0},
+        ])
+        response = await http.get('/analytics/top-products', params={'from': '2026-10-12', 'to': '2026-10-13'})
+        assert response.json()['products'] == [
+            {'product_id': 'p1', 'name': 'Caña nueva', 'category': 'Bebidas', 'quantity': 3, 'revenue': 6.0}
+        ]
+
+    api(scenario)
+
+
+def test_other_workers_see_the_rebuild_within_the_state_ttl(mongo):
+    async def scenario():
+        flag = server.ProductSalesRebuildFlag()
+        assert await flag.get() is None
+        await server.db.product_sales_state.insert_one(
+            {'_id': 'rebuild', 'active': True, 'rebuild_id': 'r1', 'started_at': server.datetime.utcnow()})
+        assert await flag.get() is None  # todavía en caché
+        flag.read_at -= server.PRODUCT_SALES_STATE_TTL
+        assert await flag.get() == 'r1'
+
+    asyncio.run(scenario())
+    assert server.PRODUCT_SALES_STATE_TTL < server.PRODUCT_SALES_REBUILD_GRACE_SECONDS
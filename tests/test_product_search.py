@@ -0,0 +1,72 @@
+import pytest
+
+from server import ProductSearchIndex, fold_text
+
+
+def names(results):
+    return [p['name'] for p in results]
+
+
+@pytest.fixture
+def index():
+    index = ProductSearchIndex()
+    index.replace_all([
+        {'_id': 'p1', 'name': 'Café Solo', 'category': 'Bebidas'},
+        {'_id': 'p2', 'name': 'Café con Leche', 'category': 'Bebidas'},
+        {'_id': 'p3', 'name': 'Cafetería Especial', 'category': 'Desayunos'},
+        {'_id': 'p4', 'name': 'Tostada con Tomate', 'category': 'Desayunos'},
+        {'_id': 'p5', 'name': 'Piña Colada', 'category': 'Cócteles'},
+    ])
+    return index
+
+
+@pytest.mark.parametrize('text,folded', [
+    ('Café Solo', 'cafe solo'),
+    ('  PIÑA-colada!! ', 'pina colada'),
+    ('Agua 1,5L', 'agua 1 5l'),
+    ('Straße', 'strasse'),
+    (None, ''),
+])
+def test_fold_text(text, folded):
+    assert fold_text(text) == folded
+
+
+def test_prefix_matches_any_word_ignoring_accents(index):
+    assert names(index.search('caf')) == ['Café con Leche', 'Café Solo', 'Cafetería Especial']
+    assert names(index.search('LECHE')) == ['Café con Leche']
+    assert names(index.search('pina')) == ['Piña Colada']
+    assert index.search('cafex') == []
+
+
+def test_every_query_word_must_match(index):
+    assert names(index.search('caf sol')) == ['Café Solo']
+    assert names(index.search('con')) == ['Café con Leche', 'Tostada con Tomate']
+
+
+def test_names_starting_with_the_query_rank_first(index):
+    assert names(index.search('cafe con')) == ['Café con Leche']
+    assert names(index.search('to')) == ['Tostada con Tomate']
+    assert names(index.search('col')) == ['Piña Colada']
+    assert names(index.search('es')) == ['Cafetería Especial']
+
+
+def test_category_filter_and_limit(index):
+    assert names(index.search('caf', category='desayunos')) == ['Cafetería Especial']
+    assert names(index.search('', category='Cocteles')) == ['Piña Colada']
+    assert len(index.search('', limit=2)) == 2
+
+
+def test_upsert_reindexes_a_renamed_product(index):
+    index.upsert({'_id': 'p1', 'name': 'Cortado', 'category': 'Bebidas'})
+    assert names(index.search('solo')) == []
+    assert names(index.search('cort')) == ['Cortado']
+    assert index.size == 5
+
+
+def test_remove_prunes_branches_no_other_product_uses(index):
+    index.remove('p5')
+    index.remove('missing')
+    assert 'p' not in index.root.children
+    assert 'p5' not in index.root.children['c'].ids
+    assert index.search('col') == []
+    assert names(index.search('c')) == ['Café con Leche', 'Café Solo', 'Cafetería Especial', 'Tostada con Tomate']
@@ -0,0 +1,59 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import server
+
+
+def resume(mongo, seqs, stored=()):
+    async def scenario():
+        with server.tenant_context(server.DEFAULT_TENANT):
+            for n in range(3):
+                await server.broadcast('order_updated', {'order_id': f'o{n}'})
+            # Eventos que otro worker guardó antes de que este emitiera los suyos
+            start = datetime.utcnow() - timedelta(seconds=len(stored))
+            for n, (epoch, seq) in enumerate(stored):
+                await server.db.event_log.insert_one({
+                    'epoch': epoch, 'seq': seq, 'event': 'order_updated',
+                    'data': {'order_id': f'{epoch}-{seq}'}, 'created_at': start + timedelta(milliseconds=n)
+                })
+            mongo.emitted.clear()
+            await server.resume('sid-1', {'seqs': seqs(server.event_log.epoch)})
+
+    asyncio.run(scenario())
+    return dict(mongo.emitted)['resume_complete'], mongo.emitted[:-1]
+
+
+def test_resume_replays_missed_events(mongo):
+    complete, events = resume(mongo, lambda epoch: {epoch: 1})
+    assert complete['replayed'] == 2 and not complete['full_sync']
+    assert [data['order_id'] for _, data in events] == ['o1', 'o2']
+
+
+def test_resume_from_an_older_worker_falls_back_to_full_sync(mongo):
+    complete, events = resume(mongo, lambda epoch: {'restarted-worker': 1})
+    assert complete['full_sync'] and complete['replayed'] == 0
+    assert [event for event, _ in events] == ['sync_data']
+
+
+def test_resume_behind_a_message_queue_replays_every_workers_events(mongo, monkeypatch):
+    monkeypatch.setattr(server, 'MULTI_WORKER', True)
+    complete, events = resume(mongo, lambda epoch: {epoch: 1, 'other': 1},
+                              stored=[('other', 1), ('other', 2), ('new', 1)])
+    assert complete['replayed'] == 4 and not complete['full_sync']
+    assert [data['order_id'] for _, data in events] == ['other-2', 'new-1', 'o1', 'o2']
+
+
+def test_resume_behind_a_message_queue_needs_the_last_seen_event(mongo, monkeypatch):
+    monkeypatch.setattr(server, 'MULTI_WORKER', True)
+    # 'other' 1 ya caducó: no se sabe si el cliente se perdió algo entre medias
+    complete, events = resume(mongo, lambda epoch: {epoch: 3, 'other': 1}, stored=[('other', 2)])
+    assert complete['full_sync']
+    assert [event for event, _ in events] == ['sync_data']
+
+
+def test_sync_data_carries_every_workers_last_seq(mongo, monkeypatch):
+    monkeypatch.setattr(server, 'MULTI_WORKER', True)
+    complete, events = resume(mongo, lambda epoch: {}, stored=[('other', 4), ('other', 5)])
+    assert complete['full_sync']
+    sync = dict(events)['sync_data']
+    assert sync['seqs'] == {sync['epoch']: 3, 'other': 5}
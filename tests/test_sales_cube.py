@@ -0,0 +1,117 @@
+from datetime import datetime
+
+import pytest
+
+import server
+from server import SalesCube
+from tests.conftest import make_order
+
+
+def delivered(order_id, created_at, zone='salon_interior', waiter_role='camarero_1', lines=None):
+    return {
+        '_id': order_id,
+        'status': 'entregado',
+        'zone': zone,
+        'waiter_role': waiter_role,
+        'created_at': created_at,
+        'products': lines or [{'name': 'Café Solo', 'category': 'Bebidas', 'price': 1.2, 'quantity': 2}],
+    }
+
+
+@pytest.fixture
+def cube():
+    cube = SalesCube(capacity=4)
+    cube.upsert(delivered('o1', datetime(2026, 10, 12, 9), lines=[
+        {'name': 'Café Solo', 'category': 'Bebidas', 'price': 1.2, 'quantity': 2},
+        {'name': 'Tostada', 'category': 'Desayunos', 'price': 2.5, 'quantity': 1},
+    ]))
+    cube.upsert(delivered('o2', datetime(2026, 10, 12, 14), zone='terraza_exterior', waiter_role='camarero_2', lines=[
+        {'name': 'Café Solo', 'category': 'Bebidas', 'price': 1.2, 'quantity': 3},
+    ]))
+    cube.upsert(delivered('o3', datetime(2026, 10, 13, 9), lines=[
+        {'name': 'Tostada', 'category': 'Desayunos', 'price': 2.5, 'quantity': 4},
+    ]))
+    return cube
+
+
+def test_group_by_product_and_hour(cube):
+    rows = cube.group_by(['product', 'hour'])
+    assert rows == [
+        {'product': 'Tostada', 'hour': 9, 'quantity': 5, 'sales': 12.5, 'orders': 2},
+        {'product': 'Café Solo', 'hour': 14, 'quantity': 3, 'sales': 3.6, 'orders': 1},
+        {'product': 'Café Solo', 'hour': 9, 'quantity': 2, 'sales': 2.4, 'orders': 1},
+    ]
+
+
+def test_group_by_weekday_with_filters_and_range(cube):
+    rows = cube.group_by(['category', 'weekday'], start=datetime(2026, 10, 12), end=datetime(2026, 10, 12),
+                         filters={'zone': 'salon_interior'})
+    assert rows == [
+        {'category': 'Desayunos', 'weekday': 'lunes', 'quantity': 1, 'sales': 2.5, 'orders': 1},
+        {'category': 'Bebidas', 'weekday': 'lunes', 'quantity': 2, 'sales': 2.4, 'orders': 1},
+    ]
+    assert cube.group_by(['zone'], filters={'waiter_role': 'nadie'}) == []
+
+
+def test_group_by_without_dimensions_totals_everything(cube):
+    assert cube.group_by([]) == [{'quantity': 10, 'sales': 18.5, 'orders': 3}]
+
+
+def test_unknown_dimension_is_rejected(cube):
+    with pytest.raises(ValueError):
+        cube.group_by(['table'])
+
+
+def test_upsert_replaces_and_non_delivered_orders_drop_out(cube):
+    cube.upsert(delivered('o2', datetime(2026, 10, 12, 14), lines=[
+        {'name': 'Café Solo', 'category': 'Bebidas', 'price': 1.2, 'quantity': 1},
+    ]))
+    cube.upsert({**delivered('o3', datetime(2026, 10, 13, 9)), 'status': 'listo'})
+    assert cube.group_by([]) == [{'quantity': 4, 'sales': 6.1, 'orders': 2}]
+    assert cube.status()['orders'] == 2
+
+
+def test_discard_removes_an_order(cube):
+    cube.discard('o1')
+    cube.discard('missing')
+    assert cube.group_by(['product']) == [
+        {'product': 'Tostada', 'quantity': 4, 'sales': 10.0, 'orders': 1},
+        {'product': 'Café Solo', 'quantity': 3, 'sales': 3.6, 'orders': 1},
+    ]
+
+
+def test_compaction_drops_dead_rows_and_their_labels(cube, monkeypatch):
+    monkeypatch.setattr(server, 'SALES_CUBE_COMPACT_ROWS', 0)
+    cube.discard('o2')
+    assert cube.size == 4 and cube.dead == 1
+
+    # La mitad de las filas muertas: se compacta
+    cube.discard('o3')
+    assert cube.size == 2 and cube.dead == 0
+    assert cube.labels['order'] == ['o1']
+    assert cube.labels['zone'] == ['salon_interior']
+    assert cube.labels['waiter_role'] == ['camarero_1']
+    assert cube.group_by(['product', 'day']) == [
+        {'product': 'Tostada', 'day': '2026-10-12', 'quantity': 1, 'sales': 2.5, 'orders': 1},
+        {'product': 'Café Solo', 'day': '2026-10-12', 'quantity': 2, 'sales': 2.4, 'orders': 1},
+    ]
+
+    cube.upsert(delivered('o4', datetime(2026, 10, 13, 20), zone='terraza_exterior'))
+    cube.discard('o1')
+    assert cube.group_by(['zone', 'hour']) == [{'zone': 'terraza_exterior', 'hour': 20, 'quantity': 2, 'sales': 2.4, 'orders': 1}]
+    assert cube.status()['orders'] == 1
+
+
+def test_deletions_reach_the_cube_of_other_workers(api):
+    other_worker = SalesCube()
+
+    async def scenario(http):
+        order_id = (await http.post('/orders', json=make_order(status='entregado'))).json()['_id']
+        await other_worker.refresh(force=True)
+        assert other_worker.group_by([])[0]['orders'] == 1
+
+        await http.delete(f'/orders/{order_id}')
+        await other_worker.refresh(force=True)
+        assert other_worker.group_by([]) == []
+
+    api(scenario)
@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+
+from server import SingleFlightCache
+
+
+class Computation:
+    """A compute() that blocks until released and counts its runs"""
+
+    def __init__(self, value='stats'):
+        self.value = value
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+        if isinstance(self.value, Exception):
+            raise self.value
+        return self.value
+
+
+def run(scenario):
+    return asyncio.run(scenario())
+
+
+def test_concurrent_calls_share_one_computation():
+    async def scenario():
+        cache, compute = SingleFlightCache(), Computation()
+        calls = [asyncio.create_task(cache.get(('daily_stats',), 5, compute)) for _ in range(5)]
+        await asyncio.sleep(0)
+        compute.release.set()
+        assert await asyncio.gather(*calls) == ['stats'] * 5
+        assert await cache.get(('daily_stats',), 5, compute) == 'stats'
+        assert compute.calls == 1
+
+    run(scenario)
+
+
+def test_cancelled_leader_does_not_cancel_waiters():
+    async def scenario():
+        cache, compute = SingleFlightCache(), Computation()
+        leader = asyncio.create_task(cache.get(('daily_stats',), 5, compute))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(cache.get(('daily_stats',), 5, compute))
+        await asyncio.sleep(0)
+
+        leader.cancel()
+        await asyncio.sleep(0)
+        compute.release.set()
+
+        assert await waiter == 'stats'
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        # El resultado se guardó aunque quien lo lanzó ya no esperaba
+        assert await cache.get(('daily_stats',), 5, compute) == 'stats'
+        assert compute.calls == 1
+
+    run(scenario)
+
+
+def test_errors_reach_every_waiter_and_are_not_cached():
+    async def scenario():
+        cache, failing = SingleFlightCache(), Computation(RuntimeError('mongo down'))
+        calls = [asyncio.create_task(cache.get(('daily_stats',), 5, failing)) for _ in range(3)]
+        await asyncio.sleep(0)
+        failing.release.set()
+        results = await asyncio.gather(*calls, return_exceptions=True)
+        assert all(isinstance(r, RuntimeError) for r in results)
+
+        compute = Computation()
+        compute.release.set()
+        assert await cache.get(('daily_stats',), 5, compute) == 'stats'
+
+    run(scenario)
+
+
+def test_invalidation_during_computation_keeps_the_result_out_of_the_cache():
+    async def scenario():
+        cache, stale = SingleFlightCache(), Computation('stale')
+        call = asyncio.create_task(cache.get(('daily_stats', 'today'), 5, stale))
+        await asyncio.sleep(0)
+        cache.invalidate('daily_stats')
+        stale.release.set()
+        assert await call == 'stale'
+
+        fresh = Computation('fresh')
+        fresh.release.set()
+        assert await cache.get(('daily_stats', 'today'), 5, fresh) == 'fresh'
+
+    run(scenario)
+
+
+def test_invalidate_by_namespace():
+    async def scenario():
+        cache = SingleFlightCache()
+        for namespace in ('daily_stats', 'weekly_stats'):
+            compute = Computation(namespace)
+            compute.release.set()
+            await cache.get((namespace,), 5, compute)
+        cache.invalidate('daily_stats')
+        assert list(cache._values) == [('weekly_stats',)]
+        cache.invalidate()
+        assert cache._values == {}
+
+    run(scenario)
+
+
+def test_expired_entries_are_pruned_when_storing():
+    async def scenario():
+        cache = SingleFlightCache()
+        for day in range(3):
+            compute = Computation(day)
+            compute.release.set()
+            await cache.get(('daily_stats', day), 0, compute)
+        assert list(cache._values) == [('daily_stats', 2)]
+
+    run(scenario)
@@ -0,0 +1,79 @@
+from tests.conftest import make_order
+
+
+def test_ops_apply_in_order_and_map_local_ids(api, mongo):
+    async def scenario(http):
+        response = await http.post('/sync/batch', json={'client_id': 'tablet-1', 'operations': [
+            {'op_id': 'a', 'type': 'create_order', 'order_id': 'local-1', 'data': make_order()},
+            {'op_id': 'b', 'type': 'update_order', 'order_id': 'local-1', 'data': make_order(status='preparando')},
+            {'op_id': 'c', 'type': 'bogus'},
+        ]})
+        assert response.status_code == 200, response.text
+        body = response.json()
+        assert [r['status'] for r in body['results']] == ['applied', 'applied', 'error']
+        order_id = body['id_map']['local-1']
+        assert body['results'][1]['order_id'] == order_id
+        assert (await http.get(f'/orders/{order_id}')).json()['status'] == 'preparando'
+
+    api(scenario)
+    assert [event for event, _ in mongo.emitted].count('sync_batch_applied') == 1
+
+
+def test_replayed_batch_is_reported_as_duplicate(api):
+    async def scenario(http):
+        operations = [{'op_id': 'a', 'type': 'create_order', 'order_id': 'local-1', 'data': make_order()}]
+        first = (await http.post('/sync/batch', json={'operations': operations})).json()
+        again = (await http.post('/sync/batch', json={'operations': operations})).json()
+        assert again['results'] == [{'op_id': 'a', 'status': 'duplicate', 'order_id': first['results'][0]['order_id']}]
+        assert len((await http.get('/orders')).json()) == 1
+
+    api(scenario)
+
+
+def test_op_id_repeated_within_a_batch_is_applied_once(api, mongo):
+    async def scenario(http):
+        create = {'op_id': 'a', 'type': 'create_order', 'order_id': 'local-1', 'data': make_order()}
+        response = await http.post('/sync/batch', json={'operations': [create, create]})
+        assert response.status_code == 200, response.text
+        results = response.json()['results']
+        assert [r['status'] for r in results] == ['applied', 'duplicate']
+        assert results[0]['order_id'] == results[1]['order_id']
+        assert len((await http.get('/orders')).json()) == 1
+
+    api(scenario)
+    assert [event for event, _ in mongo.emitted].count('sync_batch_applied') == 1
+
+
+def test_failed_op_can_be_retried(api):
+    async def scenario(http):
+        pay = {'op_id': 'p', 'type': 'partial_payment', 'order_id': 'local-1',
+               'data': {'amount': 1, 'payment_method': 'efectivo'}}
+        failed = (await http.post('/sync/batch', json={'operations': [pay]})).json()
+        assert failed['results'][0]['status'] == 'error'
+
+        create = {'op_id': 'a', 'type': 'create_order', 'order_id': 'local-1', 'data': make_order()}
+        retried = (await http.post('/sync/batch', json={'operations': [create, pay]})).json()
+        assert [r['status'] for r in retried['results']] == ['applied', 'applied']
+
+    api(scenario)
+
+
+def test_op_queued_after_an_online_attempt_that_reached_the_server_is_not_reapplied(api):
+    async def scenario(http):
+        # El POST llegó pero la respuesta se perdió: la app encola la escritura con la misma clave
+        order_id = (await http.post('/orders', json=make_order(), headers={'Idempotency-Key': 'k1'})).json()['_id']
+        pay = {'amount': 1, 'payment_method': 'efectivo'}
+        await http.post(f'/orders/{order_id}/partial-payment', json=pay, headers={'Idempotency-Key': 'k2'})
+
+        response = await http.post('/sync/batch', json={'operations': [
+            {'op_id': 'k1', 'type': 'create_order', 'order_id': 'local-1', 'data': make_order()},
+            {'op_id': 'k2', 'type': 'partial_payment', 'order_id': order_id, 'data': pay},
+            {'op_id': 'k3', 'type': 'partial_payment', 'order_id': 'local-1', 'data': pay},
+        ]})
+        body = response.json()
+        assert [r['status'] for r in body['results']] == ['duplicate', 'duplicate', 'applied']
+        assert body['id_map'] == {'local-1': order_id}
+        orders = (await http.get('/orders')).json()
+        assert len(orders) == 1 and len(orders[0]['partial_payments']) == 2
+
+    api(scenario)
@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+
+import server
+from tests.conftest import make_order
+
+LAUREL = {'X-Tenant-ID': 'laurel'}
+
+
+def test_two_restaurants_share_nothing(api, mongo, monkeypatch):
+    monkeypatch.setattr(server, 'TENANTS', [server.DEFAULT_TENANT, 'laurel'])
+    rooms = []
+
+    async def emit(event, data=None, namespace=None, **kwargs):
+        rooms.append((event, namespace))
+
+    monkeypatch.setattr(server.sio, 'emit', emit)
+
+    async def compute(start, end, bucket_minutes):
+        # mongomock no implementa $dateTrunc: cada restaurante devuelve sus propias filas
+        zone = 'terraza_exterior' if server.current_tenant.get() == 'laurel' else 'salon_interior'
+        return {start.strftime('%Y-%m-%d'): [{'zone': zone, 'time': '13:00', 'orders': 1, 'sales': 2.4}]}
+
+    monkeypatch.setattr(server, 'compute_heatmap_days', compute)
+
+    async def scenario(http):
+        # Base de datos y namespace de Socket.IO
+        delivered = make_order(status='entregado', payment_method='efectivo')
+        created = await http.post('/orders', json=delivered, headers={**LAUREL, 'Idempotency-Key': 'k1'})
+        assert created.status_code == 200
+        assert ('order_created', '/laurel') in rooms and not any(room == '/' for _, room in rooms)
+        assert len((await http.get('/orders', headers=LAUREL)).json()) == 1
+        assert (await http.get('/orders')).json() == []
+        assert await mongo[f'{server.DB_NAME}_laurel'].orders.count_documents({}) == 1
+        assert await mongo[server.DB_NAME].orders.count_documents({}) == 0
+
+        # La misma Idempotency-Key en otro restaurante es otra petición
+        replayed = await http.post('/orders', json=make_order(), headers={'Idempotency-Key': 'k1'})
+        assert replayed.json()['_id'] != created.json()['_id']
+        assert await mongo[server.DB_NAME].orders.count_documents({}) == 1
+
+        # SingleFlightCache: las estadísticas cacheadas de uno no se sirven al otro
+        assert (await http.get('/daily-stats', headers=LAUREL)).json()['total_orders'] == 1
+        assert (await http.get('/daily-stats')).json()['total_orders'] == 0
+
+        # MenuCache
+        await http.post('/products', json={'name': 'Vermut', 'category': 'Bebidas', 'price': 3.0}, headers=LAUREL)
+        laurel_menu = await http.get('/menu', headers=LAUREL)
+        default_menu = await http.get('/menu')
+        assert 'Vermut' in laurel_menu.text and 'Vermut' not in default_menu.text
+        assert laurel_menu.headers['ETag'] != default_menu.headers['ETag']
+
+        # Caché del heatmap: el día de ayer queda guardado en cada restaurante por separado
+        yesterday = (datetime.utcnow() - timedelta(days=1)).strftime('%Y-%m-%d')
+        params = {'from': yesterday, 'to': yesterday}
+        laurel_heatmap = (await http.get('/analytics/heatmap', params=params, headers=LAUREL)).json()
+        default_heatmap = (await http.get('/analytics/heatmap', params=params)).json()
+        assert [bucket['zone'] for bucket in laurel_heatmap['buckets']] == ['terraza_exterior']
+        assert [bucket['zone'] for bucket in default_heatmap['buckets']] == ['salon_interior']
+        assert [len(cache) for cache in server.heatmap_cache.instances()] == [1, 1]
+
+        # Un restaurante que no existe no cae en el de por defecto
+        assert (await http.get('/orders', headers={'X-Tenant-ID': 'otro'})).status_code == 404
+
+    api(scenario)
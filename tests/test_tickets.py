@@ -0,0 +1,125 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import server
+from server import TicketPipeline, render_ticket, ticket_changes
+from tests.conftest import ADMIN_HEADERS
+
+
+def product(product_id, name, category, quantity=1, note=None):
+    return {'product_id': product_id, 'name': name, 'category': category, 'price': 2.0, 'quantity': quantity, 'note': note}
+
+
+def order(*products, **fields):
+    return {'_id': 'a1b2c3d4e5f6', 'table_number': 7, 'zone': 'terraza_exterior', 'waiter_role': 'camarero_1',
+            'status': 'pendiente', 'products': list(products), **fields}
+
+
+def ticket(kind, lines, **fields):
+    return {'order_id': '665f1c2ab3d4e5f6a7b8c9d0', 'table_number': 7, 'zone': 'terraza_exterior',
+            'waiter_role': 'camarero_1', 'at': datetime(2026, 10, 18, 21, 5), 'kind': kind, 'lines': lines, **fields}
+
+
+def test_changes_of_a_new_order_list_every_line():
+    kind, lines = ticket_changes(None, order(product('p1', 'Bravas', 'Entrantes', 2), product('p1', 'Bravas', 'Entrantes')))
+    assert kind == 'nuevo'
+    assert lines == [{'name': 'Bravas', 'category': 'Entrantes', 'note': None, 'quantity': 3}]
+
+
+def test_changes_of_an_edit_are_signed_deltas():
+    old = order(product('p1', 'Bravas', 'Entrantes', 2), product('p2', 'Caña', 'Bebidas'))
+    new = order(product('p1', 'Bravas', 'Entrantes', 1), product('p2', 'Caña', 'Bebidas'),
+                product('p3', 'Calamares', 'Entrantes', note='sin limón'))
+    kind, lines = ticket_changes(old, new)
+    assert kind == 'modificado'
+    assert [(l['name'], l['quantity'], l['note']) for l in lines] == [('Bravas', -1, None), ('Calamares', 1, 'sin limón')]
+    assert ticket_changes(old, None)[0] == 'anulado'
+
+
+def test_render_new_ticket():
+    data = render_ticket('cocina', ticket('nuevo', [{'name': 'Bravas', 'category': 'Entrantes', 'note': None, 'quantity': 2}]))
+    assert data.startswith(b'\x1b@\x1bt\x10')
+    assert data.endswith(b'\x1bd\x04\x1dVB\x00')
+    assert b'COCINA\n' in data and b'MESA 7\n' in data
+    assert b'terraza exterior - camarero_1\n' in data
+    assert b'18/10/2026 21:05\n' in data
+    assert b'\x1d!\x01  2 x Bravas\n\x1d!\x00' in data
+    assert b'Pedido b8c9d0\n' in data
+    assert b'**' not in data
+
+
+def test_render_edit_ticket_with_notes_in_cp1252():
+    data = render_ticket('barra', ticket(
+        'modificado',
+        [{'name': 'Café con leche', 'category': 'Bebidas', 'note': 'leche de avena', 'quantity': -1}],
+        special_note='Niño con alergia', created_by='Begoña'
+    ))
+    assert b'\x1bE\x01** MODIFICADO **\n\x1bE\x00' in data
+    assert ' -1 x Café con leche\n'.encode('cp1252') in data
+    assert b'      > leche de avena\n' in data
+    assert '\x1bE\x01NOTA: Niño con alergia\n\x1bE\x00'.encode('cp1252') in data
+    assert ' - Begoña\n'.encode('cp1252') in data
+
+
+def test_render_wraps_long_names(monkeypatch):
+    monkeypatch.setattr(server, 'TICKET_WIDTH', 20)
+    data = render_ticket('cocina', ticket('nuevo', [
+        {'name': 'Hamburguesa completa con patatas', 'category': 'Comidas', 'note': None, 'quantity': 1}
+    ]))
+    assert b'  1 x Hamburguesa\n' in data
+    assert b'      completa con\n' in data
+    assert b'      patatas\n' in data
+    assert b'-' * 20 + b'\n' in data
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+    monkeypatch.setattr(server, 'TICKET_MAX_ATTEMPTS', 2)
+    monkeypatch.setattr(server, 'TICKET_RETRY_SECONDS', 0)
+    pipeline = TicketPipeline({
+        'cocina': {'url': 'memory://cocina', 'categories': ['Entrantes']},
+        'barra': {'url': 'memory://barra', 'categories': ['Bebidas']},
+    }, queue_size=10)
+    monkeypatch.setattr(server, 'ticket_pipeline', pipeline)
+    return pipeline
+
+
+async def print_all(pipeline):
+    while not pipeline.events.empty():
+        pipeline.route(pipeline.events.get_nowait())
+    for name, station in pipeline.stations.items():
+        while not station['queue'].empty():
+            ticket = station['queue'].get_nowait()
+            await pipeline.deliver(name, ticket, render_ticket(name, ticket))
+
+
+def test_pipeline_splits_an_order_by_station(pipeline):
+    pipeline.submit(None, order(product('p1', 'Bravas', 'Entrantes'), product('p2', 'Caña', 'Bebidas', 2)))
+    pipeline.submit(order(status='entregado'), order(status='entregado'))
+    asyncio.run(print_all(pipeline))
+
+    kitchen, bar = (pipeline.stations[name]['printer'].tickets for name in ('cocina', 'barra'))
+    assert len(kitchen) == len(bar) == 1
+    assert b'Bravas' in kitchen[0] and b'Ca' not in kitchen[0]
+    assert b'  2 x Ca\xf1a\n' in bar[0]
+    assert pipeline.totals == {'submitted': 1, 'dropped': 0, 'tickets': 2}
+
+
+def test_failed_tickets_are_set_aside_and_retried(pipeline, api):
+    printer = pipeline.stations['cocina']['printer']
+    printer.fail_next = 2
+    pipeline.submit(None, order(product('p1', 'Bravas', 'Entrantes')))
+    asyncio.run(print_all(pipeline))
+    assert printer.tickets == [] and len(pipeline.failed) == 1
+    assert pipeline.stats()['stations']['cocina']['failed'] == 1
+
+    async def scenario(http):
+        assert (await http.post('/tickets/retry-failed')).status_code == 404
+        response = await http.post('/admin/tickets/retry-failed', headers=ADMIN_HEADERS)
+        assert response.json() == {'requeued': 1}
+        await print_all(pipeline)
+
+    api(scenario)
+    assert len(printer.tickets) == 1 and not pipeline.failed